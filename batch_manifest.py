@@ -0,0 +1,70 @@
+import json
+import os
+from glob import glob
+from gen_utils import atomic_path
+
+#batch inference over a scan archive(see start_inference.py):
+#    the manifest lists the cases once, json lines of {"scan", "jaw"}. later runs and the other shards read it instead of walking the archive.
+#    a shard i/n processes every n-th case of the manifest from the i-th.
+#    a finished case has a done record next to its outputs, {"run", "outputs", "total_wall_ms"}. it is skipped while the record matches the run(model digest, output format) and its outputs exist.
+
+def list_scans(input_dir_path):
+    """the .stl files of the subdirectories of input_dir_path(one directory per case), sorted"""
+    stl_path_ls = []
+    for dir_path in [
+        x[0] for x in os.walk(input_dir_path)
+        ][1:]:
+        if os.path.basename(dir_path):
+            stl_path_ls += glob(os.path.join(dir_path,"*.stl"))
+    return sorted(stl_path_ls)
+
+def make_manifest(input_dir_path, get_jaw):
+    return [{"scan": stl_path, "jaw": get_jaw(stl_path)} for stl_path in list_scans(input_dir_path)]
+
+def load_or_make_manifest(manifest_path, input_dir_path, get_jaw):
+    """
+    manifest_path: read if it exists, else written with the cases of input_dir_path. None only lists them.
+    get_jaw: function(scan path) => jaw, eg: ScanSegmentation.get_jaw
+    """
+    if manifest_path is not None and os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    cases = make_manifest(input_dir_path, get_jaw)
+    if manifest_path is not None:
+        os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+        #shards that start together write the same listing
+        with atomic_path(manifest_path) as tmp_path, open(tmp_path, "w") as f:
+            for case in cases:
+                f.write(json.dumps(case) + "\n")
+    return cases
+
+def parse_shard(shard):
+    """"i/n" => i, n. i counts from 0"""
+    try:
+        shard_index, num_shards = [int(x) for x in shard.split("/")]
+    except ValueError:
+        raise ValueError(f"shard {shard} is not i/n, eg: 0/4")
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard {shard} is out of range, 0 <= i < n")
+    return shard_index, num_shards
+
+def get_shard(cases, shard):
+    shard_index, num_shards = parse_shard(shard)
+    return cases[shard_index::num_shards]
+
+def get_done_path(output_path):
+    return os.path.splitext(output_path)[0] + ".done.json"
+
+def is_done(output_path, run):
+    """run: settings that change the outputs, eg: {"model_digest", "output_format"}"""
+    try:
+        with open(get_done_path(output_path), "r") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return record.get("run") == run and all(os.path.exists(path) for path in record.get("outputs", []))
+
+def write_done(output_path, run, outputs, total_wall_ms=None):
+    """written last, after the outputs of the case"""
+    with atomic_path(get_done_path(output_path)) as tmp_path, open(tmp_path, "w") as f:
+        json.dump({"run": run, "outputs": outputs, "total_wall_ms": total_wall_ms}, f)
@@ -0,0 +1,88 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import copy
+import json
+import time
+import torch
+from models.modules.grouping_network_module import GroupingNetworkModule
+
+parser = argparse.ArgumentParser(description='Eager vs torch.compile latency of the tgnet point transformer backbones')
+parser.add_argument('--device', default="cuda" if torch.cuda.is_available() else "cpu", type=str, help = "cuda | cpu")
+parser.add_argument('--num_points', default=24000, type=int, help = "points of the first module input.")
+parser.add_argument('--crop_sample_size', default=3072, type=int, help = "points of each tooth crop(second model input).")
+parser.add_argument('--num_crops', default=14, type=int, help = "number of tooth crops given to the second model.")
+parser.add_argument('--repeat', default=5, type=int, help = "timed runs after warm up.")
+parser.add_argument('--compile_mode', default="default", type=str, help = "torch.compile mode. default | reduce-overhead | max-autotune")
+parser.add_argument('--save_path', default="benchmarks/results/compile_backbone.json", type=str, help = "json report path.")
+
+FPS_MODEL_PARAMETER = {
+    "input_feat": 6,
+    "stride": [1, 4, 4, 4, 4],
+    "nstride": [2, 2, 2, 2],
+    "nsample": [36, 24, 24, 24, 24],
+    "blocks": [2, 3, 4, 6, 3],
+    "block_num": 5,
+    "planes": [32, 64, 128, 256, 512],
+}
+
+BDL_MODEL_PARAMETER = {
+    "input_feat": 6,
+    "stride": [1, 1],
+    "nsample": [36, 24],
+    "blocks": [2, 3],
+    "block_num": 2,
+    "planes": [16, 32],
+}
+
+def time_forward(model, inputs, device, repeat):
+    with torch.no_grad():
+        #warm up, the compiled model compiles here
+        start = time.time()
+        output = model([inputs])
+        warm_up = time.time() - start
+        latency_ls = []
+        for _ in range(repeat):
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.time()
+            model([inputs])
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            latency_ls.append(time.time() - start)
+    return output, warm_up, sorted(latency_ls)[len(latency_ls)//2]
+
+def benchmark_model(name, model, inputs, args, device):
+    eager_output, _, eager_latency = time_forward(model, inputs, device, args.repeat)
+    compiled = copy.deepcopy(model)
+    compiled.compile_stages(mode=args.compile_mode)
+    compiled_output, compile_time, compiled_latency = time_forward(compiled, inputs, device, args.repeat)
+    result = {
+        "model": name,
+        "eager_latency": eager_latency,
+        "compiled_latency": compiled_latency,
+        "speedup": eager_latency / compiled_latency,
+        "compile_time": compile_time,
+        "max_abs_diff": max((a.float() - b.float()).abs().max().item() for a, b in zip(eager_output, compiled_output) if type(a) == torch.Tensor),
+    }
+    print(f"{name:<26}eager {eager_latency*1000:9.1f}ms  compiled {compiled_latency*1000:9.1f}ms  speedup {result['speedup']:5.2f}  compile {compile_time:6.1f}s  max diff {result['max_abs_diff']:.2e}")
+    return result
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    results = []
+    for name, model_parameter, inputs in [
+        ("first_ins_cent_model", FPS_MODEL_PARAMETER, torch.rand(1, 6, args.num_points)),
+        ("second_ins_cent_model", FPS_MODEL_PARAMETER, torch.rand(args.num_crops, 6, args.crop_sample_size)),
+        ("bdl first_ins_cent_model", BDL_MODEL_PARAMETER, torch.rand(1, 6, args.num_points)),
+    ]:
+        model_parameter = dict(model_parameter, crop_sample_size=args.crop_sample_size)
+        module = GroupingNetworkModule({"model_parameter": model_parameter}).to(device).eval()
+        results.append(benchmark_model(name, module.first_ins_cent_model, inputs.to(device), args, device))
+
+    os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+    with open(args.save_path, "w") as f:
+        json.dump({"device": args.device, "compile_mode": args.compile_mode, "results": results}, f, indent=4)
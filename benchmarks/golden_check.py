@@ -0,0 +1,290 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import importlib
+import json
+import tempfile
+import numpy as np
+import torch
+from sklearn.metrics import adjusted_rand_score
+import ops_utils as ou
+from models import tgn_loss
+from external_libs.pointops.functions import pointops
+from benchmarks.synthetic_arch import make_arch_mesh, write_arch_scan
+
+parser = argparse.ArgumentParser(description='Golden output check: runs the reference and a candidate implementation of each tgnet stage on the same seeded inputs and compares the outputs')
+parser.add_argument('--stages', default=None, type=str, help = "comma separated stage names to check. default: all, see GOLDEN_STAGES")
+parser.add_argument('--seeds', default="0,1,2", type=str, help = "comma separated seeds, every stage is checked once per seed.")
+parser.add_argument('--num_vertices', default=20000, type=int, help = "vertex count of the synthetic scans.")
+parser.add_argument('--device', default="cuda" if torch.cuda.is_available() else "cpu", type=str, help = "device of the candidates. the pointops references always run the torch cpu versions.")
+parser.add_argument('--candidate', default=[], action='append', type=str, help = "stage=module:function, replaces the default candidate of a stage. can be repeated. eg: --candidate clustering=ops_utils:get_clustering_labels_fast")
+parser.add_argument('--min_ari', default=0.99, type=float, help = "instance labels pass if the adjusted rand index is at least this.")
+parser.add_argument('--min_agreement', default=0.99, type=float, help = "final labels pass if this ratio of the vertices agree.")
+parser.add_argument('--rtol', default=1e-4, type=float, help = "relative tolerance of losses and distances.")
+parser.add_argument('--atol', default=1e-6, type=float, help = "absolute tolerance of losses and distances.")
+parser.add_argument('--checkpoint_path', default=None, type=str, help = "checkpoint path(for tgnet_fps). the pipeline stage is skipped if not given.")
+parser.add_argument('--checkpoint_path_bdl', default=None, type=str, help = "checkpoint path(for tgnet_bdl).")
+parser.add_argument('--pipeline_profiles', default="bf16", type=str, help = "comma separated inference profiles of the pipeline candidates. the reference is fp32 without chunking.")
+parser.add_argument('--inference_chunk_size', default=None, type=int, help = "inference_chunk_size of the pipeline candidates, see start_inference.py")
+parser.add_argument('--save_path', default="benchmarks/results/golden_check.json", type=str, help = "json report path.")
+
+NUM_FPS_POINTS = 4096
+NUM_KNN_SAMPLES = 24
+NUM_CLUSTERING_POINTS = 16000
+NUM_LOSS_POINTS = 8000
+
+def normalize_vertices(vertices):
+    vertices = vertices - np.mean(vertices, axis=0)
+    return ((vertices-np.min(vertices[:,1]))/(np.max(vertices[:,1])- np.min(vertices[:,1])))*1.8-0.8
+
+def make_golden_inputs(seed, num_vertices):
+    """
+    seeded inputs of every stage, built from two synthetic arches(a packed batch of two clouds).
+    the network outputs are replaced with the ground truth as in stage_suite.py.
+    """
+    rng = np.random.RandomState(seed)
+    xyz_ls, label_ls = [], []
+    for jaw_idx, jaw in enumerate(["lower", "upper"]):
+        mesh, labels = make_arch_mesh(num_vertices, jaw, seed*2 + jaw_idx)
+        xyz_ls.append(normalize_vertices(np.asarray(mesh.vertices)))
+        label_ls.append(labels)
+    xyz = np.concatenate(xyz_ls).astype(np.float32)
+    offset = np.cumsum([arr.shape[0] for arr in xyz_ls])
+
+    #moved points of the first module: tooth centroids with a little noise and a few outliers(dbscan noise points)
+    sampled_idx = rng.choice(xyz_ls[0].shape[0], NUM_CLUSTERING_POINTS, replace=False)
+    sampled_xyz, sampled_labels = xyz_ls[0][sampled_idx], label_ls[0][sampled_idx]
+    moved_points = sampled_xyz.copy()
+    for label in np.unique(sampled_labels[sampled_labels != 0]):
+        mask = sampled_labels == label
+        moved_points[mask] = moved_points[mask].mean(axis=0) + rng.normal(scale=0.004, size=(mask.sum(), 3))
+    outliers = rng.rand(moved_points.shape[0]) < 0.03
+    moved_points[outliers] += rng.normal(scale=0.05, size=(outliers.sum(), 3))
+
+    #training batch of the loss functions: (B, 3, N) points, (B, 1, N) labels(-1 gingiva, 0~15 teeth), offsets close to the centroids
+    loss_xyz_ls, loss_label_ls, loss_offset_ls = [], [], []
+    for cloud_xyz, cloud_labels in zip(xyz_ls, label_ls):
+        idx = rng.choice(cloud_xyz.shape[0], NUM_LOSS_POINTS, replace=False)
+        seg_label = np.unique(cloud_labels, return_inverse=True)[1].reshape(-1)[idx] - 1
+        pred_offset = rng.normal(scale=0.01, size=(NUM_LOSS_POINTS, 3))
+        for label in np.unique(seg_label[seg_label >= 0]):
+            mask = seg_label == label
+            pred_offset[mask] += (cloud_xyz[idx][mask].mean(axis=0) - cloud_xyz[idx][mask]) * 0.9
+        loss_xyz_ls.append(cloud_xyz[idx].T)
+        loss_label_ls.append(seg_label.reshape(1, -1))
+        loss_offset_ls.append(pred_offset.T)
+
+    return {
+        "xyz": torch.from_numpy(xyz),
+        "offset": torch.tensor(offset, dtype=torch.int),
+        "new_offset": torch.tensor([NUM_FPS_POINTS, 2*NUM_FPS_POINTS], dtype=torch.int),
+        "moved_points": moved_points,
+        "fg_mask": (sampled_labels != 0).astype(int),
+        "loss_xyz": torch.tensor(np.stack(loss_xyz_ls), dtype=torch.float),
+        "loss_seg_label": torch.tensor(np.stack(loss_label_ls), dtype=torch.float),
+        "loss_pred_offset": torch.tensor(np.stack(loss_offset_ls), dtype=torch.float),
+    }
+
+def get_stage_args(stage, inputs, device):
+    """arguments of the reference and the candidate functions of a stage, the tensors on device"""
+    if stage == "fps":
+        return [inputs["xyz"].to(device), inputs["offset"].to(device), inputs["new_offset"].to(device)]
+    elif stage == "knnquery":
+        xyz, offset = inputs["xyz"].to(device), inputs["offset"].to(device)
+        return [NUM_KNN_SAMPLES, xyz, xyz, offset, offset]
+    elif stage == "clustering":
+        return [inputs["moved_points"], inputs["fg_mask"]]
+    elif stage in ["offset_loss", "chamfer_loss"]:
+        return [inputs["loss_pred_offset"].to(device), inputs["loss_xyz"].to(device), inputs["loss_seg_label"].to(device)]
+    else:
+        raise "unknown stage"
+
+def to_cpu(output):
+    if type(output) == torch.Tensor:
+        return output.cpu()
+    elif type(output) in (list, tuple):
+        return type(output)(to_cpu(value) for value in output)
+    return output
+
+def knnquery_reference(nsample, xyz, new_xyz, offset, new_offset):
+    """knnquery_cpu with distances instead of squared distances, as pointops.knnquery"""
+    idx, dist2 = pointops.knnquery_cpu(nsample, xyz, new_xyz, offset, new_offset)
+    return idx, torch.sqrt(dist2)
+
+def get_index_set_result(ref, cand, args):
+    """fps: the same points have to be sampled, the order may differ"""
+    ref, cand = ref.numpy(), cand.numpy()
+    index_set_equal = ref.shape == cand.shape and np.array_equal(np.sort(ref), np.sort(cand))
+    return {
+        "passed": bool(index_set_equal),
+        "index_set_equal": bool(index_set_equal),
+        "order_equal": bool(np.array_equal(ref, cand)),
+    }
+
+def get_knn_result(ref, cand, args):
+    """neighbors at the same distance can be swapped, so the distances decide and the neighbor sets are only reported"""
+    (ref_idx, ref_dist), (cand_idx, cand_dist) = ref, cand
+    row_set_equal = np.all(np.sort(ref_idx.numpy(), axis=1) == np.sort(cand_idx.numpy(), axis=1), axis=1)
+    max_dist_diff = float((ref_dist - cand_dist).abs().max())
+    return {
+        "passed": bool(torch.allclose(ref_dist, cand_dist.float(), rtol=args.rtol, atol=args.atol)),
+        "neighbor_set_agreement": float(np.mean(row_set_equal)),
+        "max_dist_diff": max_dist_diff,
+    }
+
+def get_ari_result(ref, cand, args):
+    """instance ids are arbitrary, the labels are compared as partitions"""
+    ari = float(adjusted_rand_score(np.asarray(ref).reshape(-1), np.asarray(cand).reshape(-1)))
+    return {"passed": ari >= args.min_ari, "ari": ari}
+
+def get_loss_result(ref, cand, args):
+    ref_ls = [float(value) for value in (ref if type(ref) in (list, tuple) else [ref])]
+    cand_ls = [float(value) for value in (cand if type(cand) in (list, tuple) else [cand])]
+    diff_ls = [abs(ref_value - cand_value) for ref_value, cand_value in zip(ref_ls, cand_ls)]
+    return {
+        "passed": all(diff <= args.atol + args.rtol*abs(ref_value) for diff, ref_value in zip(diff_ls, ref_ls)),
+        "reference_values": ref_ls,
+        "candidate_values": cand_ls,
+        "max_abs_diff": max(diff_ls),
+    }
+
+def get_label_agreement(ref, cand, match_ids=False):
+    """
+    ratio of the vertices with the same label.
+    match_ids: every candidate id is first renamed to the reference id it overlaps the most(instance ids)
+    """
+    ref, cand = np.asarray(ref).reshape(-1), np.asarray(cand).reshape(-1)
+    if match_ids:
+        ref_ids, ref_inverse = np.unique(ref, return_inverse=True)
+        cand_ids, cand_inverse = np.unique(cand, return_inverse=True)
+        overlap = np.bincount(cand_inverse.reshape(-1)*ref_ids.shape[0] + ref_inverse.reshape(-1), minlength=cand_ids.shape[0]*ref_ids.shape[0])
+        cand = ref_ids[np.argmax(overlap.reshape(cand_ids.shape[0], ref_ids.shape[0]), axis=1)][cand_inverse.reshape(-1)]
+    return float(np.mean(ref == cand))
+
+def get_final_label_result(ref, cand, args):
+    sem_agreement = get_label_agreement(ref["sem"], cand["sem"])
+    ins_agreement = get_label_agreement(ref["ins"], cand["ins"], match_ids=True)
+    return {
+        "passed": sem_agreement >= args.min_agreement and ins_agreement >= args.min_agreement,
+        "sem_agreement": sem_agreement,
+        "ins_agreement": ins_agreement,
+        "ins_ari": float(adjusted_rand_score(ref["ins"], cand["ins"])),
+    }
+
+#reference(always run on cpu), default candidate(None: nothing to compare until a fast path is given with --candidate), metric
+#a candidate takes the same arguments as the reference of its stage
+GOLDEN_STAGES = {
+    "fps": (pointops.furthestsampling_cpu, pointops.furthestsampling, get_index_set_result),
+    "knnquery": (knnquery_reference, pointops.knnquery, get_knn_result),
+    "clustering": (ou.get_clustering_labels, None, get_ari_result),
+    "offset_loss": (tgn_loss.batch_center_offset_loss, tgn_loss.segment_center_offset_loss, get_loss_result),
+    "chamfer_loss": (tgn_loss.batch_chamfer_distance_loss, tgn_loss.segment_chamfer_distance_loss, get_loss_result),
+    "pipeline": (None, None, get_final_label_result),
+}
+#the default candidates of these stages run the reference code on cpu
+CUDA_ONLY_CANDIDATES = ["fps", "knnquery"]
+
+def load_candidate(target):
+    """module:function to the function"""
+    module_name, function_name = target.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+def check_stage(stage, inputs, candidate, seed, args):
+    reference, _, metric = GOLDEN_STAGES[stage]
+    np.random.seed(seed)
+    ref = to_cpu(reference(*get_stage_args(stage, inputs, "cpu")))
+    np.random.seed(seed)
+    cand = to_cpu(candidate(*get_stage_args(stage, inputs, args.device)))
+    return metric(ref, cand, args)
+
+def check_pipeline(args, seeds):
+    """final sem/ins of the whole pipeline: fp32 without chunking against every candidate profile"""
+    from inference_pipelines.inference_pipeline_maker import make_inference_pipeline
+    ckpt_path_ls = [args.checkpoint_path, args.checkpoint_path_bdl]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scan_paths = []
+        for seed in seeds:
+            scan_paths.append(os.path.join(tmp_dir, f"golden_{seed}_lower.stl"))
+            write_arch_scan(scan_paths[-1], args.num_vertices, "lower", seed)
+
+        def run(profile, inference_chunk_size):
+            pipeline = make_inference_pipeline("tgnet", ckpt_path_ls, inference_chunk_size, args.device, profile)
+            outputs = []
+            for seed, scan_path in zip(seeds, scan_paths):
+                np.random.seed(seed)
+                torch.manual_seed(seed)
+                pred_result = pipeline(scan_path, "lower")
+                outputs.append({"sem": pred_result["sem"], "ins": pred_result["ins"]})
+            return outputs
+
+        ref_outputs = run("fp32", None)
+        for profile in args.pipeline_profiles.split(","):
+            if profile == "int8" and args.device != "cpu":
+                print("int8 is cpu only, skipped")
+                continue
+            for seed, ref, cand in zip(seeds, ref_outputs, run(profile, args.inference_chunk_size)):
+                results.append({"stage": "pipeline", "candidate": f"{profile}, chunk {args.inference_chunk_size}", "seed": seed, **get_final_label_result(ref, cand, args)})
+    return results
+
+def format_value(value):
+    if type(value) == float:
+        return f"{value:.6g}"
+    elif type(value) == list:
+        return "[" + " ".join(format_value(item) for item in value) + "]"
+    return str(value)
+
+def print_result(result):
+    metrics = ", ".join(f"{key} {format_value(value)}" for key, value in result.items() if key not in ("stage", "candidate", "seed", "passed"))
+    print(f"{'PASS' if result['passed'] else 'FAIL'}  {result['stage']:<14}seed {result['seed']:<4}{result['candidate']:<40} {metrics}")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    seeds = [int(seed) for seed in args.seeds.split(",")]
+    stages = list(GOLDEN_STAGES.keys()) if args.stages is None else args.stages.split(",")
+    candidates = {stage: GOLDEN_STAGES[stage][1] for stage in GOLDEN_STAGES}
+    candidate_names = {stage: "default" for stage in GOLDEN_STAGES}
+    for candidate_arg in args.candidate:
+        stage, target = candidate_arg.split("=")
+        if stage not in GOLDEN_STAGES or stage == "pipeline":
+            raise "unknown stage"
+        candidates[stage] = load_candidate(target)
+        candidate_names[stage] = target
+
+    report = {"device": args.device, "seeds": seeds, "num_vertices": args.num_vertices, "results": [], "skipped": {}}
+    for stage in stages:
+        if stage == "pipeline":
+            continue
+        if candidates[stage] is None:
+            report["skipped"][stage] = "no candidate, give one with --candidate"
+        elif stage in CUDA_ONLY_CANDIDATES and candidate_names[stage] == "default" and not args.device.startswith("cuda"):
+            report["skipped"][stage] = "the default candidate is the reference on cpu"
+    for seed in seeds:
+        inputs = make_golden_inputs(seed, args.num_vertices)
+        for stage in stages:
+            if stage == "pipeline" or stage in report["skipped"]:
+                continue
+            result = {"stage": stage, "candidate": candidate_names[stage], "seed": seed, **check_stage(stage, inputs, candidates[stage], seed, args)}
+            report["results"].append(result)
+            print_result(result)
+
+    if "pipeline" in stages:
+        if args.checkpoint_path is None or args.checkpoint_path_bdl is None:
+            report["skipped"]["pipeline"] = "no checkpoints, give --checkpoint_path and --checkpoint_path_bdl"
+        else:
+            for result in check_pipeline(args, seeds):
+                report["results"].append(result)
+                print_result(result)
+
+    for stage, reason in report["skipped"].items():
+        print(f"SKIP  {stage:<14}{reason}")
+    failed = [result for result in report["results"] if not result["passed"]]
+    report["passed"] = len(failed) == 0
+    print(f"{len(report['results']) - len(failed)}/{len(report['results'])} checks passed")
+
+    os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+    with open(args.save_path, "w") as f:
+        json.dump(report, f, indent=4)
+    if len(failed) > 0:
+        sys.exit(1)
@@ -0,0 +1,89 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import json
+import time
+from glob import glob
+import numpy as np
+from sklearn.metrics import adjusted_rand_score
+from inference_pipelines.inference_pipeline_maker import make_inference_pipeline
+from predict_utils import ScanSegmentation
+
+parser = argparse.ArgumentParser(description='Latency and label agreement of the tgnet inference profiles against fp32')
+parser.add_argument('--input_dir_path', type=str, required=True, help = "directory that contains sample scans(.obj/.stl), searched recursively.")
+parser.add_argument('--checkpoint_path', default="ckpts/tgnet_fps", type=str, help = "checkpoint path.")
+parser.add_argument('--checkpoint_path_bdl', default="ckpts/tgnet_bdl", type=str, help = "checkpoint path(for tgnet_bdl).")
+parser.add_argument('--profiles', default="fp32,int8,bf16", type=str, help = "comma separated inference profiles. fp32 is always run as the reference.")
+parser.add_argument('--device', default="cpu", type=str, help = "cuda | cpu. int8 is skipped on cuda.")
+parser.add_argument('--inference_chunk_size', default=None, type=int, help = "see start_inference.py")
+parser.add_argument('--prepared_cache_dir', default=None, type=str, help = "see start_inference.py")
+parser.add_argument('--max_scans', default=10, type=int, help = "number of sample scans to run.")
+parser.add_argument('--save_path', default="benchmarks/results/inference_profiles.json", type=str, help = "json report path.")
+
+def get_scan_paths(input_dir_path, max_scans):
+    scan_paths = sorted(glob(os.path.join(input_dir_path, "**", "*.obj"), recursive=True) + glob(os.path.join(input_dir_path, "**", "*.stl"), recursive=True))
+    return scan_paths[:max_scans]
+
+def run_profile(args, profile, scan_paths):
+    start = time.time()
+    pipeline = make_inference_pipeline("tgnet", [args.checkpoint_path+".h5", args.checkpoint_path_bdl+".h5"], args.inference_chunk_size, args.device, profile, args.prepared_cache_dir)
+    load_time = time.time() - start
+    results = {}
+    for scan_path in scan_paths:
+        jaw = ScanSegmentation.get_jaw(scan_path)
+        start = time.time()
+        pred_result = pipeline(scan_path, jaw)
+        results[scan_path] = {
+            "latency": time.time() - start,
+            "sem": pred_result["sem"],
+            "ins": pred_result["ins"],
+        }
+    return load_time, results
+
+def summarize(profile, load_time, results, ref_results):
+    latency_ls = [results[path]["latency"] for path in results]
+    sem_agreement_ls = [np.mean(results[path]["sem"] == ref_results[path]["sem"]) for path in results]
+    #instance ids are arbitrary, so instances are compared as partitions
+    ins_ari_ls = [adjusted_rand_score(ref_results[path]["ins"], results[path]["ins"]) for path in results]
+    return {
+        "profile": profile,
+        "load_time": load_time,
+        "latency_mean": float(np.mean(latency_ls)),
+        "latency_p50": float(np.percentile(latency_ls, 50)),
+        "latency_max": float(np.max(latency_ls)),
+        "sem_agreement_mean": float(np.mean(sem_agreement_ls)),
+        "sem_agreement_min": float(np.min(sem_agreement_ls)),
+        "ins_ari_mean": float(np.mean(ins_ari_ls)),
+        "ins_ari_min": float(np.min(ins_ari_ls)),
+    }
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    scan_paths = get_scan_paths(args.input_dir_path, args.max_scans)
+    if len(scan_paths) == 0:
+        raise "no scans in input_dir_path"
+
+    profiles = ["fp32"] + [profile for profile in args.profiles.split(",") if profile != "fp32"]
+    if args.device != "cpu" and "int8" in profiles:
+        print("int8 is cpu only, skipped")
+        profiles.remove("int8")
+
+    report = {"device": args.device, "num_scans": len(scan_paths), "profiles": []}
+    ref_results = None
+    for profile in profiles:
+        print(f"running {profile} on {len(scan_paths)} scans")
+        load_time, results = run_profile(args, profile, scan_paths)
+        if ref_results is None:
+            ref_results = results
+        report["profiles"].append(summarize(profile, load_time, results, ref_results))
+
+    print(f"{'profile':<8}{'load(s)':>10}{'mean(s)':>10}{'p50(s)':>10}{'speedup':>10}{'sem agree':>12}{'ins ari':>10}")
+    ref_latency = report["profiles"][0]["latency_mean"]
+    for summary in report["profiles"]:
+        print(f"{summary['profile']:<8}{summary['load_time']:>10.2f}{summary['latency_mean']:>10.2f}{summary['latency_p50']:>10.2f}"
+              f"{ref_latency/summary['latency_mean']:>10.2f}{summary['sem_agreement_mean']:>12.4f}{summary['ins_ari_mean']:>10.4f}")
+
+    os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+    with open(args.save_path, "w") as f:
+        json.dump(report, f, indent=4)
@@ -0,0 +1,73 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from benchmarks.synthetic_arch import write_arch_scan
+from inference_pipelines.inference_pipeline_maker import make_inference_pipeline
+
+parser = argparse.ArgumentParser(description='Throughput and latency of concurrent tgnet requests with and without micro batching of the first module forward')
+parser.add_argument('--checkpoint_path', default="ckpts/tgnet_fps", type=str, help = "checkpoint path.")
+parser.add_argument('--checkpoint_path_bdl', default="ckpts/tgnet_bdl", type=str, help = "checkpoint path(for tgnet_bdl).")
+parser.add_argument('--checkpoint_ext', default=".h5", type=str, help = "see start_inference.py")
+parser.add_argument('--device', default="cuda", type=str, help = "cuda | cpu")
+parser.add_argument('--preset', default="accurate", type=str, help = "see TGNET_PRESETS in inference_pipeline_maker.py")
+parser.add_argument('--num_vertices', default=200000, type=int, help = "vertices of the synthetic scans.")
+parser.add_argument('--num_scans', default=4, type=int, help = "different synthetic scans, the requests cycle through them.")
+parser.add_argument('--num_requests', default=16, type=int, help = "requests of each concurrent run.")
+parser.add_argument('--concurrency', default=4, type=int, help = "requests in flight, as MAX_CONCURRENT_REQUESTS of inference_server.py")
+parser.add_argument('--max_batch', default=4, type=int, help = "see micro_batcher.py")
+parser.add_argument('--max_wait_ms', default=10.0, type=float, help = "see micro_batcher.py")
+parser.add_argument('--save_path', default="benchmarks/results/micro_batching.json", type=str, help = "json report path.")
+
+def run_requests(pipeline, scan_paths, num_requests, concurrency):
+    def request(i):
+        start = time.perf_counter()
+        result = pipeline(scan_paths[i % len(scan_paths)], "lower")
+        return time.perf_counter() - start, result.get("stage_timing", {}).get("first_forward_batch_size", 1)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(request, range(num_requests)))
+    wall = time.perf_counter() - start
+    latency_ls = [latency for latency, _ in results]
+    return {
+        "requests": num_requests,
+        "concurrency": concurrency,
+        "throughput": num_requests / wall,
+        "latency_mean": float(np.mean(latency_ls)),
+        "latency_p50": float(np.percentile(latency_ls, 50)),
+        "latency_p90": float(np.percentile(latency_ls, 90)),
+        "mean_batch_size": float(np.mean([batch_size for _, batch_size in results])),
+    }
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    report = {"args": vars(args), "results": {}}
+    ckpt_path_ls = [args.checkpoint_path+args.checkpoint_ext, args.checkpoint_path_bdl+args.checkpoint_ext]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scan_paths = []
+        for seed in range(args.num_scans):
+            scan_paths.append(os.path.join(tmp_dir, f"arch_{seed}_lower.stl"))
+            write_arch_scan(scan_paths[-1], args.num_vertices, "lower", seed)
+
+        for name, micro_batch in [("alone", None), ("micro_batch", {"max_batch": args.max_batch, "max_wait_ms": args.max_wait_ms})]:
+            pipeline = make_inference_pipeline("tgnet", ckpt_path_ls, device=args.device, preset=args.preset, micro_batch=micro_batch)
+            #warm up, the lazy imports and the allocator
+            pipeline(scan_paths[0], "lower")
+            report["results"][name] = {
+                "single": run_requests(pipeline, scan_paths, args.num_scans, 1),
+                "concurrent": run_requests(pipeline, scan_paths, args.num_requests, args.concurrency),
+            }
+
+    print(f"{'mode':<14}{'run':<12}{'req/s':>8}{'mean(s)':>10}{'p50(s)':>10}{'p90(s)':>10}{'batch':>8}")
+    for name, runs in report["results"].items():
+        for run_name, stat in runs.items():
+            print(f"{name:<14}{run_name:<12}{stat['throughput']:>8.2f}{stat['latency_mean']:>10.2f}{stat['latency_p50']:>10.2f}{stat['latency_p90']:>10.2f}{stat['mean_batch_size']:>8.2f}")
+
+    os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+    with open(args.save_path, "w") as f:
+        json.dump(report, f, indent=4)
@@ -0,0 +1,95 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import json
+import time
+from glob import glob
+import numpy as np
+import gen_utils as gu
+from eval_utils import cal_metric
+from inference_pipelines.inference_pipeline_maker import make_inference_pipeline, TGNET_PRESETS
+from predict_utils import ScanSegmentation
+
+parser = argparse.ArgumentParser(description='Latency and TSA/TIR of the tgnet speed/accuracy presets on a held-out split')
+parser.add_argument('--input_dir_path', type=str, required=True, help = "scans as <input_dir_path>/<id>/<id>_<jaw>.obj(or .stl)")
+parser.add_argument('--gt_json_dir_path', type=str, required=True, help = "ground truth labels as <gt_json_dir_path>/<id>/<id>_<jaw>.json")
+parser.add_argument('--split_txt_path', default=None, type=str, help = "ids of the held-out split, eg: base_name_test_fold.txt. default: every scan.")
+parser.add_argument('--checkpoint_path', default="ckpts/tgnet_fps", type=str, help = "checkpoint path.")
+parser.add_argument('--checkpoint_path_bdl', default="ckpts/tgnet_bdl", type=str, help = "checkpoint path(for tgnet_bdl).")
+parser.add_argument('--checkpoint_ext', default=".h5", type=str, help = "see start_inference.py")
+parser.add_argument('--presets', default="accurate,balanced,fast", type=str, help = "comma separated presets, see TGNET_PRESETS in inference_pipeline_maker.py")
+parser.add_argument('--device', default="cuda", type=str, help = "cuda | cpu")
+parser.add_argument('--inference_profile', default="fp32", type=str, help = "see start_inference.py")
+parser.add_argument('--inference_chunk_size', default=None, type=int, help = "see start_inference.py")
+parser.add_argument('--max_scans', default=None, type=int, help = "number of scans of the split to run. default: all")
+parser.add_argument('--save_path', default="benchmarks/results/presets.json", type=str, help = "json report path.")
+
+def get_scan_paths(input_dir_path, split_txt_path, max_scans):
+    scan_paths = sorted(glob(os.path.join(input_dir_path, "**", "*.obj"), recursive=True) + glob(os.path.join(input_dir_path, "**", "*.stl"), recursive=True))
+    if split_txt_path is not None:
+        with open(split_txt_path) as f:
+            split_ids = set(line.strip() for line in f if line.strip())
+        scan_paths = [path for path in scan_paths if os.path.basename(path).split("_")[0] in split_ids]
+    return scan_paths[:max_scans]
+
+def get_gt_labels(gt_json_dir_path, scan_path):
+    base_name = os.path.splitext(os.path.basename(scan_path))[0]
+    return np.array(gu.load_json(os.path.join(gt_json_dir_path, base_name.split("_")[0], base_name + ".json"))["labels"]).reshape(-1)
+
+def run_preset(pred_obj, preset, scan_paths, gt_json_dir_path):
+    results = []
+    for scan_path in scan_paths:
+        jaw = ScanSegmentation.get_jaw(scan_path)
+        start = time.time()
+        labels, instances, _ = pred_obj.predict(scan_path, jaw, preset)
+        latency = time.time() - start
+        gt_labels = get_gt_labels(gt_json_dir_path, scan_path)
+        if gt_labels.shape[0] != len(labels):
+            print(f"{scan_path}: {gt_labels.shape[0]} ground truth labels for {len(labels)} vertices, skipped")
+            continue
+        iou, f1, _, sem_acc, _ = cal_metric(gt_labels, np.array(labels), np.array(instances))
+        results.append({"scan": scan_path, "latency": latency, "tsa": f1, "tir": sem_acc, "iou": iou})
+    return results
+
+def summarize(preset, results):
+    latency_ls = [result["latency"] for result in results]
+    return {
+        "preset": preset,
+        "settings": TGNET_PRESETS[preset],
+        "num_scans": len(results),
+        "latency_mean": float(np.mean(latency_ls)),
+        "latency_p50": float(np.percentile(latency_ls, 50)),
+        "latency_max": float(np.max(latency_ls)),
+        "tsa": float(np.mean([result["tsa"] for result in results])),
+        "tir": float(np.mean([result["tir"] for result in results])),
+        "iou": float(np.mean([result["iou"] for result in results])),
+        "scans": results,
+    }
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    scan_paths = get_scan_paths(args.input_dir_path, args.split_txt_path, args.max_scans)
+    if len(scan_paths) == 0:
+        raise "no scans in input_dir_path"
+
+    #one pipeline for every preset, as in the server where the preset is chosen per request
+    pred_obj = ScanSegmentation(make_inference_pipeline("tgnet", [args.checkpoint_path+args.checkpoint_ext, args.checkpoint_path_bdl+args.checkpoint_ext], args.inference_chunk_size, args.device, args.inference_profile))
+    #the first scan also imports the lazy modules and warms up the allocator, it is not timed
+    pred_obj.predict(scan_paths[0], ScanSegmentation.get_jaw(scan_paths[0]))
+
+    report = {"device": args.device, "inference_profile": args.inference_profile, "presets": []}
+    for preset in args.presets.split(","):
+        print(f"running {preset} on {len(scan_paths)} scans")
+        report["presets"].append(summarize(preset, run_preset(pred_obj, preset, scan_paths, args.gt_json_dir_path)))
+
+    print(f"{'preset':<10}{'points':>8}{'crop':>6}{'mean(s)':>10}{'p50(s)':>10}{'speedup':>10}{'TSA':>8}{'TIR':>8}{'IoU':>8}")
+    ref_latency = report["presets"][0]["latency_mean"]
+    for summary in report["presets"]:
+        print(f"{summary['preset']:<10}{summary['settings']['num_of_points']:>8}{summary['settings']['crop_sample_size']:>6}"
+              f"{summary['latency_mean']:>10.2f}{summary['latency_p50']:>10.2f}{ref_latency/summary['latency_mean']:>10.2f}"
+              f"{summary['tsa']:>8.4f}{summary['tir']:>8.4f}{summary['iou']:>8.4f}")
+
+    os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+    with open(args.save_path, "w") as f:
+        json.dump(report, f, indent=4)
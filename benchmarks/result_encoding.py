@@ -0,0 +1,86 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import io
+import json
+import time
+from glob import glob
+import numpy as np
+import gen_utils as gu
+from benchmarks.synthetic_arch import make_arch_mesh
+from mesh_protocol import encode_result_message, decode_result_message, zstandard
+from predict_utils import NpEncoder
+
+parser = argparse.ArgumentParser(description='Size and encode/decode time of the label output formats(json, binary message, npz)')
+parser.add_argument('--sizes', default="50000,200000,1000000", type=str, help = "comma separated vertex counts of the synthetic scans.")
+parser.add_argument('--gt_json_dir_path', default=None, type=str, help = "also measure real label orders, eg: ground-truth_labels_instances(<id>/<id>_<jaw>.json with labels and instances)")
+parser.add_argument('--max_scans', default=10, type=int, help = "number of label files of gt_json_dir_path.")
+parser.add_argument('--repeat', default=5, type=int, help = "timed runs of each format, the median is reported.")
+parser.add_argument('--save_path', default="benchmarks/results/result_encoding.json", type=str, help = "json report path.")
+
+def json_format(labels, instances):
+    """what ScanSegmentation.write_output writes"""
+    encoded = json.dumps({"id_patient": "", "jaw": "lower", "labels": labels.tolist(), "instances": instances.tolist()}, cls=NpEncoder).encode("utf-8")
+    return encoded, lambda: json.loads(encoded)
+
+def binary_format(compression):
+    def encode(labels, instances):
+        encoded = encode_result_message({"lower": {"labels": labels, "instances": instances}}, compression, status="success")
+        return encoded, lambda: decode_result_message(encoded)
+    return encode
+
+def npz_format(labels, instances):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, labels=labels.astype(np.uint8), instances=instances.astype(np.uint8), jaw="lower")
+    encoded = buffer.getvalue()
+    def decode():
+        with np.load(io.BytesIO(encoded)) as npz:
+            return npz["labels"], npz["instances"]
+    return encoded, decode
+
+FORMATS = {"json": json_format, "binary": binary_format(None), "binary_gzip": binary_format("gzip"), "npz": npz_format}
+if zstandard is not None:
+    FORMATS["binary_zstd"] = binary_format("zstd")
+
+def measure(labels, instances, repeat):
+    stats = {}
+    for name, encode in FORMATS.items():
+        encode_ms, decode_ms = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            encoded, decode = encode(labels, instances)
+            encode_ms.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            decode()
+            decode_ms.append((time.perf_counter() - start) * 1000)
+        stats[name] = {"bytes": len(encoded), "encode_ms": float(np.median(encode_ms)), "decode_ms": float(np.median(decode_ms))}
+    return stats
+
+def get_cases(args):
+    """(name, labels, instances). the synthetic scans are also shuffled, the worst vertex order for run length encoding"""
+    rng = np.random.RandomState(0)
+    for size in [int(size) for size in args.sizes.split(",")]:
+        _, labels = make_arch_mesh(size, "lower")
+        instances = np.unique(labels, return_inverse=True)[1].reshape(-1)
+        yield f"synthetic_{labels.shape[0]}", labels, instances
+        order = rng.permutation(labels.shape[0])
+        yield f"synthetic_{labels.shape[0]}_shuffled", labels[order], instances[order]
+    if args.gt_json_dir_path is not None:
+        for path in sorted(glob(os.path.join(args.gt_json_dir_path, "**", "*.json"), recursive=True))[:args.max_scans]:
+            gt = gu.load_json(path)
+            yield os.path.basename(path), np.array(gt["labels"]), np.array(gt["instances"])
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    report = {"formats": list(FORMATS.keys()), "results": {}}
+    print(f"{'case':<32}{'format':<14}{'size(KB)':>10}{'ratio':>8}{'encode(ms)':>12}{'decode(ms)':>12}")
+    for name, labels, instances in get_cases(args):
+        stats = measure(labels, instances, args.repeat)
+        report["results"][name] = stats
+        for format_name, stat in stats.items():
+            print(f"{name:<32}{format_name:<14}{stat['bytes']/1024:>10.1f}{stats['json']['bytes']/stat['bytes']:>8.1f}{stat['encode_ms']:>12.2f}{stat['decode_ms']:>12.2f}")
+
+    os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+    with open(args.save_path, "w") as f:
+        json.dump(report, f, indent=4)
@@ -0,0 +1,173 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import json
+import platform
+import tempfile
+import time
+import numpy as np
+import torch
+import gen_utils as gu
+import ops_utils as ou
+from benchmarks.synthetic_arch import write_arch_scan
+from inference_pipelines.inference_pipeline_maker import TGNET_PRESETS
+from inference_pipelines.inference_pipeline_tgn import get_boundary_sampled_feats, transfer_labels
+from predict_utils import save_tooth_and_get_brace_location
+
+parser = argparse.ArgumentParser(description='Timing of the cpu side stages of the tgnet pipeline on synthetic dental arches')
+parser.add_argument('--sizes', default="50000,200000,1000000", type=str, help = "comma separated vertex counts of the synthetic scans.")
+parser.add_argument('--preset', default="accurate", type=str, help = "tgnet preset that gives the point counts of the stages, see TGNET_PRESETS in inference_pipeline_maker.py")
+parser.add_argument('--stages', default=None, type=str, help = "comma separated stage names to run. default: all, see STAGES")
+parser.add_argument('--repeat', default=3, type=int, help = "timed runs of each stage, the median is reported.")
+parser.add_argument('--seed', default=0, type=int, help = "seed of the synthetic scans and of the random sampling in the stages.")
+parser.add_argument('--save_path', default="benchmarks/results/stage_suite.json", type=str, help = "json report path.")
+parser.add_argument('--baseline_path', default="benchmarks/baselines/stage_suite.json", type=str, help = "stored report to compare against. skipped if it does not exist.")
+parser.add_argument('--update_baseline', action='store_true', help = "write this run to baseline_path.")
+parser.add_argument('--tolerance', default=0.2, type=float, help = "a stage regresses if its median is slower than the baseline by more than this ratio(and by more than min_delta_ms).")
+parser.add_argument('--min_delta_ms', default=5.0, type=float, help = "smaller slowdowns are ignored as noise.")
+parser.add_argument('--fail_on_regression', action='store_true', help = "exit with code 1 if a stage regressed.")
+
+STAGES = ["read_txt_obj_ls", "fps", "get_clustering_labels", "get_boundary_sampled_feats", "transfer_labels", "save_tooth_and_get_brace_location"]
+
+def normalize_vertices(vertices):
+    """the same centering and scaling as InferencePipeLine.__call__"""
+    vertices = vertices.copy()
+    vertices -= np.mean(vertices, axis=0)
+    return ((vertices-np.min(vertices[:,1]))/(np.max(vertices[:,1])- np.min(vertices[:,1])))*1.8-0.8
+
+def make_stage_inputs(scan_path, mesh, labels, rng, preset_info):
+    """
+    inputs that look like what each stage gets in the pipeline. the network outputs are replaced with the ground truth:
+    the moved points of a tooth are its centroid with a little noise and a few outliers, as the offsets of a good first module.
+    """
+    feats = np.concatenate([normalize_vertices(np.asarray(mesh.vertices)), np.asarray(mesh.vertex_normals)], axis=1)
+    num_of_points = preset_info["num_of_points"]
+    sampled_idx = gu.fps(feats[:, :3], num_of_points)
+    sampled_feats = feats[sampled_idx]
+    sampled_labels = labels[sampled_idx]
+    instance_ids = np.unique(sampled_labels, return_inverse=True)[1].reshape(-1)
+
+    moved_points = sampled_feats[:, :3].copy()
+    for label in np.unique(sampled_labels[sampled_labels != 0]):
+        mask = sampled_labels == label
+        moved_points[mask] = moved_points[mask].mean(axis=0) + rng.normal(scale=0.004, size=(mask.sum(), 3))
+    #a few badly predicted offsets, they become dbscan noise points as in real predictions
+    outliers = rng.rand(moved_points.shape[0]) < 0.03
+    moved_points[outliers] += rng.normal(scale=0.05, size=(outliers.sum(), 3))
+
+    #first module points + boundary module points, with instance and semantic labels
+    merged_idx = np.concatenate([sampled_idx, rng.choice(feats.shape[0], num_of_points)])
+    merged_labels = labels[merged_idx]
+    return {
+        "scan_path": scan_path,
+        "jaw": "lower",
+        "mesh": mesh,
+        "labels": labels,
+        "feats": feats,
+        "sampled_feats": sampled_feats,
+        "instance_ids": instance_ids,
+        "moved_points": moved_points,
+        "fg_mask": (sampled_labels != 0).astype(int),
+        "num_of_points": num_of_points,
+        "boundary_sampling_info": preset_info["boundary_sampling_info"],
+        "merged_points": feats[merged_idx, :3],
+        "merged_labels": [np.unique(merged_labels, return_inverse=True)[1].reshape(-1), merged_labels],
+    }
+
+def run_stage(name, inputs, out_dir):
+    if name == "read_txt_obj_ls":
+        gu.read_txt_obj_ls(inputs["scan_path"], inputs["jaw"], ret_mesh=True, use_tri_mesh=True)
+    elif name == "fps":
+        gu.fps(inputs["feats"][:, :3], inputs["num_of_points"])
+    elif name == "get_clustering_labels":
+        ou.get_clustering_labels(inputs["moved_points"], inputs["fg_mask"])
+    elif name == "get_boundary_sampled_feats":
+        get_boundary_sampled_feats(inputs["instance_ids"], inputs["feats"], inputs["sampled_feats"], None, inputs["boundary_sampling_info"])
+    elif name == "transfer_labels":
+        transfer_labels(inputs["merged_points"], inputs["merged_labels"], inputs["feats"][:, :3])
+    elif name == "save_tooth_and_get_brace_location":
+        save_tooth_and_get_brace_location(inputs["mesh"], inputs["labels"], out_dir)
+    else:
+        raise "unknown stage"
+
+def time_stage(name, inputs, out_dir, repeat, seed):
+    latency_ls = []
+    for _ in range(repeat):
+        np.random.seed(seed)
+        start = time.perf_counter()
+        run_stage(name, inputs, out_dir)
+        latency_ls.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": float(np.median(latency_ls)), "min_ms": float(np.min(latency_ls))}
+
+def get_env():
+    import open3d as o3d
+    import sklearn
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "open3d": o3d.__version__,
+        "sklearn": sklearn.__version__,
+        "cuda": torch.cuda.is_available(),
+    }
+
+def compare(report, baseline, tolerance, min_delta_ms):
+    """output: list of (size, stage, baseline ms, current ms, ratio, regressed)"""
+    rows = []
+    for size, stages in report["results"].items():
+        for stage, stat in stages.items():
+            if stage not in baseline["results"].get(size, {}):
+                continue
+            base_ms = baseline["results"][size][stage]["median_ms"]
+            ratio = stat["median_ms"] / max(base_ms, 1e-6)
+            regressed = ratio > 1 + tolerance and stat["median_ms"] - base_ms > min_delta_ms
+            rows.append((size, stage, base_ms, stat["median_ms"], ratio, regressed))
+    return rows
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    stages = STAGES if args.stages is None else args.stages.split(",")
+    report = {"env": get_env(), "preset": args.preset, "seed": args.seed, "repeat": args.repeat, "results": {}}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            scan_path = os.path.join(tmp_dir, f"arch_{size}_lower.stl")
+            mesh, labels = write_arch_scan(scan_path, size, "lower", args.seed)
+            inputs = make_stage_inputs(scan_path, mesh, labels, np.random.RandomState(args.seed), TGNET_PRESETS[args.preset])
+            out_dir = os.path.join(tmp_dir, f"individual_{size}")
+            os.makedirs(out_dir, exist_ok=True)
+            report["results"][str(size)] = {}
+            for stage in stages:
+                stat = time_stage(stage, inputs, out_dir, args.repeat, args.seed)
+                report["results"][str(size)][stage] = stat
+                print(f"{len(mesh.vertices):>9} vertices  {stage:<36}{stat['median_ms']:>10.1f}ms")
+
+    os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+    with open(args.save_path, "w") as f:
+        json.dump(report, f, indent=4)
+
+    regressed = False
+    if os.path.exists(args.baseline_path) and not args.update_baseline:
+        with open(args.baseline_path) as f:
+            baseline = json.load(f)
+        if baseline["env"] != report["env"]:
+            print("baseline was recorded in another environment, the comparison is only indicative")
+        if baseline.get("preset", "accurate") != report["preset"]:
+            print(f"baseline was recorded with the {baseline.get('preset', 'accurate')} preset")
+        print(f"{'size':>9}  {'stage':<36}{'baseline':>10}{'current':>10}{'ratio':>8}")
+        for size, stage, base_ms, current_ms, ratio, stage_regressed in compare(report, baseline, args.tolerance, args.min_delta_ms):
+            print(f"{size:>9}  {stage:<36}{base_ms:>10.1f}{current_ms:>10.1f}{ratio:>8.2f}{'  REGRESSION' if stage_regressed else ''}")
+            regressed = regressed or stage_regressed
+    elif args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline_path) or ".", exist_ok=True)
+        with open(args.baseline_path, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"baseline written to {args.baseline_path}")
+
+    if regressed and args.fail_on_regression:
+        sys.exit(1)
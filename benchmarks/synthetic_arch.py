@@ -0,0 +1,105 @@
+import numpy as np
+import open3d as o3d
+
+#fdi labels from the central incisor to the second molar. quadrant 1/4(right side of the patient) is at -x, 2/3 at +x, the incisors at -y.
+TOOTH_NUMBERS = [1, 2, 3, 4, 5, 6, 7]
+#(half width along the arch, half depth across the arch, height) in mm
+TOOTH_SIZES = {1: (4.3, 3.0, 5.0), 2: (3.4, 3.0, 4.6), 3: (3.9, 4.0, 5.5), 4: (3.5, 4.3, 4.4), 5: (3.4, 4.3, 4.2), 6: (5.2, 5.3, 4.0), 7: (5.0, 5.1, 3.8)}
+
+def get_arch_curve(t, width=26.0, depth=30.0):
+    """U shaped arch. t in [-1, 1], 0 is the front(-y), -1/1 are the ends of the right/left sides."""
+    angle = t * np.pi * 0.5
+    return np.stack([width*np.sin(angle), -depth*np.cos(angle)*np.abs(np.cos(angle))**0.3], axis=-1)
+
+def get_arch_frame(t):
+    """position, unit tangent and unit outward normal(labial/buccal direction) of the arch in the xy plane"""
+    position = get_arch_curve(t)
+    tangent = get_arch_curve(t+1e-4) - get_arch_curve(t-1e-4)
+    tangent = tangent / np.linalg.norm(tangent, axis=-1, keepdims=True)
+    outward = np.stack([tangent[..., 1], -tangent[..., 0]], axis=-1)
+    return position, tangent, outward
+
+def get_tooth_positions():
+    """arch parameters of the tooth centers, the teeth are placed side by side from the front"""
+    ts = np.linspace(-1, 1, 4001)
+    xy = get_arch_curve(ts)
+    arc_length = np.concatenate([[0], np.cumsum(np.linalg.norm(np.diff(xy, axis=0), axis=1))])
+    center_length = np.interp(0, ts, arc_length)
+    positions = {}
+    for side in [-1, 1]:
+        length = 0
+        for number in TOOTH_NUMBERS:
+            half_width = TOOTH_SIZES[number][0]
+            length += half_width
+            positions[(side, number)] = np.interp(center_length + side*length, arc_length, ts)
+            length += half_width + 0.2
+    return positions
+
+def make_gingiva(num_vertices, rng):
+    """tube along the arch, the teeth stand on it. returns vertices (n, 3), triangles (m, 3)"""
+    ring = max(16, int(np.sqrt(num_vertices / 12)))
+    length = max(16, num_vertices // ring)
+    ts = np.linspace(-0.95, 0.95, length)
+    position, tangent, outward = get_arch_frame(ts)
+    angles = np.linspace(0, 2*np.pi, ring, endpoint=False)
+    radius = 6.0 * (1 + 0.03*rng.standard_normal((length, 1)))
+    xy = position[:, None, :] + outward[:, None, :] * (radius*np.cos(angles)[None, :])[..., None]
+    z = -3.0 + 4.0*np.sin(angles)[None, :] * np.ones((length, 1))
+    vertices = np.concatenate([xy, z[..., None]], axis=-1).reshape(-1, 3)
+
+    i, j = np.meshgrid(np.arange(length-1), np.arange(ring), indexing="ij")
+    a = i*ring + j
+    b = i*ring + (j+1) % ring
+    c = (i+1)*ring + j
+    d = (i+1)*ring + (j+1) % ring
+    triangles = np.concatenate([np.stack([a, c, b], axis=-1).reshape(-1, 3), np.stack([b, c, d], axis=-1).reshape(-1, 3)])
+    return vertices, triangles
+
+def make_tooth(num_vertices, number, t, rng):
+    """ellipsoid crown with a flattened occlusal side, oriented along the arch at parameter t"""
+    resolution = max(8, int(np.sqrt(num_vertices / 2)))
+    sphere = o3d.geometry.TriangleMesh.create_sphere(radius=1.0, resolution=resolution)
+    unit = np.asarray(sphere.vertices)
+    half_width, half_depth, height = TOOTH_SIZES[number]
+    #occlusal flattening and a little noise so that the surfaces are not perfectly smooth
+    local_z = np.where(unit[:, 2] > 0, np.clip(unit[:, 2], 0, None)**0.6 * height, unit[:, 2] * height)
+    scale = 1 + 0.02*rng.standard_normal(unit.shape[0])
+    position, tangent, outward = get_arch_frame(np.array([t]))
+    xy = position[0] + (unit[:, 0]*half_width*scale)[:, None]*tangent[0] + (unit[:, 1]*half_depth*scale)[:, None]*outward[0]
+    vertices = np.concatenate([xy, (local_z + 2.0)[:, None]], axis=1)
+    return vertices, np.asarray(sphere.triangles)
+
+def make_arch_mesh(num_vertices, jaw="lower", seed=0):
+    """
+    synthetic jaw scan: 14 teeth on a gingiva band, about num_vertices vertices. 60% of the vertices are on the teeth.
+    output:
+        mesh => o3d.geometry.TriangleMesh with vertex normals
+        labels => (num vertices) fdi labels, 0 is the gingiva
+    """
+    rng = np.random.RandomState(seed)
+    vertex_ls, triangle_ls, label_ls = [], [], []
+    count = 0
+    vertices, triangles = make_gingiva(int(num_vertices*0.4), rng)
+    vertex_ls.append(vertices); triangle_ls.append(triangles); label_ls.append(np.zeros(vertices.shape[0], dtype=int))
+    count += vertices.shape[0]
+
+    quadrants = {-1: 4, 1: 3} if jaw == "lower" else {-1: 1, 1: 2}
+    tooth_vertices = int(num_vertices*0.6) // (2*len(TOOTH_NUMBERS))
+    for (side, number), t in get_tooth_positions().items():
+        vertices, triangles = make_tooth(tooth_vertices, number, t, rng)
+        vertex_ls.append(vertices); triangle_ls.append(triangles + count)
+        label_ls.append(np.full(vertices.shape[0], quadrants[side]*10 + number))
+        count += vertices.shape[0]
+
+    mesh = o3d.geometry.TriangleMesh()
+    mesh.vertices = o3d.utility.Vector3dVector(np.concatenate(vertex_ls))
+    mesh.triangles = o3d.utility.Vector3iVector(np.concatenate(triangle_ls))
+    mesh.compute_vertex_normals()
+    return mesh, np.concatenate(label_ls)
+
+def write_arch_scan(path, num_vertices, jaw="lower", seed=0):
+    """writes the synthetic scan(.stl/.obj) and returns its mesh and labels"""
+    mesh, labels = make_arch_mesh(num_vertices, jaw, seed)
+    mesh.compute_triangle_normals()
+    o3d.io.write_triangle_mesh(path, mesh)
+    return mesh, labels
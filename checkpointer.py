@@ -0,0 +1,108 @@
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+def snapshot_state(obj, memo=None):
+    """copy a (nested) state dict so that training can keep mutating the original.
+
+    Tensors are cloned on their own device, which is a fast device-to-device copy.
+    Shared tensors are cloned only once.
+    """
+    if memo is None:
+        memo = {}
+    if isinstance(obj, torch.Tensor):
+        if id(obj) not in memo:
+            memo[id(obj)] = obj.detach().clone()
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot_state(value, memo)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [snapshot_state(value, memo) for value in obj]
+    if isinstance(obj, tuple):
+        return tuple(snapshot_state(value, memo) for value in obj)
+    return obj
+
+def state_to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.cpu()
+    if isinstance(obj, dict):
+        return type(obj)((key, state_to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [state_to_cpu(value) for value in obj]
+    if isinstance(obj, tuple):
+        return tuple(state_to_cpu(value) for value in obj)
+    return obj
+
+def atomic_torch_save(obj, path):
+    """write to a temporary file next to path and swap it in, so a crash never leaves a broken checkpoint"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def get_rng_state():
+    rng_state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state["python"])
+    np.random.set_state(rng_state["numpy"])
+    torch.set_rng_state(rng_state["torch"])
+    if "cuda" in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+
+def reseed_rng(seed):
+    """python, numpy and torch(cpu and every cuda device) generators from one seed"""
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    torch.manual_seed(seed)
+
+class AsyncCheckpointer:
+    """Writes checkpoints from a background thread.
+
+    save() only takes an on-device snapshot of the given states; moving them to host memory,
+    serializing and the atomic file swap happen on a single writer thread.
+    At most one snapshot is in flight, so a new save waits for the previous write to finish.
+    """
+    def __init__(self, async_save=True):
+        self.async_save = async_save
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpointer") if async_save else None
+        self.pending = None
+
+    def save(self, path_to_state: dict):
+        """
+        path_to_state: {file path: state dict to write there}
+        """
+        self.wait()
+        snapshot = snapshot_state(path_to_state)
+        if self.async_save:
+            self.pending = self.executor.submit(self._write, snapshot)
+        else:
+            self._write(snapshot)
+
+    def wait(self):
+        """block until the last submitted checkpoint is on disk. re-raises writer errors."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def _write(path_to_state):
+        for path, state in path_to_state.items():
+            atomic_torch_save(state_to_cpu(state), path)
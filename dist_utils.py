@@ -0,0 +1,65 @@
+import os
+import torch
+import torch.distributed as dist
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def init_distributed(backend="gloo"):
+    """
+    init the process group from the torchrun style env vars(RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT).
+    output: device this process should train on
+    """
+    if "WORLD_SIZE" not in os.environ or int(os.environ["WORLD_SIZE"]) <= 1:
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    local_rank = int(os.environ.get("LOCAL_RANK", os.environ["RANK"]))
+    if torch.cuda.is_available():
+        device = torch.device("cuda", local_rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+    dist.init_process_group(backend=backend)
+    return device
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def all_gather_object(obj):
+    """
+    output: [obj of each process], in rank order. every process has to call it.
+    """
+    if not is_distributed():
+        return [obj]
+    object_ls = [None] * get_world_size()
+    dist.all_gather_object(object_ls, obj)
+    return object_ls
+
+def all_reduce_sum_dict(value_dict, count):
+    """
+    sum the loss sums and counts of every process.
+    input: value_dict: {name: float}, count: int
+    output: summed dict, summed count
+    """
+    if not is_distributed():
+        return value_dict, count
+    keys = sorted(value_dict.keys())
+    values = torch.tensor([float(value_dict[key]) for key in keys] + [float(count)], dtype=torch.float64)
+    if dist.get_backend() == "nccl":
+        values = values.cuda()
+    dist.all_reduce(values)
+    values = values.cpu().tolist()
+    return {key: value for key, value in zip(keys, values[:-1])}, int(values[-1])
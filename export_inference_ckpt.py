@@ -0,0 +1,23 @@
+import sys
+import os
+sys.path.append(os.getcwd())
+import argparse
+import time
+import inference_optimizer as iopt
+from inference_pipelines.inference_pipeline_maker import get_tgnet_inference_config
+from models.modules.grouping_network_module import GroupingNetworkModule
+
+parser = argparse.ArgumentParser(description='Export the tgnet checkpoints for inference(training only modules dropped, memory mappable)')
+parser.add_argument('--checkpoint_path', default="ckpts/tgnet_fps", type=str, help = "checkpoint path, without .h5")
+parser.add_argument('--checkpoint_path_bdl', default="ckpts/tgnet_bdl", type=str, help = "checkpoint path(for tgnet_bdl), without .h5")
+parser.add_argument('--no_fold_bn', action='store_true', help = "keep the batch norms. by default they are folded into the linear layers.")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = get_tgnet_inference_config([args.checkpoint_path+".h5", args.checkpoint_path_bdl+".h5"])
+    for model_info in [config["fps_model_info"], config["boundary_model_info"]]:
+        ckpt_path = model_info["load_ckpt_path"]
+        save_path = ckpt_path[:-len(".h5")] + iopt.INFERENCE_CKPT_SUFFIX
+        start = time.time()
+        count = iopt.export_inference_checkpoint(lambda: GroupingNetworkModule(model_info), ckpt_path, save_path, fold_bn=not args.no_fold_bn)
+        print(f"{ckpt_path}({os.path.getsize(ckpt_path)/2**20:.1f}MB) => {save_path}({os.path.getsize(save_path)/2**20:.1f}MB), {count} tensors, {time.time()-start:.1f}s")
@@ -4,27 +4,101 @@ import torch
 from torch.autograd import Function
 import torch.nn as nn
 
-import pointops_cuda
+try:
+    import pointops_cuda
+except ImportError:
+    #cpu only machines. furthestsampling, knnquery and interpolation fall back to the torch versions below.
+    pointops_cuda = None
+
+
+def furthestsampling_cpu(xyz, offset, new_offset):
+    """
+    same result as the cuda kernel: every cloud starts from its first point and adds the point farthest from the already sampled ones.
+    input: xyz: (n, 3), offset: (b), new_offset: (b)
+    output: idx: (m)
+    """
+    idx = torch.zeros(new_offset[-1].item(), dtype=torch.int, device=xyz.device)
+    start, new_start = 0, 0
+    for end, new_end in zip(offset.tolist(), new_offset.tolist()):
+        seg_xyz = xyz[start:end]
+        tmp = torch.full((end - start,), 1e10, dtype=xyz.dtype, device=xyz.device)
+        last = 0
+        seg_idx = [0]
+        for _ in range(1, new_end - new_start):
+            tmp = torch.minimum(tmp, ((seg_xyz - seg_xyz[last])**2).sum(dim=1))
+            last = int(torch.argmax(tmp))
+            seg_idx.append(last)
+        idx[new_start:new_end] = torch.tensor(seg_idx, dtype=torch.int, device=xyz.device) + start
+        start, new_start = end, new_end
+    return idx
+
+
+def knnquery_cpu(nsample, xyz, new_xyz, offset, new_offset, chunk_elements=2**24):
+    """
+    same result as the cuda kernel: neighbors are sorted by distance, clouds smaller than nsample are padded with (first index of the cloud, 1e10).
+    input: xyz: (n, 3), new_xyz: (m, 3), offset: (b), new_offset: (b)
+    output: idx: (m, nsample), dist2: (m, nsample)
+    """
+    m = new_xyz.shape[0]
+    idx = torch.zeros((m, nsample), dtype=torch.int, device=xyz.device)
+    dist2 = torch.full((m, nsample), 1e10, dtype=xyz.dtype, device=xyz.device)
+    start, new_start = 0, 0
+    for end, new_end in zip(offset.tolist(), new_offset.tolist()):
+        seg_xyz = xyz[start:end]
+        k = min(nsample, end - start)
+        idx[new_start:new_end] = start
+        chunk = max(1, chunk_elements // max(end - start, 1))
+        for chunk_start in range(new_start, new_end, chunk):
+            chunk_end = min(chunk_start + chunk, new_end)
+            d = ((new_xyz[chunk_start:chunk_end, None, :] - seg_xyz[None, :, :])**2).sum(dim=-1)
+            chunk_dist2, chunk_idx = torch.topk(d, k, dim=1, largest=False, sorted=True)
+            idx[chunk_start:chunk_end, :k] = chunk_idx.int() + start
+            dist2[chunk_start:chunk_end, :k] = chunk_dist2
+        start, new_start = end, new_end
+    return idx, dist2
+
+
+def furthestsampling_gpu(xyz, offset, new_offset, n_max, m):
+    """
+    input: xyz: (n, 3), offset: (b), new_offset: (b), n_max: largest cloud size, m: new_offset[-1]
+    output: idx: (m)
+    """
+    n, b = xyz.shape[0], offset.shape[0]
+    idx = torch.cuda.IntTensor(m).zero_()
+    tmp = torch.cuda.FloatTensor(n).fill_(1e10)
+    pointops_cuda.furthestsampling_cuda(b, n_max, xyz, offset, new_offset, tmp, idx)
+    del tmp
+    return idx
+
+
+def knnquery_gpu(nsample, xyz, new_xyz, offset, new_offset):
+    """
+    input: xyz: (n, 3), new_xyz: (m, 3), offset: (b), new_offset: (b)
+    output: idx: (m, nsample), dist2: (m, nsample)
+    """
+    m = new_xyz.shape[0]
+    idx = torch.cuda.IntTensor(m, nsample).zero_()
+    dist2 = torch.cuda.FloatTensor(m, nsample).zero_()
+    pointops_cuda.knnquery_cuda(m, nsample, xyz, new_xyz, offset, new_offset, idx, dist2)
+    return idx, dist2
 
 
 class FurthestSampling(Function):
     @staticmethod
-    def forward(ctx, xyz, offset, new_offset):
+    def forward(ctx, xyz, offset, new_offset, n_max=None, m=None):
         """
         input: xyz: (n, 3), offset: (b), new_offset: (b)
+            n_max, m: optional host side ints, largest cloud size and new_offset[-1]. if given, no device to host copy is needed.
         output: idx: (m)
         """
         assert xyz.is_contiguous()
-        n, b, n_max = xyz.shape[0], offset.shape[0], offset[0]
-        for i in range(1, b):
-            n_max = max(offset[i] - offset[i-1], n_max)
-        idx = torch.cuda.IntTensor(new_offset[b-1].item()).zero_()
-        tmp = torch.cuda.FloatTensor(n).fill_(1e10)
-        pointops_cuda.furthestsampling_cuda(b, n_max, xyz, offset, new_offset, tmp, idx)
-        del tmp
-        return idx
-
-furthestsampling = FurthestSampling.apply
+        if not xyz.is_cuda:
+            return furthestsampling_cpu(xyz, offset, new_offset)
+        if n_max is None:
+            n_max = int(torch.diff(offset, prepend=offset.new_zeros(1)).max())
+        if m is None:
+            m = int(new_offset[-1])
+        return furthestsampling_gpu(xyz, offset, new_offset, n_max, m)
 
 
 class KNNQuery(Function):
@@ -36,13 +110,73 @@ class KNNQuery(Function):
         """
         if new_xyz is None: new_xyz = xyz
         assert xyz.is_contiguous() and new_xyz.is_contiguous()
-        m = new_xyz.shape[0]
-        idx = torch.cuda.IntTensor(m, nsample).zero_()
-        dist2 = torch.cuda.FloatTensor(m, nsample).zero_()
-        pointops_cuda.knnquery_cuda(m, nsample, xyz, new_xyz, offset, new_offset, idx, dist2)
+        if not xyz.is_cuda:
+            idx, dist2 = knnquery_cpu(nsample, xyz, new_xyz, offset, new_offset)
+        else:
+            idx, dist2 = knnquery_gpu(nsample, xyz, new_xyz, offset, new_offset)
         return idx, torch.sqrt(dist2)
 
-knnquery = KNNQuery.apply
+
+#furthestsampling and knnquery as torch custom ops(torch>=2.4), so torch.compile can trace through them.
+#they are not differentiable and the fake kernels give the output shapes without running them.
+if hasattr(torch.library, "custom_op"):
+    @torch.library.custom_op("pointops::furthestsampling", mutates_args=(), device_types="cpu")
+    def furthestsampling_op(xyz: torch.Tensor, offset: torch.Tensor, new_offset: torch.Tensor, n_max: int, m: int) -> torch.Tensor:
+        return furthestsampling_cpu(xyz, offset, new_offset)
+
+    @furthestsampling_op.register_kernel("cuda")
+    def _(xyz, offset, new_offset, n_max, m):
+        return furthestsampling_gpu(xyz, offset, new_offset, n_max, m)
+
+    @furthestsampling_op.register_fake
+    def _(xyz, offset, new_offset, n_max, m):
+        return xyz.new_empty((m,), dtype=torch.int)
+
+    @torch.library.custom_op("pointops::knnquery", mutates_args=(), device_types="cpu")
+    def knnquery_op(nsample: int, xyz: torch.Tensor, new_xyz: torch.Tensor, offset: torch.Tensor, new_offset: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        idx, dist2 = knnquery_cpu(nsample, xyz, new_xyz, offset, new_offset)
+        return idx, torch.sqrt(dist2)
+
+    @knnquery_op.register_kernel("cuda")
+    def _(nsample, xyz, new_xyz, offset, new_offset):
+        idx, dist2 = knnquery_gpu(nsample, xyz, new_xyz, offset, new_offset)
+        return idx, torch.sqrt(dist2)
+
+    @knnquery_op.register_fake
+    def _(nsample, xyz, new_xyz, offset, new_offset):
+        m = new_xyz.shape[0]
+        return new_xyz.new_empty((m, nsample), dtype=torch.int), new_xyz.new_empty((m, nsample))
+else:
+    furthestsampling_op = knnquery_op = None
+
+
+def furthestsampling(xyz, offset, new_offset, n_max=None, m=None):
+    """
+    input: xyz: (n, 3), offset: (b), new_offset: (b)
+        n_max, m: optional host side ints, largest cloud size and new_offset[-1]. if given, no device to host copy is needed.
+    output: idx: (m)
+    """
+    #the custom ops are for torch.compile, eager calls skip them(the first custom op call imports torch._dynamo, ~2s)
+    if furthestsampling_op is None or not torch.compiler.is_compiling():
+        return FurthestSampling.apply(xyz, offset, new_offset, n_max, m)
+    assert xyz.is_contiguous()
+    if n_max is None:
+        n_max = int(torch.diff(offset, prepend=offset.new_zeros(1)).max())
+    if m is None:
+        m = int(new_offset[-1])
+    return furthestsampling_op(xyz.detach(), offset, new_offset, n_max, m)
+
+
+def knnquery(nsample, xyz, new_xyz, offset, new_offset):
+    """
+    input: xyz: (n, 3), new_xyz: (m, 3), offset: (b), new_offset: (b)
+    output: idx: (m, nsample), dist: (m, nsample)
+    """
+    if knnquery_op is None or not torch.compiler.is_compiling():
+        return KNNQuery.apply(nsample, xyz, new_xyz, offset, new_offset)
+    if new_xyz is None: new_xyz = xyz
+    assert xyz.is_contiguous() and new_xyz.is_contiguous()
+    return knnquery_op(int(nsample), xyz.detach(), new_xyz.detach(), offset, new_offset)
 
 
 class Grouping(Function):
@@ -172,7 +306,7 @@ def interpolation(xyz, new_xyz, feat, offset, new_offset, k=3):
     norm = torch.sum(dist_recip, dim=1, keepdim=True)
     weight = dist_recip / norm # (n, 3)
 
-    new_feat = torch.cuda.FloatTensor(new_xyz.shape[0], feat.shape[1]).zero_()
+    new_feat = torch.zeros((new_xyz.shape[0], feat.shape[1]), dtype=feat.dtype, device=feat.device)
     for i in range(k):
         new_feat += feat[idx[:, i].long(), :] * weight[:, i].unsqueeze(-1)
     return new_feat
@@ -1,12 +1,13 @@
-import open3d as o3d
 import numpy as np
 import torch
 import os
-import matplotlib.pyplot as plt
-from sklearn.neighbors import KDTree
 import json
-from external_libs.pointops.functions import pointops
-import trimesh
+import contextlib
+import threading
+from lazy_import import lazy_import
+#imported on first use, see import_time_report.py
+o3d = lazy_import("open3d")
+pointops = lazy_import("external_libs.pointops.functions.pointops")
 
 def np_to_pcd(arr, color=[1,0,0]):
     arr = np.array(arr)
@@ -135,10 +136,43 @@ def resample_pcd(pcd_ls, n, method):
 def fps(xyz, npoint):
     if xyz.shape[0]<=npoint:
         raise "new fps error"
-    xyz = torch.from_numpy(np.array(xyz)).type(torch.float).cuda()
-    idx = pointops.furthestsampling(xyz, torch.tensor([xyz.shape[0]]).cuda().type(torch.int), torch.tensor([npoint]).cuda().type(torch.int)) 
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    xyz = torch.from_numpy(np.array(xyz)).type(torch.float).to(device)
+    idx = pointops.furthestsampling(xyz, torch.tensor([xyz.shape[0]], dtype=torch.int, device=device), torch.tensor([npoint], dtype=torch.int, device=device)) 
     return torch_to_numpy(idx).reshape(-1)
 
+def stack_point_tensors(tensor_ls):
+    """
+    input: tensor_ls => list of (channel, N_i) tensors
+    output:
+        if every N_i is the same => (B, channel, N), None
+        else => packed (1, channel, sum of N_i), offset (B) cumulative point counts
+    """
+    if all(tensor.shape == tensor_ls[0].shape for tensor in tensor_ls):
+        return torch.stack(tensor_ls), None
+    offset = torch.tensor([tensor.shape[-1] for tensor in tensor_ls], dtype=torch.int).cumsum(0).type(torch.int)
+    return torch.cat(tensor_ls, dim=-1).unsqueeze(0), offset
+
+def get_batch_item(batch_item, b_idx):
+    """
+    take the b_idx-th item out of a collated batch as a batch of size 1
+    """
+    item = {}
+    if batch_item.get("offset") is not None:
+        end = int(batch_item["offset"][b_idx])
+        start = int(batch_item["offset"][b_idx-1]) if b_idx > 0 else 0
+    for key, value in batch_item.items():
+        if key == "offset":
+            continue
+        if type(value) == torch.Tensor:
+            if batch_item.get("offset") is not None:
+                item[key] = value[:, ..., start:end]
+            else:
+                item[key] = value[b_idx:b_idx+1]
+        else:
+            item[key] = [value[b_idx]]
+    return item
+
 def print_3d(*data_3d_ls):
     data_3d_ls = [item for item in data_3d_ls]
     for idx, item in enumerate(data_3d_ls):
@@ -147,6 +181,9 @@ def print_3d(*data_3d_ls):
     o3d.visualization.draw_geometries(data_3d_ls, mesh_show_wireframe = True, mesh_show_back_face = True)
 
 def torch_to_numpy(cuda_arr):
+    if cuda_arr.dtype == torch.bfloat16:
+        #numpy has no bfloat16
+        cuda_arr = cuda_arr.float()
     return cuda_arr.cpu().detach().numpy()
 
 def save_np(arr, path):
@@ -187,6 +224,17 @@ def save_json(file_path, json_obj):
 
         json.dump(json_obj, json_file)
 
+@contextlib.contextmanager
+def atomic_path(file_path):
+    """yields a temporary path next to file_path, moved onto it when the block finishes. readers never see a partly written file"""
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 def read_txt(file_path):
     f = open(file_path, 'r')
     path_ls = []
@@ -232,6 +280,24 @@ def read_txt_obj_ls(path,
         mesh.vertices = o3d.utility.Vector3dVector(vertex_ls)
         mesh.triangles = o3d.utility.Vector3iVector(np.array(tri_ls)-1)
 
+    return prepare_jaw_mesh(mesh, jaw, ret_mesh, creating_color_mesh)
+
+def read_jaw_mesh(source, jaw, creating_color_mesh=False):
+    """
+    source: scan file path, or (vertices (n, 3), faces (m, 3)) arrays, eg: a mesh uploaded to inference_server(see mesh_protocol.py)
+    output: the mesh as read_txt_obj_ls(path, jaw, ret_mesh=True, use_tri_mesh=True) returns it
+    """
+    if type(source) == str:
+        return read_txt_obj_ls(source, jaw, ret_mesh=True, use_tri_mesh=True, creating_color_mesh=creating_color_mesh)[1]
+    vertices, faces = source
+    mesh = o3d.geometry.TriangleMesh()
+    #open3d copies the arrays and needs them writeable, decoded uploads are read only views of the message
+    mesh.vertices = o3d.utility.Vector3dVector(np.array(vertices, dtype=np.float64).reshape(-1, 3))
+    mesh.triangles = o3d.utility.Vector3iVector(np.array(faces, dtype=np.int32).reshape(-1, 3))
+    return prepare_jaw_mesh(mesh, jaw, True, creating_color_mesh)[1]
+
+def prepare_jaw_mesh(mesh, jaw, ret_mesh=False, creating_color_mesh=False):
+    """upper jaws are flipped to the lower jaw orientation and the vertex normals are computed. output: [(n, 6) vertices and normals](, mesh)"""
     if jaw == 'upper' and not creating_color_mesh:
         transformation_matrix = np.array([
             [-1, 0, 0, 0],
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(description='Cold start import time report of an entry point(python -X importtime)')
+parser.add_argument('--entry', default="inference_server", type=str, help = "module to import, eg: inference_server | inference_tgnet | start_inference")
+parser.add_argument('--statement', default=None, type=str, help = "python statements run after the import instead of nothing, eg: to time the pipeline construction")
+parser.add_argument('--top', default=15, type=int, help = "number of top level packages and modules shown.")
+parser.add_argument('--bundle_dir', default=None, type=str, help = "frozen bundle directory(eg: old/_internal). packages in the bundle that this run never imports are listed. heavy modules are imported on first use, so pass a --statement that processes a scan.")
+parser.add_argument('--save_path', default=None, type=str, help = "json report path.")
+
+def run_importtime(entry, statement):
+    code = f"import {entry}" + (f"\n{statement}" if statement else "")
+    #entry points like start_inference parse sys.argv on import
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import sys; sys.argv = sys.argv[:1]\n{code}"],
+                            cwd=os.getcwd(), capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append({
+            "name": name.strip(),
+            "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+        })
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1])
+    return rows
+
+def summarize(rows):
+    """self time grouped by top level package. the cumulative time of a module includes the modules it imported first."""
+    packages = {}
+    for row in rows:
+        package = row["name"].split(".")[0]
+        packages[package] = packages.get(package, 0) + row["self_ms"]
+    return {
+        "total_ms": sum(row["self_ms"] for row in rows),
+        "packages": sorted(packages.items(), key=lambda item: -item[1]),
+        "modules": sorted(rows, key=lambda row: -row["cumulative_ms"]),
+    }
+
+def get_unused_bundle_packages(bundle_dir, imported_packages):
+    bundle_packages = set()
+    for name in os.listdir(bundle_dir):
+        #dist infos, data directories and the packages of this repo
+        if name.endswith(".dist-info") or name.startswith("_") or os.path.exists(name):
+            continue
+        if os.path.isdir(os.path.join(bundle_dir, name)) or name.endswith((".py", ".pyd", ".so")):
+            bundle_packages.add(name.split(".")[0])
+    return sorted(bundle_packages - set(imported_packages))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    summary = summarize(run_importtime(args.entry, args.statement))
+    print(f"import {args.entry}: {summary['total_ms']:.0f}ms")
+    print(f"    {'package':<32}{'self(ms)':>10}")
+    for package, self_ms in summary["packages"][:args.top]:
+        print(f"    {package:<32}{self_ms:>10.0f}")
+    print(f"    {'module':<56}{'cumulative(ms)':>16}")
+    for row in summary["modules"][:args.top]:
+        print(f"    {'  '*row['depth'] + row['name']:<56}{row['cumulative_ms']:>16.0f}")
+
+    report = {"entry": args.entry, "statement": args.statement, "total_ms": summary["total_ms"], "packages": dict(summary["packages"])}
+    if args.bundle_dir is not None:
+        report["unused_bundle_packages"] = get_unused_bundle_packages(args.bundle_dir, report["packages"].keys())
+        print("bundle packages that this run never imports(candidates for the pyinstaller --exclude-module):")
+        print("    " + " ".join(report["unused_bundle_packages"]))
+
+    if args.save_path is not None:
+        os.makedirs(os.path.dirname(args.save_path) or ".", exist_ok=True)
+        with open(args.save_path, "w") as f:
+            json.dump(report, f, indent=4)
@@ -0,0 +1,167 @@
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import torch
+import torch.nn as nn
+from checkpointer import atomic_torch_save
+
+#fp32: as trained. int8: dynamic int8 quantization of the linear layers(cpu only). bf16: bf16 autocast.
+INFERENCE_PROFILES = ["fp32", "int8", "bf16"]
+
+#weights exported by export_inference_checkpoint, loaded memory mapped
+INFERENCE_CKPT_SUFFIX = ".inference.pt"
+
+#(linear, batch norm) attribute pairs outside of nn.Sequential, the batch norm normalizes the output channels of the linear layer.
+LINEAR_BN_ATTR_PAIRS = {
+    "PointTransformerBlock": [("linear1", "bn1"), ("linear3", "bn3")],
+    "TransitionDown": [("linear", "bn")],
+}
+
+def fold_linear_bn(linear, bn):
+    """
+    eval mode batch norm after a linear layer is a per channel affine transform, so it can be merged into the linear weights.
+    output: nn.Linear that computes bn(linear(x))
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) if bn.affine else 1 / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias if bn.affine else torch.zeros_like(bn.running_mean)
+    bias = linear.bias if linear.bias is not None else torch.zeros_like(bn.running_mean)
+    folded = nn.Linear(linear.in_features, linear.out_features, bias=True).to(linear.weight.device)
+    with torch.no_grad():
+        folded.weight.copy_(linear.weight * scale.unsqueeze(1))
+        folded.bias.copy_((bias - bn.running_mean) * scale + shift)
+    return folded
+
+def fold_batchnorm(module):
+    """
+    folds every batch norm that directly follows a linear layer(inside nn.Sequential, or the pairs in LINEAR_BN_ATTR_PAIRS) and replaces it with nn.Identity.
+    the module has to be in eval mode. the indexes of nn.Sequential are kept, the point transformer layers address their batch norms by index.
+    output: number of folded batch norms
+    """
+    count = 0
+    for m in list(module.modules()):
+        if isinstance(m, nn.Sequential):
+            for i in range(1, len(m)):
+                if isinstance(m[i-1], nn.Linear) and isinstance(m[i], nn.BatchNorm1d):
+                    m[i-1] = fold_linear_bn(m[i-1], m[i])
+                    m[i] = nn.Identity()
+                    count += 1
+        for linear_name, bn_name in LINEAR_BN_ATTR_PAIRS.get(type(m).__name__, []):
+            linear, bn = getattr(m, linear_name), getattr(m, bn_name)
+            if isinstance(linear, nn.Linear) and isinstance(bn, nn.BatchNorm1d):
+                setattr(m, linear_name, fold_linear_bn(linear, bn))
+                setattr(m, bn_name, nn.Identity())
+                count += 1
+    return count
+
+def strip_training_modules(module):
+    """the contrast loss(criterion) of the point transformers is only used in training"""
+    for m in module.modules():
+        if hasattr(m, "criterion") and isinstance(m.criterion, nn.Module):
+            m.criterion = nn.Identity()
+
+def get_inference_state_dict(state_dict):
+    """drops the weights of the training only modules(criterion, contrast head)"""
+    return {key: value for key, value in state_dict.items() if "criterion." not in key}
+
+def export_inference_checkpoint(make_module, ckpt_path, save_path, fold_bn=True):
+    """
+    saves the weights that the inference uses, contiguous and without shared storages, so load_inference_weights can memory map them.
+    fold_bn: the batch norms are folded before saving, so the loaded linear weights are used as they are mapped.
+    output: number of saved tensors
+    """
+    module = make_module()
+    strip_training_modules(module)
+    module.load_state_dict(get_inference_state_dict(torch.load(ckpt_path, map_location="cpu")))
+    module.eval()
+    if fold_bn:
+        fold_batchnorm(module)
+    state_dict = {key: value.detach().contiguous().clone() for key, value in module.state_dict().items()}
+    atomic_torch_save({"state_dict": state_dict, "bn_folded": fold_bn}, save_path)
+    return len(state_dict)
+
+def load_inference_weights(module, ckpt_path):
+    """
+    .inference.pt: the tensors are memory mapped and assigned to the module without a copy. the pages are read lazily and shared by the processes that load the same file.
+        this holds for the cpu fp32 and bf16 profiles only: prepare_module copies the weights to the gpu memory for cuda(.to(device)), and into new quantized tensors for int8.
+    others(.h5): torch.load of the training state dict, the weights of the training only modules are dropped.
+    the training only modules of the module have to be stripped before.
+    """
+    if ckpt_path.endswith(INFERENCE_CKPT_SUFFIX):
+        checkpoint = torch.load(ckpt_path, map_location="cpu", mmap=True, weights_only=True)
+        if checkpoint["bn_folded"]:
+            #same module structure as the exported one, the folded weights are loaded below
+            module.eval()
+            fold_batchnorm(module)
+        module.load_state_dict(checkpoint["state_dict"], assign=True)
+    else:
+        module.load_state_dict(get_inference_state_dict(torch.load(ckpt_path, map_location="cpu")))
+    return module
+
+def prepare_module(module, profile, device):
+    """
+    inference preparation: eval mode, batch norm folding, and int8 dynamic quantization of the linear layers for the int8 profile.
+    the bf16 profile keeps fp32 weights, the forward has to run under inference_autocast.
+    """
+    if profile not in INFERENCE_PROFILES:
+        raise "inference profile is something unknown"
+    if profile == "int8" and torch.device(device).type != "cpu":
+        raise "int8 profile is cpu only"
+    module = module.to(device).eval()
+    strip_training_modules(module)
+    fold_batchnorm(module)
+    if profile == "int8":
+        module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+    return module
+
+def inference_autocast(profile, device):
+    if profile == "bf16":
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+def get_prepared_cache_path(cache_dir, ckpt_path, model_parameter, profile, device):
+    """the cache file changes with the checkpoint file, the model parameters, the profile, the device type and the torch version"""
+    stat = os.stat(ckpt_path)
+    key = json.dumps(["state_dict", os.path.abspath(ckpt_path), stat.st_size, stat.st_mtime_ns, model_parameter, profile, torch.device(device).type, torch.__version__], sort_keys=True, default=str)
+    name = os.path.basename(ckpt_path).split(".")[0]
+    return os.path.join(cache_dir, f"{name}_{profile}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.pt")
+
+def load_prepared_module(make_module, ckpt_path, model_parameter, profile="fp32", device="cuda", cache_dir=None):
+    """
+    Args:
+        make_module: function that builds the module before the checkpoint is loaded
+        model_parameter: used for the cache key
+        cache_dir: the state dicts of the prepared modules are saved here and reused by later runs. None disables the cache.
+    Returns:
+        prepared module in eval mode
+    """
+    cache_path = None
+    #the mapped weights of an inference export are used as they are on cpu, a cached copy would not share their pages
+    keeps_mapping = ckpt_path.endswith(INFERENCE_CKPT_SUFFIX) and torch.device(device).type == "cpu" and profile != "int8"
+    if cache_dir is not None and not keeps_mapping:
+        cache_path = get_prepared_cache_path(cache_dir, ckpt_path, model_parameter, profile, device)
+        if os.path.exists(cache_path):
+            try:
+                return load_prepared_state_dict(make_module, cache_path, profile, device)
+            except (OSError, RuntimeError, KeyError, pickle.UnpicklingError) as e:
+                print(f"prepared module cache {cache_path} is not usable, preparing again: {str(e).splitlines()[0]}")
+
+    module = make_module()
+    strip_training_modules(module)
+    load_inference_weights(module, ckpt_path)
+    module = prepare_module(module, profile, device)
+
+    if cache_path is not None:
+        atomic_torch_save(module.state_dict(), cache_path)
+    return module
+
+def load_prepared_state_dict(make_module, cache_path, profile, device):
+    """
+    the cache holds tensors only(weights_only load, no pickled code). the folded and quantized structure is rebuilt by preparing a new module, then the cached weights replace its initial ones.
+    """
+    module = make_module()
+    strip_training_modules(module)
+    module = prepare_module(module, profile, device)
+    module.load_state_dict(torch.load(cache_path, map_location=device, weights_only=True))
+    return module
@@ -1,8 +1,97 @@
-from models.modules.tsegnet import TSegNetModule
 import torch
-def make_inference_pipeline(model_name, ckpt_path_ls):
-    from inference_pipelines.inference_pipeline_tsegnet import InferencePipeLine
+
+#speed/accuracy presets of the tgnet pipeline, any of them can be chosen per scan(InferencePipeLine.__call__). accurate is the original setting.
+#    num_of_points: points sampled for the first module. meshes with fewer vertices are subdivided first.
+#    crop_sample_size: points of each tooth crop of the second stage(both modules)
+#    boundary_sampling_info: points of the boundary module. a point is a boundary point if less than bdl_ratio of its num_of_neighbors nearest first module points share its label.
+#crop_sample_size and num_of_neighbors scale with num_of_points, so the crops and the boundary neighborhoods cover the same area as in training.
+TGNET_PRESETS = {
+    "accurate": {
+        "num_of_points": 24000,
+        "crop_sample_size": 3072,
+        "boundary_sampling_info": {"bdl_ratio": 0.7, "num_of_neighbors": 40, "num_of_bdl_points": 20000, "num_of_all_points": 24000},
+    },
+    "balanced": {
+        "num_of_points": 16000,
+        "crop_sample_size": 2048,
+        "boundary_sampling_info": {"bdl_ratio": 0.7, "num_of_neighbors": 27, "num_of_bdl_points": 13333, "num_of_all_points": 16000},
+    },
+    "fast": {
+        "num_of_points": 12000,
+        "crop_sample_size": 1536,
+        "boundary_sampling_info": {"bdl_ratio": 0.7, "num_of_neighbors": 20, "num_of_bdl_points": 10000, "num_of_all_points": 12000},
+    },
+}
+
+def get_tgnet_inference_config(ckpt_path_ls, inference_chunk_size=None, device="cuda", inference_profile="fp32", prepared_cache_dir=None, preset="accurate", early_exit_threshold=None, micro_batch=None, log_boundary_score=False):
+    """
+    ckpt_path_ls: [fps model checkpoint, boundary model checkpoint], training checkpoints(.h5) or inference exports(.inference.pt, see export_inference_ckpt.py)
+    preset: default preset of the scans that do not choose one, see TGNET_PRESETS
+    early_exit_threshold: the boundary module is skipped for scans with a boundary score(ratio of the first module points with mixed neighborhoods) below this. None always runs it.
+    log_boundary_score: also computes the boundary score(tens of ms per scan) without a threshold, to choose one. the score is in the stage timing of each scan.
+    micro_batch: {"max_batch": 4, "max_wait_ms": 10}, the first module forwards of scans that run at the same time(threads sharing the pipeline) are batched, see micro_batcher.py. None runs each scan alone.
+    """
+    if preset not in TGNET_PRESETS:
+        raise ValueError(f"unknown preset {preset}, one of {list(TGNET_PRESETS.keys())}")
+    return {
+        "fps_model_info":{
+            "model_parameter" :{
+                "input_feat": 6,
+                "stride": [1, 4, 4, 4, 4],
+                "nstride": [2, 2, 2, 2],
+                "nsample": [36, 24, 24, 24, 24],
+                "blocks": [2, 3, 4, 6, 3],
+                "block_num": 5,
+                "planes": [32, 64, 128, 256, 512],
+                "crop_sample_size": 3072,
+                "inference_chunk_size": inference_chunk_size,
+            },
+            "load_ckpt_path": ckpt_path_ls[0]
+        },
+
+        "boundary_model_info":{
+            "model_parameter":{
+                "input_feat": 6,
+                "stride": [1, 1],
+                "nsample": [36, 24],
+                "blocks": [2, 3],
+                "block_num": 2,
+                "planes": [16, 32],
+                "crop_sample_size": 3072,
+                "inference_chunk_size": inference_chunk_size,
+            },
+            "load_ckpt_path": ckpt_path_ls[1]
+        },
+
+        "presets": TGNET_PRESETS,
+        "preset": preset,
+        "early_exit_threshold": early_exit_threshold,
+        "log_boundary_score": log_boundary_score,
+        "micro_batch": micro_batch,
+        "device": device,
+        "inference_profile": inference_profile,
+        "prepared_cache_dir": prepared_cache_dir,
+        "stage_timing": True,
+        #synchronizes cuda around each timed stage for exact stage times and cuda peaks, profiling of single requests only(see stage_timer.py)
+        "stage_timing_cuda_sync": False,
+    }
+
+def make_inference_pipeline(model_name, ckpt_path_ls, inference_chunk_size=None, device="cuda", inference_profile="fp32", prepared_cache_dir=None, preset="accurate", early_exit_threshold=None, micro_batch=None, log_boundary_score=False):
+    """
+    tgnet only options
+        inference_chunk_size: the point transformer layers attend this many points at a time(same outputs, bounded memory). None processes all points at once.
+        device: cuda | cpu
+        inference_profile: fp32 | int8(cpu only) | bf16, see inference_optimizer.py
+        prepared_cache_dir: the prepared(batch norm folded, quantized) modules are cached here. None disables the cache.
+        preset: accurate | balanced | fast, default preset of the scans, see TGNET_PRESETS
+        early_exit_threshold: boundary score below which the boundary module is skipped, None always runs it. see get_tgnet_inference_config
+        micro_batch: batching of the first module forward across concurrent scans, None disables it. see get_tgnet_inference_config
+        log_boundary_score: boundary score of every scan without a threshold, see get_tgnet_inference_config
+    """
+    #only the modules of the selected model are imported
     if model_name=="tsegnet":
+        from inference_pipelines.inference_pipeline_tsegnet import InferencePipeLine
+        from models.modules.tsegnet import TSegNetModule
         inference_config = {
             "model_info":{
                 "model_parameter" :{
@@ -25,40 +114,7 @@ def make_inference_pipeline(model_name, ckpt_path_ls):
         return InferencePipeLine(module)
     elif model_name=="tgnet":
         from inference_pipelines.inference_pipeline_tgn import InferencePipeLine
-        inference_config = {
-            "fps_model_info":{
-                "model_parameter" :{
-                    "input_feat": 6,
-                    "stride": [1, 4, 4, 4, 4],
-                    "nstride": [2, 2, 2, 2],
-                    "nsample": [36, 24, 24, 24, 24],
-                    "blocks": [2, 3, 4, 6, 3],
-                    "block_num": 5,
-                    "planes": [32, 64, 128, 256, 512],
-                    "crop_sample_size": 3072,
-                },
-                "load_ckpt_path": ckpt_path_ls[0]
-            },
-
-            "boundary_model_info":{
-                "model_parameter":{
-                    "input_feat": 6,
-                    "stride": [1, 1],
-                    "nsample": [36, 24],
-                    "blocks": [2, 3],
-                    "block_num": 2,
-                    "planes": [16, 32],
-                    "crop_sample_size": 3072,
-                },
-                "load_ckpt_path": ckpt_path_ls[1]
-            },
-
-            "boundary_sampling_info":{
-                "bdl_ratio": 0.7,
-                "num_of_bdl_points": 20000,
-                "num_of_all_points": 24000,
-            },
-        }
+        inference_config = get_tgnet_inference_config(ckpt_path_ls, inference_chunk_size, device, inference_profile, prepared_cache_dir, preset, early_exit_threshold, micro_batch, log_boundary_score)
         return InferencePipeLine(inference_config)
     elif model_name=="pointnet":
         from inference_pipelines.inference_pipeline_sem import InferencePipeLine
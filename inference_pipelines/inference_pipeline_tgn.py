@@ -1,143 +1,253 @@
+import contextlib
+import threading
+import time
 import gen_utils as gu
 import numpy as np
 from models.modules.grouping_network_module import GroupingNetworkModule
 import torch
 import ops_utils as tu
-from sklearn.neighbors import KDTree
-from sklearn.decomposition import PCA
-import open3d as o3d
+import inference_optimizer as iopt
+from stage_timer import StageTimer
+from micro_batcher import MicroBatcher
+from lazy_import import lazy_import
+#imported on first use(the first scan), see import_time_report.py
+KDTree = lazy_import("sklearn.neighbors", "KDTree")
+PCA = lazy_import("sklearn.decomposition", "PCA")
+o3d = lazy_import("open3d")
 
 class InferencePipeLine:
     def __init__(self, config):
         self.scaler = 1.8
         self.shifter = 0.8
         self.config = config
-        
-        self.first_module = GroupingNetworkModule(self.config["fps_model_info"])
-        self.first_module.cuda()
-        self.first_module.load_state_dict(torch.load(self.config["fps_model_info"]["load_ckpt_path"]))
+        self.device = torch.device(self.config.get("device", "cuda"))
+        #fp32 | int8 | bf16, see inference_optimizer.py
+        self.inference_profile = self.config.get("inference_profile", "fp32")
+        #per stage wall/cpu time and memory of each scan, returned as result["stage_timing"]
+        self.stage_timing = self.config.get("stage_timing", True)
+        self.stage_timing_cuda_sync = self.config.get("stage_timing_cuda_sync", False)
+        #the boundary module is skipped for scans whose boundary score is below this, None always runs it
+        self.early_exit_threshold = self.config.get("early_exit_threshold")
+        #the boundary score is only computed for the early exit, or to log it
+        self.log_boundary_score = self.config.get("log_boundary_score", False)
+        #how often each path was taken, see get_early_exit_stats
+        self.early_exit_stats = {"full": 0, "early_exit": 0, "full_boundary_ms": 0.0}
+        self.early_exit_lock = threading.Lock()
+
+        self.first_module = self.load_module(self.config["fps_model_info"])
+        self.bdl_module = self.load_module(self.config["boundary_model_info"])
+        #first module forwards of concurrent scans run as one batch, see get_tgnet_inference_config. None runs each scan alone.
+        micro_batch = self.config.get("micro_batch")
+        self.first_batcher = MicroBatcher(self.run_first_forward_batch, **micro_batch) if micro_batch is not None else None
+
+    def load_module(self, model_info):
+        return iopt.load_prepared_module(
+            lambda: GroupingNetworkModule(model_info),
+            model_info["load_ckpt_path"],
+            model_info["model_parameter"],
+            self.inference_profile,
+            self.device,
+            self.config.get("prepared_cache_dir"),
+        )
 
-        self.bdl_module = GroupingNetworkModule(self.config["boundary_model_info"])
-        self.bdl_module.cuda()
-        self.bdl_module.load_state_dict(torch.load(self.config["boundary_model_info"]["load_ckpt_path"]))
+    def get_preset_info(self, preset=None):
+        """settings of a preset name(see TGNET_PRESETS in inference_pipeline_maker.py), None is the default preset of the config"""
+        preset = self.config.get("preset", "accurate") if preset is None else preset
+        if preset not in self.config["presets"]:
+            raise ValueError(f"unknown preset {preset}, one of {list(self.config['presets'].keys())}")
+        return self.config["presets"][preset]
 
-    def __call__(self, stl_path, jaw):
+    def __call__(self, stl_path, jaw, preset=None, keep_context=False):
+        """
+        stl_path: scan file path, or (vertices, faces) arrays of an uploaded mesh
+        keep_context: the result has a "context" for the incremental re-segmentation of user edits, see resegment
+        """
+        #the batch window is only waited while other scans are in the pipeline
+        with self.first_batcher.track() if self.first_batcher is not None else contextlib.nullcontext():
+            return self.infer(stl_path, jaw, preset, keep_context)
+
+    def infer(self, stl_path, jaw, preset=None, keep_context=False):
+        #the stages can also run in different workers, see staged_runner.py and start_inference.py
+        state = self.load_scan(stl_path, jaw, preset)
+        state["keep_context"] = keep_context
+        self.run_first_forward(state)
+        self.select_boundary(state)
+        self.run_boundary_forward(state)
+        return self.merge_labels(state)
+
+    def load_scan(self, stl_path, jaw, preset=None):
+        """cpu stage: mesh load, normalization and sampling. returns the state of the scan, passed through the next stages"""
+        preset_info = self.get_preset_info(preset)
+        #the pipeline object is shared by the threads of inference_tgnet, so the timer is per call
+        timer = StageTimer(self.device, enabled=self.stage_timing, cuda_sync=self.stage_timing_cuda_sync)
+        with timer.measure("mesh_load"):
+            #vertex normals are computed here
+            mesh = gu.read_jaw_mesh(stl_path, jaw) #TODO slow processing speed
+        with timer.measure("dedup"):
+            mesh = mesh.remove_duplicated_vertices()
+        with timer.measure("normalize"):
+            vertices = np.array(mesh.vertices)
+            n_vertices = vertices.shape[0]
+            vertices[:,:3] -= np.mean(vertices[:,:3], axis=0)
+            vertices[:, :3] = ((vertices[:, :3]-np.min(vertices[:,1]))/(np.max(vertices[:,1])- np.min(vertices[:,1])))*self.scaler-self.shifter
+            mesh.vertices = o3d.utility.Vector3dVector(vertices)
+            org_feats = np.array(np.concatenate([np.array(mesh.vertices), np.array(mesh.vertex_normals)], axis=1))
+
+        with timer.measure("subdivide"):
+            if np.asarray(mesh.vertices).shape[0] < preset_info["num_of_points"]:
+                mesh = mesh.subdivide_midpoint(number_of_iterations=1)
+                bdl_feats = np.array(np.concatenate([np.array(mesh.vertices), np.array(mesh.vertex_normals)], axis=1))
+            else:
+                bdl_feats = org_feats.copy()
+                
+            vertices = np.array(np.concatenate([np.array(mesh.vertices), np.array(mesh.vertex_normals)], axis=1))
+
+        with timer.measure("fps"):
+            sampled_feats = gu.resample_pcd([vertices.copy()], preset_info["num_of_points"], "fps")[0] #TODO slow processing speed
+
+        input_cuda_feats = torch.from_numpy(np.array([sampled_feats.astype('float32')])).to(self.device).permute(0,2,1)
+        return {
+            "timer": timer,
+            "preset_info": preset_info,
+            "n_vertices": n_vertices,
+            "org_feats": org_feats,
+            "bdl_feats": bdl_feats,
+            "sampled_feats": sampled_feats,
+            "input_cuda_feats": input_cuda_feats,
+        }
+
+    def run_first_forward(self, state):
+        """model stage"""
+        state["first_output"] = self.forward_first_module(state["input_cuda_feats"], self.first_module, state["timer"], state["preset_info"]["crop_sample_size"])
+
+    def select_boundary(self, state):
+        """cpu stage: clustering of the first module output, boundary score and boundary point selection"""
+        timer, preset_info, sampled_feats = state["timer"], state["preset_info"], state["sampled_feats"]
+        first_results = self.get_first_module_results(state["input_cuda_feats"], self.first_module, timer, preset_info["crop_sample_size"], state.pop("first_output"))
+        state["first_results"] = first_results
+
+        boundary_score = None
+        if self.early_exit_threshold is not None or self.log_boundary_score:
+            with timer.measure("boundary_score"):
+                boundary_score = get_boundary_score(first_results["ins"]["full_ins_labeled_points"][:,3], sampled_feats[:,:3], preset_info["boundary_sampling_info"])
+        early_exit = self.early_exit_threshold is not None and boundary_score < self.early_exit_threshold
+        state.update({"boundary_score": boundary_score, "early_exit": early_exit, "boundary_ms": 0.0})
+
+        if not early_exit:
+            boundary_start = time.perf_counter()
+            with timer.measure("boundary_selection"):
+                sampled_boundary_feats, sampled_boundary_seg_label, only_boundary_feats, only_boundary_seg_label = self.get_boundary_sampled_feats(
+                    first_results["ins"]["full_ins_labeled_points"][:,3], 
+                    state["bdl_feats"], 
+                    sampled_feats,
+                    None,
+                    preset_info["boundary_sampling_info"],
+                )
+
+            state["input_cuda_bdl_feats"] = torch.from_numpy(np.array([sampled_boundary_feats.astype('float32')])).permute(0,2,1).to(self.device)
+            state["sampled_boundary_seg_label"] = torch.from_numpy(np.array([sampled_boundary_seg_label.astype(int)])).permute(0,2,1).to(self.device) - 1
+            state["num_of_only_boundary_points"] = only_boundary_feats.shape[0]
+            state["sampled_boundary_feats"] = sampled_boundary_feats
+            state["boundary_ms"] += (time.perf_counter() - boundary_start) * 1000
+
+    def run_boundary_forward(self, state):
+        """model stage, skipped on an early exit"""
+        if state["early_exit"]:
+            return
+        boundary_start = time.perf_counter()
+        state["bdl_output"] = self.forward_second_module(state["input_cuda_bdl_feats"], state["sampled_boundary_seg_label"], self.bdl_module, state["timer"], state["preset_info"]["crop_sample_size"])
+        state["boundary_ms"] += (time.perf_counter() - boundary_start) * 1000
+
+    def merge_labels(self, state):
+        """cpu stage: kmeans of the boundary module output, label merge and transfer to the vertices. returns the result of the scan"""
         DEBUG=False
-        _, mesh = gu.read_txt_obj_ls(stl_path, jaw, ret_mesh=True, use_tri_mesh=True) #TODO slow processing speed
-        mesh = mesh.remove_duplicated_vertices()
-        vertices = np.array(mesh.vertices)
-        n_vertices = vertices.shape[0]
-        vertices[:,:3] -= np.mean(vertices[:,:3], axis=0)
-        vertices[:, :3] = ((vertices[:, :3]-np.min(vertices[:,1]))/(np.max(vertices[:,1])- np.min(vertices[:,1])))*self.scaler-self.shifter
-        mesh.vertices = o3d.utility.Vector3dVector(vertices)
-        org_feats = np.array(np.concatenate([np.array(mesh.vertices), np.array(mesh.vertex_normals)], axis=1))
-
-        if np.asarray(mesh.vertices).shape[0] < 24000:
-            mesh = mesh.subdivide_midpoint(number_of_iterations=1)
-            bdl_feats = np.array(np.concatenate([np.array(mesh.vertices), np.array(mesh.vertex_normals)], axis=1))
-        else:
-            bdl_feats = org_feats.copy()
+        timer, first_results, early_exit, org_feats = state["timer"], state["first_results"], state["early_exit"], state["org_feats"]
+        if not early_exit:
+            boundary_start = time.perf_counter()
+            bdl_results = self.get_second_module_results(state["input_cuda_bdl_feats"], state["sampled_boundary_seg_label"], self.bdl_module, timer, state["preset_info"]["crop_sample_size"], state.pop("bdl_output"))
+            state["boundary_ms"] += (time.perf_counter() - boundary_start) * 1000
             
-        vertices = np.array(np.concatenate([np.array(mesh.vertices), np.array(mesh.vertex_normals)], axis=1))
-
-        sampled_feats = gu.resample_pcd([vertices.copy()], 24000, "fps")[0] #TODO slow processing speed
-
-        input_cuda_feats = torch.from_numpy(np.array([sampled_feats.astype('float32')])).cuda().permute(0,2,1)
-        first_results = self.get_first_module_results(input_cuda_feats, self.first_module)
-
-        sampled_boundary_feats, sampled_boundary_seg_label, only_boundary_feats, only_boundary_seg_label = self.get_boundary_sampled_feats(
-            first_results["ins"]["full_ins_labeled_points"][:,3], 
-            bdl_feats, 
-            sampled_feats,
-            None
-        )
-
-        input_cuda_bdl_feats = torch.from_numpy(np.array([sampled_boundary_feats.astype('float32')])).permute(0,2,1).cuda()
-        sampled_boundary_seg_label = torch.from_numpy(np.array([sampled_boundary_seg_label.astype(int)])).permute(0,2,1).cuda() - 1
-        bdl_results = self.get_second_module_results(input_cuda_bdl_feats, sampled_boundary_seg_label, self.bdl_module)
+            if DEBUG: gu.print_3d(gu.np_to_pcd_with_label(first_results["ins"]["full_ins_labeled_points"]), gu.np_to_pcd_with_label(bdl_results["ins"]["full_ins_labeled_points"]))
+        boundary_ms = state["boundary_ms"]
+        self.record_early_exit(early_exit, boundary_ms)
+        timer.annotate("early_exit", {"boundary_score": state["boundary_score"], "threshold": self.early_exit_threshold, "skipped": early_exit, "boundary_ms": boundary_ms})
+
+        with timer.measure("label_merge"):
+            first_xyz = first_results["ins"]["full_ins_labeled_points"][:,:3]
+            first_ps_label = first_results["ins"]["full_ins_labeled_points"][:,3].astype(int)
+            first_sem_xyz = first_results["sem_1"]["full_labeled_points"][:,:3]
+            first_sem_label = first_results["sem_1"]["full_labeled_points"][:,3]
+            if early_exit:
+                #only the first module labels are transferred
+                bdl_xyz = np.zeros((0, 3))
+                bdl_ps_label = np.zeros(0, dtype=int)
+            else:
+                bdl_xyz = bdl_results["ins"]["full_ins_labeled_points"][:state["num_of_only_boundary_points"],:3]
+                bdl_ps_label = bdl_results["ins"]["full_ins_labeled_points"][:state["num_of_only_boundary_points"],3].astype(int)
+
+            gin_mean = np.mean(first_xyz[first_ps_label==0],axis=0).reshape(1,3)
+            teeth_mean = np.mean(first_xyz[first_ps_label!=0],axis=0).reshape(1,3)
         
-        if DEBUG: gu.print_3d(gu.np_to_pcd_with_label(first_results["ins"]["full_ins_labeled_points"]), gu.np_to_pcd_with_label(bdl_results["ins"]["full_ins_labeled_points"]))
 
-        first_xyz = first_results["ins"]["full_ins_labeled_points"][:,:3]
-        first_ps_label = first_results["ins"]["full_ins_labeled_points"][:,3].astype(int)
-        first_sem_xyz = first_results["sem_1"]["full_labeled_points"][:,:3]
-        first_sem_label = first_results["sem_1"]["full_labeled_points"][:,3]
-        bdl_xyz = bdl_results["ins"]["full_ins_labeled_points"][:only_boundary_feats.shape[0],:3]
-        bdl_ps_label = bdl_results["ins"]["full_ins_labeled_points"][:only_boundary_feats.shape[0],3].astype(int)
+            #instance x semantic label counts and instance centers, one pass over the points
+            ins_ids, ins_inverse, ins_sem_histogram = get_label_histogram(first_ps_label, first_sem_label.astype(int))
+            ins_counts = ins_sem_histogram.sum(axis=1)
+            ins_centers = np.stack([np.bincount(ins_inverse, weights=first_xyz[:,axis], minlength=ins_ids.shape[0]) for axis in range(3)], axis=1) / ins_counts[:,None]
+            ins_label_center_points = ins_centers[ins_ids!=0]
+            pca = PCA(n_components=3); pca.fit(ins_label_center_points); pca_axis = pca.components_
+            pca_axis[2] = pca_axis[2] if np.dot((teeth_mean - gin_mean).reshape(3), pca_axis[2])>0 else -pca_axis[2]
+
+            if np.where(first_sem_label==1)[0].shape[0] + np.where(first_sem_label==9)[0].shape[0] > 20:
+                centerpoints_of_11_12 = np.array(np.mean([np.mean(first_sem_xyz[first_sem_label==1],axis = 0), np.mean(first_sem_xyz[first_sem_label==9], axis=0)], axis=0))
+            else:
+                for i in range(2,9):
+                    if np.where(first_sem_label==i)[0].shape[0]>20:
+                        centerpoints_of_11_12 = np.array(np.mean([np.mean(first_sem_xyz[first_sem_label==i],axis = 0), np.mean(ins_label_center_points, axis=0)], axis=0))
+                        break
 
-        gin_mean = np.mean(first_xyz[first_ps_label==0],axis=0).reshape(1,3)
-        teeth_mean = np.mean(first_xyz[first_ps_label!=0],axis=0).reshape(1,3)
-        
-
-        first_ps_label_unique_except_zero = np.unique(first_ps_label); first_ps_label_unique_except_zero =first_ps_label_unique_except_zero[first_ps_label_unique_except_zero!=0]
-        ins_label_center_points = np.array([np.mean(first_xyz[first_ps_label==label],axis=0) for label in first_ps_label_unique_except_zero])
-        pca = PCA(n_components=3); pca.fit(ins_label_center_points); pca_axis = pca.components_
-        pca_axis[2] = pca_axis[2] if np.dot((teeth_mean - gin_mean).reshape(3), pca_axis[2])>0 else -pca_axis[2]
-
-        if np.where(first_sem_label==1)[0].shape[0] + np.where(first_sem_label==9)[0].shape[0] > 20:
-            centerpoints_of_11_12 = np.array(np.mean([np.mean(first_sem_xyz[first_sem_label==1],axis = 0), np.mean(first_sem_xyz[first_sem_label==9], axis=0)], axis=0))
-        else:
-            for i in range(2,9):
-                if np.where(first_sem_label==i)[0].shape[0]>20:
-                    centerpoints_of_11_12 = np.array(np.mean([np.mean(first_sem_xyz[first_sem_label==i],axis = 0), np.mean(ins_label_center_points, axis=0)], axis=0))
-                    break
-
-            
-        center_line = centerpoints_of_11_12 - np.mean(ins_label_center_points,axis=0)
-        checking_axis_vector = np.cross(pca_axis[2], center_line)
-        new_sem_labels = np.zeros(first_ps_label.shape[0])
-        for ins_label in np.unique(first_ps_label): 
-            if ins_label==0:
-                continue
-            ins_cluster_mask = first_ps_label == ins_label
-            ins_points_center = first_xyz[ins_cluster_mask].mean(axis=0)
-            sem_labels_in_cluster = first_sem_label[ins_cluster_mask]
-            sem_labels_in_cluster = sem_labels_in_cluster[sem_labels_in_cluster!=0]
-            if(sem_labels_in_cluster.shape[0]==0):
-                new_sem_labels[ins_cluster_mask] = 0
-                first_ps_label[ins_cluster_mask] = 0
-                continue
-            max_freq_first_cluster_label = np.argmax(np.bincount(sem_labels_in_cluster.astype(int)))
-            if max_freq_first_cluster_label not in [1, 9]:
-                if(np.dot(ins_points_center-centerpoints_of_11_12, checking_axis_vector)<0): max_freq_first_cluster_label = max_freq_first_cluster_label + 8
-            new_sem_labels[ins_cluster_mask] = max_freq_first_cluster_label
-        new_sem_labels = new_sem_labels.astype(int)
-
-        #================boundary part ===========================#
-        tree = KDTree(first_xyz, leaf_size=2)
-        mod_bdl_ps_label = np.zeros((bdl_ps_label.shape[0]))
-        mod_bdl_sem_label = np.zeros((bdl_ps_label.shape[0]))
-        for bdl_cluster_label in np.unique(bdl_ps_label):
-            if bdl_cluster_label==0:
-                continue
-            bdl_cluster_points = bdl_xyz[bdl_cluster_label == bdl_ps_label]
-            cluster_near_points = tree.query(bdl_cluster_points, k=1, return_distance=False)
-
-            cluster_first_cluster_label = first_ps_label[cluster_near_points.reshape(-1)]
-            max_freq_first_cluster_label = np.argmax(np.bincount(cluster_first_cluster_label))
             
-            ins_cluster_mask = first_ps_label == max_freq_first_cluster_label
-            sem_labels = new_sem_labels[ins_cluster_mask]
-            if np.unique(sem_labels).shape[0] != 1:
-                raise "sem label error"
-            sem_label = sem_labels[0]
-            
-            mod_bdl_ps_label[bdl_cluster_label == bdl_ps_label] = max_freq_first_cluster_label
-            mod_bdl_sem_label[bdl_cluster_label == bdl_ps_label] = sem_label
-
-        final_ins_points = np.concatenate([first_xyz, bdl_xyz], axis=0)
-        mod_bdl_ps_label = mod_bdl_ps_label.astype(int)
-        final_ins_labels = np.concatenate([first_ps_label.reshape(-1,1), mod_bdl_ps_label.reshape(-1,1)], axis=0)
-        final_ins_labels = final_ins_labels.astype(int)
-        final_sem_labels = np.concatenate([new_sem_labels.reshape(-1,1), mod_bdl_sem_label.reshape(-1,1)], axis=0)
-        final_sem_labels = final_sem_labels.astype(int)
-
-
-
-        tree = KDTree(final_ins_points, leaf_size=2)
-        near_points = tree.query(org_feats[:,:3], k=1, return_distance=False)
-        result_ins_labels = final_ins_labels.reshape(-1)[near_points.reshape(-1)].reshape(-1,1)
-        result_sem_labels = final_sem_labels.reshape(-1)[near_points.reshape(-1)].reshape(-1,1)
+            center_line = centerpoints_of_11_12 - np.mean(ins_label_center_points,axis=0)
+            checking_axis_vector = np.cross(pca_axis[2], center_line)
+            #majority semantic label of each instance(gingiva votes ignored), then the left/right flip by the side of the instance center
+            ins_sem_histogram[:,0] = 0
+            ins_sem_labels = np.argmax(ins_sem_histogram, axis=1)
+            flip = ~np.isin(ins_sem_labels, [1, 9]) & (np.dot(ins_centers-centerpoints_of_11_12, checking_axis_vector)<0)
+            ins_sem_labels = ins_sem_labels + 8*flip
+            #instances without any tooth vote become gingiva
+            no_tooth_votes = (ins_sem_histogram.sum(axis=1)==0) | (ins_ids==0)
+            ins_sem_labels[no_tooth_votes] = 0
+            new_sem_labels = ins_sem_labels[ins_inverse].astype(int)
+            first_ps_label[no_tooth_votes[ins_inverse]] = 0
+
+            #================boundary part ===========================#
+            #each boundary cluster takes the majority instance of the nearest first module points of its points, one query for all of them
+            mod_bdl_ps_label = np.zeros((bdl_ps_label.shape[0]))
+            mod_bdl_sem_label = np.zeros((bdl_ps_label.shape[0]))
+            clustered = np.flatnonzero(bdl_ps_label!=0)
+            if clustered.shape[0] > 0:
+                tree = KDTree(first_xyz, leaf_size=2)
+                near_points = tree.query(bdl_xyz[clustered], k=1, return_distance=False).reshape(-1)
+                _, bdl_inverse, bdl_ins_histogram = get_label_histogram(bdl_ps_label[clustered], first_ps_label[near_points])
+                bdl_ins_labels = np.argmax(bdl_ins_histogram, axis=1)
+                #semantic label of each remaining instance id
+                sem_label_of_ins = np.zeros(first_ps_label.max()+1, dtype=int)
+                sem_label_of_ins[first_ps_label] = new_sem_labels
+
+                mod_bdl_ps_label[clustered] = bdl_ins_labels[bdl_inverse]
+                mod_bdl_sem_label[clustered] = sem_label_of_ins[bdl_ins_labels][bdl_inverse]
+
+            final_ins_points = np.concatenate([first_xyz, bdl_xyz], axis=0)
+            mod_bdl_ps_label = mod_bdl_ps_label.astype(int)
+            final_ins_labels = np.concatenate([first_ps_label.reshape(-1,1), mod_bdl_ps_label.reshape(-1,1)], axis=0)
+            final_ins_labels = final_ins_labels.astype(int)
+            final_sem_labels = np.concatenate([new_sem_labels.reshape(-1,1), mod_bdl_sem_label.reshape(-1,1)], axis=0)
+            final_sem_labels = final_sem_labels.astype(int)
+
+
+
+        with timer.measure("kdtree_transfer"):
+            near_points = get_nearest_points(final_ins_points, org_feats[:,:3])
+            result_ins_labels, result_sem_labels = [labels.reshape(-1)[near_points].reshape(-1,1) for labels in [final_ins_labels, final_sem_labels]]
         if DEBUG:
             gu.print_3d(
                 gu.np_to_pcd_with_label(org_feats[:,:3], result_ins_labels), 
@@ -146,64 +256,228 @@ class InferencePipeLine:
                 gu.np_to_pcd_with_label(org_feats[:,:3], result_sem_labels)
             )
 
-        result_sem_labels[result_sem_labels>=9] += 2
-        result_sem_labels[result_sem_labels>0] += 10
-        assert result_sem_labels.shape[0] == n_vertices
-        assert result_ins_labels.shape[0] == n_vertices
+        result_sem_labels = get_result_sem_labels(result_sem_labels)
+        assert result_sem_labels.shape[0] == state["n_vertices"]
+        assert result_ins_labels.shape[0] == state["n_vertices"]
         
-        return {
+        result = {
             "sem":result_sem_labels.reshape(-1),
             "ins":result_ins_labels.reshape(-1),
-        }       
-
-    def get_first_module_results(self, feats, base_model):
+        }
+        if state.get("keep_context"):
+            #labels of the sampled points then of the boundary points, in the numbering of the result
+            result["context"] = {
+                "preset_info": state["preset_info"],
+                "vertices": org_feats[:,:3],
+                "sampled_feats": state["sampled_feats"],
+                "boundary_feats": None if early_exit else state["sampled_boundary_feats"],
+                "point_sem": get_result_sem_labels(final_sem_labels).reshape(-1),
+                "point_ins": final_ins_labels.reshape(-1),
+                "near_points": near_points,
+                "sem": result["sem"].copy(),
+                "ins": result["ins"].copy(),
+            }
+        if self.stage_timing:
+            result["stage_timing"] = timer.to_dict()
+        return result
+
+    def record_early_exit(self, early_exit, boundary_ms):
+        with self.early_exit_lock:
+            if early_exit:
+                self.early_exit_stats["early_exit"] += 1
+            else:
+                self.early_exit_stats["full"] += 1
+                self.early_exit_stats["full_boundary_ms"] += boundary_ms
+
+    def resegment(self, context, vertex_ids=None, label=None, instance=None):
+        """
+        incremental re-segmentation of a result made with keep_context=True after a user edit. labels are in the numbering of the result sem, 0 is the gingiva.
+            vertex_ids, label: the user painted these vertices of the scan as tooth label. only the crops of the teeth the edit touches rerun, through the second model of the first module and of the boundary module,
+                and only the vertices whose nearest labeled point changed are relabeled.
+            instance, label: the user relabeled the teeth of a whole instance, no model runs.
+        returns {"sem", "ins", "touched"(labels of the teeth whose vertices changed), "context"(of the new result, for the next edit), "stage_timing"}
+        """
+        timer = StageTimer(self.device, enabled=self.stage_timing, cuda_sync=self.stage_timing_cuda_sync)
+        point_sem, point_ins = context["point_sem"].copy(), context["point_ins"].copy()
+        sem, ins = context["sem"].copy(), context["ins"].copy()
+        if instance is not None:
+            with timer.measure("relabel"):
+                #the gingiva has no instance, a tooth keeps its instance id
+                label_instance = 0 if label == 0 else instance
+                point_sem[point_ins == instance], point_ins[point_ins == instance] = label, label_instance
+                sem[ins == instance], ins[ins == instance] = label, label_instance
+        else:
+            vertex_ids = np.asarray(vertex_ids, dtype=int).reshape(-1)
+            sampled_feats = context["sampled_feats"]
+            num_of_sampled = sampled_feats.shape[0]
+            crop_sample_size = context["preset_info"]["crop_sample_size"]
+            with timer.measure("edit_mapping"):
+                painted = np.zeros(num_of_sampled, dtype=bool)
+                painted[get_nearest_points(sampled_feats[:,:3], context["vertices"][vertex_ids])] = True
+                affected = np.union1d(point_sem[:num_of_sampled][painted], [label])
+                affected = affected[affected != 0]
+                label_instance = get_instance_of_label(point_sem, point_ins, label)
+                point_sem[:num_of_sampled][painted], point_ins[:num_of_sampled][painted] = label, label_instance
+
+            with timer.measure("crop_forward"):
+                sampled_sem, sampled_ins = point_sem[:num_of_sampled], point_ins[:num_of_sampled]
+                self.update_tooth_crops(self.first_module, sampled_feats, sampled_sem, sampled_ins, affected, painted, crop_sample_size)
+
+            if context["boundary_feats"] is not None:
+                with timer.measure("boundary_crop_forward"):
+                    #the boundary module input is labeled by the nearest sampled points, as in select_boundary
+                    boundary_feats = context["boundary_feats"]
+                    seed_points = get_nearest_points(sampled_feats[:,:3], boundary_feats[:,:3])
+                    boundary_sem, boundary_ins = sampled_sem[seed_points], sampled_ins[seed_points]
+                    #boundary points away from the affected teeth keep their labels
+                    previous_sem, previous_ins = point_sem[num_of_sampled:], point_ins[num_of_sampled:]
+                    num_of_only_boundary = previous_sem.shape[0]
+                    kept = ~np.isin(previous_sem, affected) & ~np.isin(boundary_sem[:num_of_only_boundary], affected)
+                    boundary_sem[:num_of_only_boundary][kept], boundary_ins[:num_of_only_boundary][kept] = previous_sem[kept], previous_ins[kept]
+                    self.update_tooth_crops(self.bdl_module, boundary_feats, boundary_sem, boundary_ins, affected, np.zeros(boundary_sem.shape[0], dtype=bool), crop_sample_size)
+                    point_sem[num_of_sampled:], point_ins[num_of_sampled:] = boundary_sem[:num_of_only_boundary], boundary_ins[:num_of_only_boundary]
+
+            with timer.measure("label_patch"):
+                near_points = context["near_points"]
+                changed = (point_sem != context["point_sem"]) | (point_ins != context["point_ins"])
+                changed_vertices = np.flatnonzero(changed[near_points])
+                sem[changed_vertices], ins[changed_vertices] = point_sem[near_points[changed_vertices]], point_ins[near_points[changed_vertices]]
+                sem[vertex_ids], ins[vertex_ids] = label, label_instance
+
+        changed_vertices = (sem != context["sem"]) | (ins != context["ins"])
+        touched = np.union1d(context["sem"][changed_vertices], sem[changed_vertices])
+        timer.annotate("resegment_changed_vertices", int(changed_vertices.sum()))
+        return {
+            "sem": sem.copy(),
+            "ins": ins.copy(),
+            "touched": touched,
+            "context": dict(context, point_sem=point_sem, point_ins=point_ins, sem=sem, ins=ins),
+            "stage_timing": timer.to_dict(),
+        }
+
+    def update_tooth_crops(self, base_model, feats, point_sem, point_ins, crop_labels, fixed, crop_sample_size):
+        """
+        reruns the second model of base_model on one crop per tooth of crop_labels, centered at the mean of its points. in place:
+        inside the crop of a tooth, its points outside the predicted mask become gingiva and gingiva points inside the mask join it. fixed points(user edits) keep their labels.
+        feats: (n, 6) points, point_sem, point_ins: (n) labels, fixed: (n) bool
+        """
+        crop_labels = [crop_label for crop_label in crop_labels if np.any(point_sem == crop_label)]
+        if len(crop_labels) == 0:
+            return
+        xyz = feats[:,:3]
+        centroids = np.array([xyz[point_sem == crop_label].mean(axis=0) for crop_label in crop_labels])
+        crop_indexes = tu.get_nearest_neighbor_idx(xyz[None], [centroids], min(crop_sample_size, xyz.shape[0]))[0]
+        points = torch.from_numpy(np.ascontiguousarray(feats.T[None], dtype="float32")).to(self.device)
+        with torch.no_grad(), iopt.inference_autocast(self.inference_profile, self.device):
+            cropped_feats = tu.centering_object(tu.get_indexed_features(points, [crop_indexes]))
+            crop_masks = gu.torch_to_numpy(torch.argmax(base_model.second_ins_cent_model([cropped_feats])[0], dim=1)) == 1
+
+        for crop_label, indexes, mask in zip(crop_labels, crop_indexes, crop_masks):
+            crop_instance = get_instance_of_label(point_sem, point_ins, crop_label)
+            free = ~fixed[indexes]
+            shrink = indexes[free & ~mask & (point_sem[indexes] == crop_label)]
+            grow = indexes[free & mask & (point_sem[indexes] == 0)]
+            point_sem[shrink], point_ins[shrink] = 0, 0
+            point_sem[grow], point_ins[grow] = crop_label, crop_instance
+
+    def get_early_exit_stats(self):
+        """
+        scans of each path since the pipeline was made. the latency saved by an early exit is estimated with the mean boundary stage time of the full scans.
+        """
+        with self.early_exit_lock:
+            stats = dict(self.early_exit_stats)
+        mean_boundary_ms = stats["full_boundary_ms"] / stats["full"] if stats["full"] > 0 else None
+        return {
+            "threshold": self.early_exit_threshold,
+            "full": stats["full"],
+            "early_exit": stats["early_exit"],
+            "mean_boundary_ms": mean_boundary_ms,
+            "estimated_saved_ms": stats["early_exit"] * mean_boundary_ms if mean_boundary_ms is not None else None,
+        }
+
+    def run_first_forward_batch(self, key, points_ls):
+        """
+        key: crop sample size, number of points of the scans
+        points_ls: (1, 6, N) sampled points of each scan
+        output: first module output of each scan, as if it ran alone
+        """
+        crop_sample_size, _ = key
+        with torch.no_grad(), iopt.inference_autocast(self.inference_profile, self.device):
+            if len(points_ls) == 1:
+                return [self.first_module([points_ls[0]], crop_sample_size=crop_sample_size)]
+            #the batch key has the point count, the clouds are stacked
+            inputs = torch.cat(points_ls, dim=0)
+            output = self.first_module([inputs], crop_sample_size=crop_sample_size)
+            return split_batch_output(output, self.first_module.get_cloud_ranges([inputs], None))
+
+    def get_micro_batch_stats(self):
+        """batches of the first module forward since the pipeline was made, None without micro batching"""
+        return self.first_batcher.get_stats() if self.first_batcher is not None else None
+
+    def forward_first_module(self, points, base_model, timer=None, crop_sample_size=None):
+        timer = timer if timer is not None else StageTimer(enabled=False)
+        with timer.measure("first_forward"):
+            if self.first_batcher is not None and base_model is self.first_module:
+                #a forward has one crop size, and scans of one preset have the same number of points(fewer only for scans smaller than the sample size)
+                output, batch_size = self.first_batcher((crop_sample_size, points.shape[-1]), points)
+                timer.annotate("first_forward_batch_size", batch_size)
+            else:
+                with torch.no_grad(), iopt.inference_autocast(self.inference_profile, self.device):
+                    output = base_model([points], crop_sample_size=crop_sample_size)
+        return output
+
+    def get_first_module_results(self, feats, base_model, timer=None, crop_sample_size=None, output=None):
         """
 
         Args:
             batch_idx (_type_): _description_
+            output: output of forward_first_module if the forward ran in another stage, None runs it here
 
         Returns:
             labels: N
         """
         points = feats
-        with torch.no_grad():
-            output = base_model([points])
-        results = {}
-        results["first_features"] = output["first_features"] 
-
-        org_xyz_cpu = gu.torch_to_numpy(points)[0,:3,:].T
-
-        whole_pd_sem_1 = gu.torch_to_numpy(output["sem_1"])[0,:,:].T
-        whole_cls_1 = np.argmax(whole_pd_sem_1, axis=1)
-        full_labeled_points_1 = np.concatenate([org_xyz_cpu, whole_cls_1.reshape(-1,1)], axis=1)
-
-        results["sem_1"] = {}
-        results["sem_1"]["full_labeled_points"] = full_labeled_points_1
-        results["sem_1"]["whole_pd_sem"] = whole_pd_sem_1
-
-        crop_num = output["sem_2"].shape[0]
-
-        whole_pd_mask_2 = torch.zeros((points.shape[2], 2)).cuda()
-        whole_pd_mask_count_2 = torch.zeros(points.shape[2]).cuda()
-        for crop_idx in range(crop_num):
-            pd_mask = output["sem_2"][crop_idx, :, :].permute(1,0) # 3072,17
-            inside_crop_idx = output["nn_crop_indexes"][0][crop_idx]
-            whole_pd_mask_2[inside_crop_idx] += pd_mask
-            whole_pd_mask_count_2[inside_crop_idx] += 1
+        timer = timer if timer is not None else StageTimer(enabled=False)
+        if output is None:
+            output = self.forward_first_module(points, base_model, timer, crop_sample_size)
+        #crop mask merge and clustering of the moved points
+        with timer.measure("clustering"):
+            results = {}
+            results["first_features"] = output["first_features"] 
+
+            org_xyz_cpu = gu.torch_to_numpy(points)[0,:3,:].T
+
+            whole_pd_sem_1 = gu.torch_to_numpy(output["sem_1"])[0,:,:].T
+            whole_cls_1 = np.argmax(whole_pd_sem_1, axis=1)
+            full_labeled_points_1 = np.concatenate([org_xyz_cpu, whole_cls_1.reshape(-1,1)], axis=1)
+
+            results["sem_1"] = {}
+            results["sem_1"]["full_labeled_points"] = full_labeled_points_1
+            results["sem_1"]["whole_pd_sem"] = whole_pd_sem_1
+
+            crop_num = output["sem_2"].shape[0]
+
+            whole_pd_mask_2 = torch.zeros((points.shape[2], 2), device=self.device)
+            whole_pd_mask_count_2 = torch.zeros(points.shape[2], device=self.device)
+            for crop_idx in range(crop_num):
+                pd_mask = output["sem_2"][crop_idx, :, :].permute(1,0) # 3072,17
+                inside_crop_idx = output["nn_crop_indexes"][0][crop_idx]
+                whole_pd_mask_2[inside_crop_idx] += pd_mask
+                whole_pd_mask_count_2[inside_crop_idx] += 1
         
-        whole_pd_mask_2 = gu.torch_to_numpy(whole_pd_mask_2)
-        whole_mask_2 = np.argmax(whole_pd_mask_2, axis=1)
-        full_masked_points_2 = np.concatenate([org_xyz_cpu, whole_mask_2.reshape(-1,1)], axis=1)
+            whole_pd_mask_2 = gu.torch_to_numpy(whole_pd_mask_2)
+            whole_mask_2 = np.argmax(whole_pd_mask_2, axis=1)
+            full_masked_points_2 = np.concatenate([org_xyz_cpu, whole_mask_2.reshape(-1,1)], axis=1)
 
-        results["sem_2"] = {}
-        results["sem_2"]["full_masked_points"] = full_masked_points_2
-        results["sem_2"]["whole_pd_mask"] = whole_pd_mask_2
+            results["sem_2"] = {}
+            results["sem_2"]["full_masked_points"] = full_masked_points_2
+            results["sem_2"]["whole_pd_mask"] = whole_pd_mask_2
 
-        moved_points_cpu = org_xyz_cpu + gu.torch_to_numpy(output["offset_1"])[0,:3,:].T
-        fg_moved_points = moved_points_cpu[results["sem_2"]["full_masked_points"][:,3]==1, :]
+            moved_points_cpu = org_xyz_cpu + gu.torch_to_numpy(output["offset_1"])[0,:3,:].T
+            fg_moved_points = moved_points_cpu[results["sem_2"]["full_masked_points"][:,3]==1, :]
 
         
-        fg_points_labels_ls = tu.get_clustering_labels(moved_points_cpu, results["sem_2"]["full_masked_points"][:,3])
+            fg_points_labels_ls = tu.get_clustering_labels(moved_points_cpu, results["sem_2"]["full_masked_points"][:,3])
 
         points_ins_labels = np.zeros(org_xyz_cpu.shape[0])
         points_ins_labels[:] = -1
@@ -215,63 +489,72 @@ class InferencePipeLine:
         results["ins"]["full_ins_labeled_points"] = full_ins_labeled_points
         return results
 
-    def get_second_module_results(self, feats, sampled_boundary_seg_label, base_model):
+    def forward_second_module(self, points, sampled_boundary_seg_label, base_model, timer=None, crop_sample_size=None):
+        timer = timer if timer is not None else StageTimer(enabled=False)
+        with timer.measure("boundary_forward"), torch.no_grad(), iopt.inference_autocast(self.inference_profile, self.device):
+            return base_model([points, sampled_boundary_seg_label], test=True, crop_sample_size=crop_sample_size)
+
+    def get_second_module_results(self, feats, sampled_boundary_seg_label, base_model, timer=None, crop_sample_size=None, output=None):
         """
 
         Args:
             batch_idx (_type_): _description_
+            output: output of forward_second_module if the forward ran in another stage, None runs it here
 
         Returns:
             labels: N
         """
         points = feats
-        with torch.no_grad():
-            output = base_model([points, sampled_boundary_seg_label], test=True)
-        results = {}
-
-        crop_num = output["sem_2"].shape[0]
-        org_xyz_cpu = gu.torch_to_numpy(points)[0,:3,:].T
-
-        whole_pd_mask_2 = torch.zeros((points.shape[2], 2)).cuda()
-        whole_pd_mask_count_2 = torch.zeros(points.shape[2]).cuda()
-        for crop_idx in range(crop_num):
-            pd_mask = output["sem_2"][crop_idx, :, :].permute(1,0) # 3072,17
-            inside_crop_idx = output["nn_crop_indexes"][0][crop_idx]
-            whole_pd_mask_2[inside_crop_idx] += pd_mask
-            whole_pd_mask_count_2[inside_crop_idx] += 1
+        timer = timer if timer is not None else StageTimer(enabled=False)
+        if output is None:
+            output = self.forward_second_module(points, sampled_boundary_seg_label, base_model, timer, crop_sample_size)
+        #crop mask merge and kmeans of the moved points
+        with timer.measure("kmeans"):
+            results = {}
+
+            crop_num = output["sem_2"].shape[0]
+            org_xyz_cpu = gu.torch_to_numpy(points)[0,:3,:].T
+
+            whole_pd_mask_2 = torch.zeros((points.shape[2], 2), device=self.device)
+            whole_pd_mask_count_2 = torch.zeros(points.shape[2], device=self.device)
+            for crop_idx in range(crop_num):
+                pd_mask = output["sem_2"][crop_idx, :, :].permute(1,0) # 3072,17
+                inside_crop_idx = output["nn_crop_indexes"][0][crop_idx]
+                whole_pd_mask_2[inside_crop_idx] += pd_mask
+                whole_pd_mask_count_2[inside_crop_idx] += 1
     
-        if False:
-            t = gu.torch_to_numpy(output['first_features'])
-            x_p = gu.torch_to_numpy(points.permute(2,1,0)[:,:3])
+            if False:
+                t = gu.torch_to_numpy(output['first_features'])
+                x_p = gu.torch_to_numpy(points.permute(2,1,0)[:,:3])
 
-            pca = PCA(n_components=3, svd_solver='full')
-            pca.fit(t)
-            colors = np.matmul(t,pca.components_.T)
-            colors = ((colors - colors.min(axis=0))/(colors.max(axis=0)-colors.min(axis=0)))
+                pca = PCA(n_components=3, svd_solver='full')
+                pca.fit(t)
+                colors = np.matmul(t,pca.components_.T)
+                colors = ((colors - colors.min(axis=0))/(colors.max(axis=0)-colors.min(axis=0)))
 
-            pcd = o3d.geometry.PointCloud()
-            pcd.points = o3d.utility.Vector3dVector(x_p[:,:3])
-            pcd.colors = o3d.utility.Vector3dVector(colors)
+                pcd = o3d.geometry.PointCloud()
+                pcd.points = o3d.utility.Vector3dVector(x_p[:,:3])
+                pcd.colors = o3d.utility.Vector3dVector(colors)
 
 
-        whole_pd_mask_2 = gu.torch_to_numpy(whole_pd_mask_2)
-        whole_mask_2 = np.argmax(whole_pd_mask_2, axis=1)
-        full_masked_points_2 = np.concatenate([org_xyz_cpu, whole_mask_2.reshape(-1,1)], axis=1)
+            whole_pd_mask_2 = gu.torch_to_numpy(whole_pd_mask_2)
+            whole_mask_2 = np.argmax(whole_pd_mask_2, axis=1)
+            full_masked_points_2 = np.concatenate([org_xyz_cpu, whole_mask_2.reshape(-1,1)], axis=1)
 
-        results["sem_2"] = {}
-        results["sem_2"]["full_masked_points"] = full_masked_points_2
-        results["sem_2"]["whole_pd_mask"] = whole_pd_mask_2
+            results["sem_2"] = {}
+            results["sem_2"]["full_masked_points"] = full_masked_points_2
+            results["sem_2"]["whole_pd_mask"] = whole_pd_mask_2
 
-        moved_points_cpu = org_xyz_cpu + gu.torch_to_numpy(output["offset_1"])[0,:3,:].T
-        fg_moved_points = moved_points_cpu[results["sem_2"]["full_masked_points"][:,3]==1, :]
+            moved_points_cpu = org_xyz_cpu + gu.torch_to_numpy(output["offset_1"])[0,:3,:].T
+            fg_moved_points = moved_points_cpu[results["sem_2"]["full_masked_points"][:,3]==1, :]
 
-        num_of_clusters = []
-        num_of_clusters.append(len(np.unique(gu.torch_to_numpy(sampled_boundary_seg_label)))-1)
-        cluster_centroids, cluster_centroids_labels, fg_points_labels_ls = tu.clustering_points(
-            [fg_moved_points], 
-            method="kmeans", 
-            num_of_clusters=num_of_clusters
-        )
+            num_of_clusters = []
+            num_of_clusters.append(len(np.unique(gu.torch_to_numpy(sampled_boundary_seg_label)))-1)
+            cluster_centroids, cluster_centroids_labels, fg_points_labels_ls = tu.clustering_points(
+                [fg_moved_points], 
+                method="kmeans", 
+                num_of_clusters=num_of_clusters
+            )
         
         points_ins_labels = np.zeros(org_xyz_cpu.shape[0])
         points_ins_labels -= 1
@@ -286,45 +569,131 @@ class InferencePipeLine:
         return results
 
 
-    def get_boundary_sampled_feats(self,point_labels, org_feats, sampled_feats, sample_output_features):
-        xyz_cpu = sampled_feats[:,:3].copy() # N',3
-        tree = KDTree(xyz_cpu, leaf_size=40)
+    def get_boundary_sampled_feats(self,point_labels, org_feats, sampled_feats, sample_output_features, boundary_sampling_info=None):
+        if boundary_sampling_info is None:
+            boundary_sampling_info = self.get_preset_info()["boundary_sampling_info"]
+        return get_boundary_sampled_feats(point_labels, org_feats, sampled_feats, sample_output_features, boundary_sampling_info)
 
-        bd_labels = np.zeros(org_feats.shape[0]) # N
-        ps_labels = np.zeros(org_feats.shape[0]) # N
-        near_points = tree.query(org_feats[:,:3], k=40, return_distance=False, )
+def get_boundary_sampled_feats(point_labels, org_feats, sampled_feats, sample_output_features, boundary_sampling_info):
+    """
+    points near the instance boundaries of the first module(less than bdl_ratio of the num_of_neighbors neighbors share the label) are sampled densely for the boundary module.
+    input: point_labels (N'), org_feats (N, 6), sampled_feats (N', 6)
+    output: sampled feats (num_of_all_points, 6), their labels, the boundary feats and their labels
+    """
+    xyz_cpu = sampled_feats[:,:3].copy() # N',3
+    tree = KDTree(xyz_cpu, leaf_size=40)
 
-        labels_arr = point_labels[near_points]
-        label_counts = gu.count_unique_by_row(labels_arr)
-        label_ratio = label_counts[:, 0] / 40.
+    bd_labels = np.zeros(org_feats.shape[0]) # N
+    ps_labels = np.zeros(org_feats.shape[0]) # N
+    num_of_neighbors = boundary_sampling_info.get("num_of_neighbors", 40)
+    near_points = tree.query(org_feats[:,:3], k=num_of_neighbors, return_distance=False, )
 
-        bd_labels[label_ratio < self.config["boundary_sampling_info"]["bdl_ratio"]] = 1
+    labels_arr = point_labels[near_points]
+    label_counts = gu.count_unique_by_row(labels_arr)
+    label_ratio = label_counts[:, 0] / num_of_neighbors
 
-        k_1_near_points = tree.query(org_feats[:,:3], k=1, return_distance=False)
-        ps_labels = point_labels[k_1_near_points[:,0]].reshape(-1,1)
+    bd_labels[label_ratio < boundary_sampling_info["bdl_ratio"]] = 1
 
+    k_1_near_points = tree.query(org_feats[:,:3], k=1, return_distance=False)
+    ps_labels = point_labels[k_1_near_points[:,0]].reshape(-1,1)
 
-        bd_org_feat_cpu = org_feats[bd_labels==1, :]
-        bd_org_ps_label_cpu = ps_labels[bd_labels==1, :]
-        bd_org_feat_cpu, bd_org_ps_label_cpu = gu.resample_pcd([bd_org_feat_cpu, bd_org_ps_label_cpu], self.config["boundary_sampling_info"]["num_of_bdl_points"], "uniformly")
-        non_bd_org_feat_cpu = org_feats[bd_labels!=1, :]
-        non_bd_org_ps_label_cpu = ps_labels[bd_labels!=1, :]
-        non_bd_org_feat_cpu, non_bd_org_ps_label_cpu = gu.resample_pcd([non_bd_org_feat_cpu, non_bd_org_ps_label_cpu], self.config["boundary_sampling_info"]["num_of_all_points"]-bd_org_feat_cpu.shape[0], "fps")
-        
-        results_feat_cpu = np.concatenate([bd_org_feat_cpu, non_bd_org_feat_cpu], axis=0)
-        results_label_cpu = np.concatenate([bd_org_ps_label_cpu, non_bd_org_ps_label_cpu], axis=0)
-
-        if sample_output_features is not None:
-            sample_output_features = gu.torch_to_numpy(sample_output_features)[0,:,:].T
-
-            near_points = tree.query(results_feat_cpu[:,:3], k=3, return_distance=True)
-            near_points_idxes = near_points[1]
-            near_points_prop = near_points[0]
-            near_points_prop = near_points_prop / np.sum(near_points_prop,axis=1).reshape(-1,1)
 
-            nn_features = sample_output_features[near_points_idxes] * near_points_prop.reshape(24000,3,1)
-            nn_features = nn_features.sum(axis=1)
-            nn_features = nn_features.astype('float32')
-            results_feat_cpu = np.concatenate([results_feat_cpu, nn_features], axis=1)
-
-        return results_feat_cpu, results_label_cpu, bd_org_feat_cpu, bd_org_ps_label_cpu
+    bd_org_feat_cpu = org_feats[bd_labels==1, :]
+    bd_org_ps_label_cpu = ps_labels[bd_labels==1, :]
+    bd_org_feat_cpu, bd_org_ps_label_cpu = gu.resample_pcd([bd_org_feat_cpu, bd_org_ps_label_cpu], boundary_sampling_info["num_of_bdl_points"], "uniformly")
+    non_bd_org_feat_cpu = org_feats[bd_labels!=1, :]
+    non_bd_org_ps_label_cpu = ps_labels[bd_labels!=1, :]
+    non_bd_org_feat_cpu, non_bd_org_ps_label_cpu = gu.resample_pcd([non_bd_org_feat_cpu, non_bd_org_ps_label_cpu], boundary_sampling_info["num_of_all_points"]-bd_org_feat_cpu.shape[0], "fps")
+    
+    results_feat_cpu = np.concatenate([bd_org_feat_cpu, non_bd_org_feat_cpu], axis=0)
+    results_label_cpu = np.concatenate([bd_org_ps_label_cpu, non_bd_org_ps_label_cpu], axis=0)
+
+    if sample_output_features is not None:
+        sample_output_features = gu.torch_to_numpy(sample_output_features)[0,:,:].T
+
+        near_points = tree.query(results_feat_cpu[:,:3], k=3, return_distance=True)
+        near_points_idxes = near_points[1]
+        near_points_prop = near_points[0]
+        near_points_prop = near_points_prop / np.sum(near_points_prop,axis=1).reshape(-1,1)
+
+        nn_features = sample_output_features[near_points_idxes] * near_points_prop.reshape(-1,3,1)
+        nn_features = nn_features.sum(axis=1)
+        nn_features = nn_features.astype('float32')
+        results_feat_cpu = np.concatenate([results_feat_cpu, nn_features], axis=1)
+
+    return results_feat_cpu, results_label_cpu, bd_org_feat_cpu, bd_org_ps_label_cpu
+
+def split_batch_output(output, cloud_ranges):
+    """
+    output: GroupingNetworkModule output of a batch of clouds(stacked or packed)
+    cloud_ranges: (batch row, start, end) of every cloud, see GroupingNetworkModule.get_cloud_ranges
+    output: the output of each cloud, shaped as the output of a forward of that cloud alone
+    """
+    num_of_points = output["sem_1"].shape[2]
+    crop_batch_index = torch.from_numpy(output["crop_batch_index"]).to(output["sem_2"].device)
+    cloud_outputs = []
+    for cloud_idx, (b_idx, start, end) in enumerate(cloud_ranges):
+        crop_rows = torch.nonzero(crop_batch_index == cloud_idx).reshape(-1)
+        cloud_output = {
+            "first_features": output["first_features"][b_idx*num_of_points + start:b_idx*num_of_points + end],
+            "nn_crop_indexes": [output["nn_crop_indexes"][cloud_idx]],
+            "crop_batch_index": np.zeros(crop_rows.shape[0], dtype=int),
+        }
+        for key in ["sem_1", "offset_1", "mask_1"]:
+            cloud_output[key] = output[key][b_idx:b_idx+1, :, start:end] if output[key] is not None else None
+        for key in ["sem_2", "offset_2", "mask_2", "cropped_feature_ls"]:
+            cloud_output[key] = output[key][crop_rows] if output[key] is not None else None
+        cloud_outputs.append(cloud_output)
+    return cloud_outputs
+
+def get_label_histogram(group_labels, class_labels):
+    """
+    co-occurrence counts of two non negative label arrays of the same points, with one bincount
+    output: unique group labels (g), index of each point's group (n), counts (g, max class label + 1)
+    """
+    group_ids, group_inverse = np.unique(group_labels, return_inverse=True)
+    group_inverse = group_inverse.reshape(-1)
+    num_classes = int(class_labels.max()) + 1 if class_labels.shape[0] > 0 else 1
+    histogram = np.bincount(group_inverse * num_classes + class_labels, minlength=group_ids.shape[0] * num_classes).reshape(group_ids.shape[0], num_classes)
+    return group_ids, group_inverse, histogram
+
+def get_boundary_score(point_labels, sampled_xyz, boundary_sampling_info):
+    """
+    boundary uncertainty of the first module result: ratio of the sampled points with a mixed neighborhood(the test of get_boundary_sampled_feats on the sampled points only).
+    a clean result only has the thin bands between the teeth, a noisy one has mixed points everywhere.
+    input: point_labels (N'), sampled_xyz (N', 3)
+    output: score in [0, 1]
+    """
+    num_of_neighbors = boundary_sampling_info.get("num_of_neighbors", 40)
+    tree = KDTree(sampled_xyz, leaf_size=40)
+    near_points = tree.query(sampled_xyz, k=num_of_neighbors, return_distance=False)
+    label_ratio = gu.count_unique_by_row(point_labels[near_points])[:, 0] / num_of_neighbors
+    return float(np.mean(label_ratio < boundary_sampling_info["bdl_ratio"]))
+
+def get_nearest_points(points, query_points):
+    """output: (m) index of the nearest point of each query point"""
+    tree = KDTree(points, leaf_size=2)
+    return tree.query(query_points, k=1, return_distance=False).reshape(-1)
+
+def transfer_labels(points, labels_ls, query_points):
+    """
+    each query point takes the labels of its nearest point
+    input: points (n, 3), labels_ls: list of (n) or (n, 1) arrays, query_points (m, 3)
+    output: list of (m, 1) arrays
+    """
+    near_points = get_nearest_points(points, query_points)
+    return [labels.reshape(-1)[near_points].reshape(-1,1) for labels in labels_ls]
+
+def get_result_sem_labels(sem_labels):
+    """first module classes(1~8 one side, 9~16 the other) => labels of the result(11~18, 21~28), 0 stays the gingiva"""
+    sem_labels = sem_labels.copy()
+    sem_labels[sem_labels>=9] += 2
+    sem_labels[sem_labels>0] += 10
+    return sem_labels
+
+def get_instance_of_label(point_sem, point_ins, label):
+    """the instance id of the points of a tooth label, a new id if the label has no points"""
+    if label == 0:
+        return 0
+    instances = point_ins[point_sem == label]
+    return int(np.argmax(np.bincount(instances))) if instances.shape[0] > 0 else int(point_ins.max()) + 1
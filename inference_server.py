@@ -1,26 +1,136 @@
 import asyncio
 import websockets
 import json
-from inference_tgnet import inference_tgnet
+from concurrent.futures import ThreadPoolExecutor
+from inference_tgnet import inference_tgnet, segment_meshes, resegment_scan, get_result_cache_stats, get_micro_batch_stats
+from inference_pipelines.inference_pipeline_maker import TGNET_PRESETS
+from mesh_protocol import decode_mesh_request, encode_result_message
+
+#binary mesh requests carry whole scans, a 200k vertex scan is ~7MB uncompressed
+MAX_MESSAGE_SIZE = 2**28
+#requests of different connections run at the same time in these threads, so that their first module forwards can be batched(MICRO_BATCH in inference_tgnet.py)
+MAX_CONCURRENT_REQUESTS = 4
+request_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS)
+
+async def run_in_executor(func, *args):
+    """runs a blocking inference call without blocking the other connections"""
+    return await asyncio.get_running_loop().run_in_executor(request_executor, func, *args)
+
+def handle_mesh_message(message):
+    """
+    binary mesh request(see mesh_protocol.py). the meshes are segmented from memory and the results are returned in the response, no files are written.
+    "result_format": "json"(default) returns a json response, "binary" a binary message with uint8 run length encoded labels and instances(encode_result_message). errors are always json.
+    "keep_context": true adds a "context_id" to each result, for the resegment command
+    """
+    try:
+        data, meshes = decode_mesh_request(message)
+    except (ValueError, KeyError, TypeError) as e:
+        return {"status": "error", "message": f"Invalid mesh message: {e}"}
+
+    preset = data.get("preset")
+    if preset is not None and preset not in TGNET_PRESETS:
+        return {"status": "error", "message": f"Unknown preset {preset}, one of {list(TGNET_PRESETS.keys())}."}
+    if len(meshes) == 0 or any(scan_type not in ("lower", "upper") for scan_type in meshes):
+        return {"status": "error", "message": "Mesh message needs lower and/or upper meshes."}
+    result_format = data.get("result_format", "json")
+    if result_format not in ("json", "binary"):
+        return {"status": "error", "message": f"Unknown result format {result_format}, json | binary."}
+
+    try:
+        results = segment_meshes(meshes, preset, bool(data.get("keep_context")))
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+    failed = [scan_type for scan_type, result in results.items() if result is None]
+    response = {
+        "status": "error" if failed else "success",
+        "message": f"Inference failed for {', '.join(failed)}." if failed else "Inference completed successfully.",
+        "results": {},
+    }
+    for scan_type, result in results.items():
+        if result is None:
+            response["results"][scan_type] = None
+            continue
+        response["results"][scan_type] = {key: result[key] for key in ("labels", "instances", "braces_location", "context_id") if key in result}
+        if data.get("return_timing"):
+            response["results"][scan_type]["stage_timing"] = result["stage_timing"]
+    if result_format == "binary":
+        return encode_result_message(response.pop("results"), **response)
+    return response
+
+def handle_resegment_message(data):
+    """
+    {"command": "resegment", "context_id", "label", "vertex_ids": [...] | "instance"}: a clinician edit of a result segmented with "keep_context": true.
+    only the teeth the edit touches are segmented again, see ScanSegmentation.resegment. the response has the labels of the whole scan and the touched teeth.
+    "result_format": "binary" as for the mesh requests, the result is under "edit".
+    """
+    if type(data.get("label")) != int or (data.get("vertex_ids") is None) == (data.get("instance") is None):
+        return {"status": "error", "message": "Resegment needs an integer label and either vertex_ids or an instance."}
+    result_format = data.get("result_format", "json")
+    if result_format not in ("json", "binary"):
+        return {"status": "error", "message": f"Unknown result format {result_format}, json | binary."}
+    try:
+        result = resegment_scan(data.get("context_id"), data.get("vertex_ids"), data["label"], data.get("instance"))
+    except KeyError as e:
+        return {"status": "error", "message": str(e.args[0])}
+    except ValueError as e:
+        #an invalid edit, the result is not changed
+        return {"status": "error", "message": f"Invalid edit: {e}"}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+    edit = {key: result[key] for key in ("labels", "instances", "braces_location", "touched")}
+    if data.get("return_timing"):
+        edit["stage_timing"] = result["stage_timing"]
+    if result_format == "binary":
+        return encode_result_message({"edit": edit}, status="success", message="Resegment completed successfully.")
+    return {"status": "success", "message": "Resegment completed successfully.", "results": {"edit": edit}}
 
 async def handle_connection(websocket):
     try:
         async for message in websocket:
+            #binary messages are mesh uploads, text messages are json requests with server side file paths
+            if isinstance(message, bytes):
+                response = await run_in_executor(handle_mesh_message, message)
+                await websocket.send(response if isinstance(response, bytes) else json.dumps(response))
+                continue
             try:
                 data = json.loads(message)
             except json.JSONDecodeError:
                 response = {"status": "error", "message": "Invalid JSON format."}
                 await websocket.send(json.dumps(response))
                 continue
+
+            #{"command": "cache_stats"} returns the hit rate and size of the result cache
+            if data.get("command") == "cache_stats":
+                await websocket.send(json.dumps({"status": "success", "cache_stats": get_result_cache_stats()}))
+                continue
+            #{"command": "batch_stats"} returns the batch sizes of the first module forwards
+            if data.get("command") == "batch_stats":
+                await websocket.send(json.dumps({"status": "success", "batch_stats": get_micro_batch_stats()}))
+                continue
+            if data.get("command") == "resegment":
+                response = await run_in_executor(handle_resegment_message, data)
+                await websocket.send(response if isinstance(response, bytes) else json.dumps(response))
+                continue
             
             lower_scan = data.get("lower_scan")
             upper_scan = data.get("upper_scan")
             output_dir = data.get("output_dir")
+            #"preset": "accurate" | "balanced" | "fast" trades accuracy for latency, accurate if not given
+            preset = data.get("preset")
+            #"output_format": "npz" writes uint8 labels and instances instead of the json lists
+            output_format = data.get("output_format", "json")
 
-            if (lower_scan != 'null' or upper_scan != 'null') and output_dir:
+            if preset is not None and preset not in TGNET_PRESETS:
+                response = {"status": "error", "message": f"Unknown preset {preset}, one of {list(TGNET_PRESETS.keys())}."}
+            elif output_format not in ("json", "npz"):
+                response = {"status": "error", "message": f"Unknown output format {output_format}, json | npz."}
+            elif (lower_scan != 'null' or upper_scan != 'null') and output_dir:
                 try:
-                    inference_tgnet(lower_scan, upper_scan, output_dir)
+                    stage_timings = await run_in_executor(inference_tgnet, lower_scan, upper_scan, output_dir, preset, output_format)
                     response = {"status": "success", "message": "Inference completed successfully."}
+                    #"return_timing": true in the request adds the per stage timing of each scan
+                    if data.get("return_timing"):
+                        response["stage_timing"] = stage_timings
                 except Exception as e:
                     response = {"status": "error", "message": str(e)}
             else:
@@ -33,7 +143,7 @@ async def handle_connection(websocket):
         print(f"Unexpected error: {e}")
 
 async def main():
-    async with websockets.serve(handle_connection, "localhost", 8800):
+    async with websockets.serve(handle_connection, "localhost", 8800, max_size=MAX_MESSAGE_SIZE):
         print("WebSocket server started on ws://localhost:8800")
         await asyncio.Future()  # Run forever
 
@@ -1,32 +1,107 @@
 import sys
 import os
+import json
 import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 sys.path.append(os.getcwd())
 from inference_pipelines.inference_pipeline_maker import make_inference_pipeline
 from glob import glob
 from predict_utils import ScanSegmentation
+from result_cache import ResultCache, get_model_digest
 
-def process_scan(pred_obj, scan_path, output_path, scan_type):
-    """Process a single scan"""
+#resubmitted scans(same file or upload, checkpoints and preset) return the cached result, see result_cache.py. None disables the cache.
+RESULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "result_cache")
+RESULT_CACHE_MAX_BYTES = 2**30
+#first module forwards of concurrent requests are batched, see micro_batcher.py. None runs each scan alone.
+MICRO_BATCH = {"max_batch": 4, "max_wait_ms": 10}
+pred_obj_lock = threading.Lock()
+shared_pred_obj = None
+
+def process_scan(pred_obj, scan_path, output_path, scan_type, preset=None, output_format="json"):
+    """Process a single scan, returns the stage timing(see stage_timer.py) or None on error"""
     try:
         print(f"Processing {scan_type} Scan: {scan_path}")
-        pred_obj.process(scan_path, output_path, scan_type)
+        stage_timing = pred_obj.process(scan_path, output_path, scan_type, preset, output_format)
         print(f"Completed {scan_type} Scan: {scan_path}")
-        return True
+        #one json line per scan for the log collectors
+        print(json.dumps({"event": "stage_timing", "scan_type": scan_type, **stage_timing}))
+        return stage_timing
     except Exception as e:
         print(f"Error processing {scan_type} scan {scan_path}: {str(e)}")
-        return False
+        return None
+
+def segment_scan(pred_obj, mesh, scan_type, preset=None, keep_context=False):
+    """Segment an uploaded mesh((vertices, faces) arrays), returns the result of ScanSegmentation.segment or None on error"""
+    try:
+        print(f"Processing uploaded {scan_type} mesh: {mesh[0].shape[0]} vertices")
+        result = pred_obj.segment(mesh, scan_type, preset, keep_context=keep_context)
+        print(json.dumps({"event": "stage_timing", "scan_type": scan_type, **result["stage_timing"]}))
+        return result
+    except Exception as e:
+        print(f"Error processing uploaded {scan_type} mesh: {str(e)}")
+        return None
 
-def inference_tgnet(lower_scan, upper_scan, output_dir):
-    dir_path = os.path.dirname(os.path.realpath(__file__))
+def make_pred_obj():
+    """the prediction object is built on the first request and shared by the later ones, so that they share the result cache"""
+    global shared_pred_obj
+    with pred_obj_lock:
+        if shared_pred_obj is not None:
+            return shared_pred_obj
+        dir_path = os.path.dirname(os.path.realpath(__file__))
 
-    model_name = "tgnet"
-    checkpoint_path = os.path.join(dir_path, "ckpts\\tgnet_fps")
-    checkpoint_path_bdl = os.path.join(dir_path, "ckpts\\tgnet_bdl")
-    
-    # Create prediction object
-    pred_obj = ScanSegmentation(make_inference_pipeline(model_name, [checkpoint_path+".h5", checkpoint_path_bdl+".h5"]))
+        model_name = "tgnet"
+        checkpoint_path = os.path.join(dir_path, "ckpts\\tgnet_fps")
+        checkpoint_path_bdl = os.path.join(dir_path, "ckpts\\tgnet_bdl")
+        
+        # Create prediction object
+        pipeline = make_inference_pipeline(model_name, [checkpoint_path+".h5", checkpoint_path_bdl+".h5"], micro_batch=MICRO_BATCH)
+        result_cache = None
+        if RESULT_CACHE_DIR is not None:
+            result_cache = ResultCache(RESULT_CACHE_DIR, get_model_digest(pipeline.config), RESULT_CACHE_MAX_BYTES)
+        shared_pred_obj = ScanSegmentation(pipeline, result_cache)
+        return shared_pred_obj
+
+def get_result_cache_stats():
+    """hit/miss/coalesced counts and the size of the result cache, None before the first request or without a cache"""
+    if shared_pred_obj is None or shared_pred_obj.result_cache is None:
+        return None
+    return shared_pred_obj.result_cache.get_stats()
+
+def get_micro_batch_stats():
+    """number and sizes of the batched first module forwards, None before the first request or without micro batching"""
+    if shared_pred_obj is None:
+        return None
+    return shared_pred_obj.chl_pipeline.get_micro_batch_stats()
+
+def segment_meshes(meshes, preset=None, keep_context=False):
+    """
+    meshes: {scan_type: (vertices (n, 3), faces (m, 3))}, eg: decoded by mesh_protocol.decode_mesh_request. nothing is written to disk.
+    keep_context: the results can be edited with resegment_scan
+    returns {scan_type: {"labels", "instances", "braces_location", "stage_timing"}, and "context_id" with keep_context}, None if the scan failed
+    """
+    pred_obj = make_pred_obj()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {scan_type: executor.submit(segment_scan, pred_obj, mesh, scan_type, preset, keep_context) for scan_type, mesh in meshes.items()}
+        return {scan_type: future.result() for scan_type, future in futures.items()}
+
+def resegment_scan(context_id, vertex_ids=None, label=None, instance=None):
+    """
+    incremental re-segmentation after a clinician edit of a result segmented with keep_context, see ScanSegmentation.resegment
+    vertex_ids, label: vertices painted as tooth label(fdi, 0 is the gingiva). instance, label: a whole instance relabeled.
+    returns {"labels", "instances", "braces_location", "touched", "stage_timing"}
+    """
+    pred_obj = make_pred_obj()
+    result = pred_obj.resegment(context_id, vertex_ids=vertex_ids, label=label, instance=instance)
+    print(json.dumps({"event": "stage_timing", "context_id": context_id, "touched": result["touched"], **result["stage_timing"]}))
+    return result
+
+def inference_tgnet(lower_scan, upper_scan, output_dir, preset=None, output_format="json"):
+    """
+    preset: accurate | balanced | fast, see TGNET_PRESETS in inference_pipeline_maker.py. None is accurate.
+    output_format: json | npz, the file format of the labels and instances, see ScanSegmentation.write_output
+    returns {scan_type: stage timing}, the stage timing is None if the scan failed
+    """
+    pred_obj = make_pred_obj()
     os.makedirs(output_dir, exist_ok=True)
 
     # Prepare scan processing tasks
@@ -34,11 +109,11 @@ def inference_tgnet(lower_scan, upper_scan, output_dir):
     
     if lower_scan != 'null':
         lower_output = os.path.join(output_dir, os.path.basename(lower_scan).replace(".stl", "_labels.json"))
-        tasks.append((pred_obj, lower_scan, lower_output, "lower"))
+        tasks.append((pred_obj, lower_scan, lower_output, "lower", preset, output_format))
     
     if upper_scan != 'null':
         upper_output = os.path.join(output_dir, os.path.basename(upper_scan).replace(".stl", "_labels.json"))
-        tasks.append((pred_obj, upper_scan, upper_output, "upper"))
+        tasks.append((pred_obj, upper_scan, upper_output, "upper", preset, output_format))
     
     # Process scans concurrently
     if tasks:
@@ -58,12 +133,20 @@ def inference_tgnet(lower_scan, upper_scan, output_dir):
                     results[scan_type] = future.result()
                 except Exception as e:
                     print(f"Exception occurred for {scan_type} scan: {str(e)}")
-                    results[scan_type] = False
+                    results[scan_type] = None
         
         # Print summary
         print("\nProcessing Summary:")
-        for scan_type, success in results.items():
-            status = "SUCCESS" if success else "FAILED"
+        for scan_type, stage_timing in results.items():
+            status = f"SUCCESS({stage_timing['total_wall_ms']/1000:.1f}s)" if stage_timing is not None else "FAILED"
+            if stage_timing is not None and stage_timing.get("early_exit", {}).get("skipped"):
+                status += ", boundary module skipped"
+            if stage_timing is not None and stage_timing.get("result_cache") in ("hit", "coalesced"):
+                status += f", cached result({stage_timing['result_cache']})"
+            if stage_timing is not None and stage_timing.get("first_forward_batch_size", 1) > 1:
+                status += f", first forward batched with {stage_timing['first_forward_batch_size']-1} other scan(s)"
             print(f"  {scan_type.upper()} scan: {status}")
+        return results
     else:
         print("No valid scans to process.")
+        return {}
@@ -0,0 +1,38 @@
+import importlib
+
+class LazyImport:
+    """
+    stands in for a module(or an attribute of a module, eg: a class), the module is imported on the first use.
+    usage:
+        o3d = lazy_import("open3d")
+        KDTree = lazy_import("sklearn.neighbors", "KDTree")
+    importlib.import_module holds the import lock, so the first use from several threads imports the module once.
+    """
+    def __init__(self, module_name, attr=None):
+        self._module_name = module_name
+        self._attr = attr
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            if self._attr is not None:
+                target = getattr(target, self._attr)
+            self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        #only reached before __init__ ran(eg: copy, pickle)
+        if name in ("_module_name", "_attr", "_target"):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self._module_name if self._attr is None else f"{self._module_name}.{self._attr}"
+        return f"<lazy {name}, {'loaded' if self._target is not None else 'not loaded'}>"
+
+def lazy_import(module_name, attr=None):
+    return LazyImport(module_name, attr)
@@ -1,4 +1,5 @@
 import gen_utils as gu
+from dist_utils import all_reduce_sum_dict
 class LossMeter:
     def __init__(self):
         self.loss_meter_dict = {
@@ -19,6 +20,10 @@ class LossMeter:
             avg_loss_meter_dict[key] = self.loss_meter_dict[key] / self.step_num
         return avg_loss_meter_dict
 
+    def all_reduce(self):
+        """sum the meters of every training process, so every process gets the same averages"""
+        self.loss_meter_dict, self.step_num = all_reduce_sum_dict(self.loss_meter_dict, self.step_num)
+
     def init(self):
         self.step_num = 0
         self.loss_meter_dict = {}
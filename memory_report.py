@@ -0,0 +1,79 @@
+import argparse
+import copy
+import importlib.util
+import time
+import numpy as np
+import torch
+from models.modules.cbl_point_transformer.cbl_point_transformer_module import StageMemoryMeter
+
+parser = argparse.ArgumentParser(description='Per stage memory report of the tgnet point transformer backbone')
+parser.add_argument('--config_path', default="train_configs/tgnet_fps.py", type=str, help = "train config file path.")
+parser.add_argument('--device', default="cuda" if torch.cuda.is_available() else "cpu", type=str, help = "cuda | cpu")
+parser.add_argument('--num_points', default=24000, type=int, help = "number of points of each synthetic scan.")
+parser.add_argument('--batch_size', default=1, type=int, help = "number of synthetic scans in a batch.")
+parser.add_argument('--crop_sample_size', default=None, type=int, help = "points of each tooth crop. default is the config value, it must not exceed num_points.")
+parser.add_argument('--grad_checkpoint', action='store_true', help = "recompute each encoder/decoder stage in backward.")
+parser.add_argument('--mixed_precision', default=None, type=str, help = "None | bf16")
+
+def load_config(args):
+    spec = importlib.util.spec_from_file_location("module.name", args.config_path)
+    loaded_model_config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(loaded_model_config)
+    config = copy.deepcopy(loaded_model_config.config)
+    config["model_parameter"]["grad_checkpoint"] = args.grad_checkpoint
+    config["tr_set"]["mixed_precision"] = args.mixed_precision
+    if args.crop_sample_size is not None:
+        config["model_parameter"]["crop_sample_size"] = args.crop_sample_size
+    config["checkpoint"] = {"async_save": False}
+    config["checkpoint_path"] = "memory_report"
+    config["device"] = args.device
+    return config
+
+def make_synthetic_batch(batch_size, num_points):
+    """scans with 8 teeth along the x axis and gingiva(-1) around them"""
+    feats, labels = [], []
+    for _ in range(batch_size):
+        xyz = np.random.rand(num_points, 3).astype(np.float32)*2-1
+        label = np.floor((xyz[:, 0]+1)*4).astype(np.int64)
+        label[np.random.rand(num_points)<0.3] = -1
+        feats.append(np.concatenate([xyz, np.random.rand(num_points, 3).astype(np.float32)], axis=1).T)
+        labels.append(label.reshape(1, -1))
+    return {
+        "feat": torch.from_numpy(np.stack(feats)),
+        "gt_seg_label": torch.from_numpy(np.stack(labels)),
+    }
+
+def print_report(name, meter):
+    print(name)
+    print(f"    {'stage':<8}{'saved for backward(MB)':>24}{'cuda peak(MB)':>16}")
+    for stage_name, stat in meter.stats.items():
+        print(f"    {stage_name:<8}{stat['saved_mb']:>24.1f}{stat['peak_mb']:>16.1f}")
+    print(f"    {'total':<8}{sum(stat['saved_mb'] for stat in meter.stats.values()):>24.1f}")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    config = load_config(args)
+    from models.fps_grouping_network_model import FpsGroupingNetworkModel
+    from models.modules.grouping_network_module import GroupingNetworkModule
+    model = FpsGroupingNetworkModel(config, GroupingNetworkModule)
+
+    meters = {
+        "first_ins_cent_model": StageMemoryMeter(),
+        "second_ins_cent_model": StageMemoryMeter(),
+    }
+    for name, meter in meters.items():
+        getattr(model.module, name).memory_meter = meter
+
+    device = torch.device(args.device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.time()
+    loss = model.step(0, make_synthetic_batch(args.batch_size, args.num_points), "train")
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    print(f"grad_checkpoint: {args.grad_checkpoint}, mixed_precision: {args.mixed_precision}, batch_size: {args.batch_size}, num_points: {args.num_points}")
+    print(f"train step: {time.time()-start:.2f}s")
+    for name, meter in meters.items():
+        print_report(name, meter)
+    if device.type == "cuda":
+        print(f"cuda peak of the whole step(MB): {torch.cuda.max_memory_allocated(device) / 2**20:.1f}")
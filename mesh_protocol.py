@@ -0,0 +1,200 @@
+import gzip
+import json
+import struct
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    #gzip and uncompressed meshes still work
+    zstandard = None
+
+#binary mesh request of inference_server, sent as one binary websocket message:
+#    header length(uint32, little endian) | header(utf-8 json) | payload
+#the header has the fields of the json request(preset, return_timing, ...) and
+#    "meshes": {scan_type: {"num_vertices", "num_faces", "compression", "offset", "size"}}
+#each mesh is size bytes at offset from the payload start: float32 vertices (num_vertices, 3) then int32 faces (num_faces, 3), little endian.
+#with compression gzip | zstd the bytes of a mesh are compressed as a whole.
+#
+#binary results of inference_server use the same framing, the header has the fields of the json response and
+#    "results": {scan_type: {"num_vertices", "labels": {"encoding", "compression", "offset", "size"}, "instances": {...}, "braces_location", ...}}
+#labels and instances are uint8 per vertex, encoded as
+#    raw => (num_vertices) uint8
+#    rle => (num_runs) uint8 run values then (num_runs) uint32 run lengths, little endian
+COMPRESSIONS = [None, "gzip", "zstd"]
+LABEL_ENCODINGS = ["raw", "rle"]
+HEADER_LENGTH = struct.Struct("<I")
+
+def compress(data, compression):
+    if compression is None:
+        return data
+    elif compression == "gzip":
+        return gzip.compress(data, compresslevel=1)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"unknown compression {compression}, one of {COMPRESSIONS}")
+
+def decompress(data, compression):
+    if compression is None:
+        return data
+    elif compression == "gzip":
+        return gzip.decompress(data)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"unknown compression {compression}, one of {COMPRESSIONS}")
+
+def encode_mesh_request(meshes, compression=None, **fields):
+    """
+    meshes: {scan_type: (vertices (n, 3), faces (m, 3))}, eg: {"lower": (np.asarray(mesh.vertices), np.asarray(mesh.triangles))}
+    fields: other request fields, eg: preset="fast", return_timing=True
+    output: bytes of the message
+    """
+    header = dict(fields)
+    header["meshes"] = {}
+    chunks = []
+    offset = 0
+    for scan_type, (vertices, faces) in meshes.items():
+        vertices = np.ascontiguousarray(vertices, dtype="<f4").reshape(-1, 3)
+        faces = np.ascontiguousarray(faces, dtype="<i4").reshape(-1, 3)
+        data = compress(vertices.tobytes() + faces.tobytes(), compression)
+        header["meshes"][scan_type] = {
+            "num_vertices": vertices.shape[0],
+            "num_faces": faces.shape[0],
+            "compression": compression,
+            "offset": offset,
+            "size": len(data),
+        }
+        chunks.append(data)
+        offset += len(data)
+    header_bytes = json.dumps(header).encode("utf-8")
+    return b"".join([HEADER_LENGTH.pack(len(header_bytes)), header_bytes] + chunks)
+
+def decode_mesh_request(message):
+    """
+    input: bytes of a message made by encode_mesh_request
+    output:
+        header => dict of the request fields, "meshes" is the mesh layout
+        meshes => {scan_type: (vertices (n, 3) float32, faces (m, 3) int32)}. uncompressed arrays are read only views of message, not copies.
+    """
+    message = memoryview(message)
+    if len(message) < HEADER_LENGTH.size:
+        raise ValueError("mesh message is too short")
+    header_length, = HEADER_LENGTH.unpack_from(message)
+    payload_start = HEADER_LENGTH.size + header_length
+    if len(message) < payload_start:
+        raise ValueError("mesh message is shorter than its header length")
+    header = json.loads(bytes(message[HEADER_LENGTH.size:payload_start]).decode("utf-8"))
+
+    meshes = {}
+    for scan_type, info in header.get("meshes", {}).items():
+        start = payload_start + info["offset"]
+        if info["offset"] < 0 or start + info["size"] > len(message):
+            raise ValueError(f"{scan_type} mesh is out of the message")
+        data = message[start:start + info["size"]]
+        if info.get("compression") is not None:
+            data = decompress(data, info["compression"])
+        num_vertices, num_faces = info["num_vertices"], info["num_faces"]
+        if len(data) != (num_vertices + num_faces) * 12:
+            raise ValueError(f"{scan_type} mesh has {len(data)} bytes, {(num_vertices + num_faces) * 12} expected")
+        vertices = np.frombuffer(data, dtype="<f4", count=num_vertices*3).reshape(-1, 3)
+        faces = np.frombuffer(data, dtype="<i4", count=num_faces*3, offset=num_vertices*12).reshape(-1, 3)
+        if num_faces > 0 and (faces.min() < 0 or faces.max() >= num_vertices):
+            raise ValueError(f"{scan_type} mesh has face indexes out of its vertices")
+        meshes[scan_type] = (vertices, faces)
+    return header, meshes
+
+def as_uint8_labels(values):
+    """per vertex labels or instances as uint8, fdi labels(<= 48) and instance ids of a jaw fit in it"""
+    values = np.asarray(values).reshape(-1)
+    if values.size > 0 and (values.min() < 0 or values.max() > 255):
+        raise ValueError(f"labels out of the uint8 range: {values.min()} ~ {values.max()}")
+    return values.astype(np.uint8)
+
+def encode_labels(values):
+    """
+    input: per vertex labels or instances
+    output: encoding, bytes. rle unless the runs are larger than the raw array, eg: when the vertex order is scattered
+    """
+    values = as_uint8_labels(values)
+    run_starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]])) if values.size > 0 else np.zeros(0, dtype=int)
+    if run_starts.shape[0] * 5 >= values.shape[0]:
+        return "raw", values.tobytes()
+    run_lengths = np.diff(np.append(run_starts, values.shape[0])).astype("<u4")
+    return "rle", values[run_starts].tobytes() + run_lengths.tobytes()
+
+def decode_labels(data, encoding, num_vertices):
+    """output: (num_vertices) uint8"""
+    if encoding == "raw":
+        values = np.frombuffer(data, dtype=np.uint8)
+    elif encoding == "rle":
+        if len(data) % 5 != 0:
+            raise ValueError(f"rle labels have {len(data)} bytes, not a multiple of 5")
+        num_runs = len(data) // 5
+        run_lengths = np.frombuffer(data, dtype="<u4", count=num_runs, offset=num_runs)
+        values = np.repeat(np.frombuffer(data, dtype=np.uint8, count=num_runs), run_lengths)
+    else:
+        raise ValueError(f"unknown label encoding {encoding}, one of {LABEL_ENCODINGS}")
+    if values.shape[0] != num_vertices:
+        raise ValueError(f"{values.shape[0]} labels decoded, {num_vertices} expected")
+    return values
+
+def encode_result_message(results, compression=None, **fields):
+    """
+    results: {scan_type: {"labels", "instances", other json fields(braces_location, stage_timing, ...)}}, None for a failed scan
+    fields: other response fields, eg: status="success"
+    output: bytes of the message
+    """
+    header = dict(fields)
+    header["results"] = {}
+    chunks = []
+    offset = 0
+    for scan_type, result in results.items():
+        if result is None:
+            header["results"][scan_type] = None
+            continue
+        info = {key: value for key, value in result.items() if key not in ("labels", "instances")}
+        info["num_vertices"] = len(result["labels"])
+        for key in ("labels", "instances"):
+            encoding, data = encode_labels(result[key])
+            data = compress(data, compression)
+            info[key] = {"encoding": encoding, "compression": compression, "offset": offset, "size": len(data)}
+            chunks.append(data)
+            offset += len(data)
+        header["results"][scan_type] = info
+    header_bytes = json.dumps(header).encode("utf-8")
+    return b"".join([HEADER_LENGTH.pack(len(header_bytes)), header_bytes] + chunks)
+
+def decode_result_message(message):
+    """
+    input: bytes of a message made by encode_result_message
+    output: header, {scan_type: {"labels" (n) uint8, "instances" (n) uint8, other json fields}}, None for a failed scan
+    """
+    message = memoryview(message)
+    if len(message) < HEADER_LENGTH.size:
+        raise ValueError("result message is too short")
+    header_length, = HEADER_LENGTH.unpack_from(message)
+    payload_start = HEADER_LENGTH.size + header_length
+    if len(message) < payload_start:
+        raise ValueError("result message is shorter than its header length")
+    header = json.loads(bytes(message[HEADER_LENGTH.size:payload_start]).decode("utf-8"))
+
+    results = {}
+    for scan_type, info in header.get("results", {}).items():
+        if info is None:
+            results[scan_type] = None
+            continue
+        result = {key: value for key, value in info.items() if key not in ("labels", "instances", "num_vertices")}
+        for key in ("labels", "instances"):
+            start = payload_start + info[key]["offset"]
+            if info[key]["offset"] < 0 or start + info[key]["size"] > len(message):
+                raise ValueError(f"{scan_type} {key} are out of the message")
+            data = message[start:start + info[key]["size"]]
+            if info[key].get("compression") is not None:
+                data = decompress(data, info[key]["compression"])
+            result[key] = decode_labels(data, info[key]["encoding"], info["num_vertices"])
+        results[scan_type] = result
+    return header, results
@@ -0,0 +1,108 @@
+import contextlib
+import threading
+import time
+from concurrent.futures import Future
+
+class MicroBatcher:
+    """
+    runs the calls of concurrent requests in batches: run_batch(key, items) => one output per item.
+    a batch has the calls of one key(eg: settings that can not be mixed in a batch), up to max_batch of them.
+    it waits up to max_wait_ms for more calls, but only while other tracked requests have not called yet, so a lone request is not delayed(also not by requests that are past their call).
+    one batch runs at a time, the calls that arrive meanwhile form the next one.
+    usage:
+        batcher = MicroBatcher(run_batch, max_batch=4, max_wait_ms=10)
+        with batcher.track():   #around each whole request, it makes one call in the same thread
+            ...
+            output, batch_size = batcher(key, item)
+    """
+    def __init__(self, run_batch, max_batch=4, max_wait_ms=10.0):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.condition = threading.Condition()
+        #(key, item, future) of the calls that wait for a batch
+        self.pending = []
+        self.running = False
+        #tracked requests that have not called yet
+        self.expected = 0
+        #whether the tracked request of this thread has not called yet
+        self.local = threading.local()
+        self.stats = {"batches": 0, "items": 0, "max_batch_size": 0}
+
+    @contextlib.contextmanager
+    def track(self):
+        with self.condition:
+            self.expected += 1
+        self.local.expected = True
+        try:
+            yield
+        finally:
+            #a request that failed before its call
+            self.stop_expecting()
+
+    def stop_expecting(self):
+        if getattr(self.local, "expected", False):
+            self.local.expected = False
+            with self.condition:
+                self.expected -= 1
+                self.condition.notify_all()
+
+    def __call__(self, key, item):
+        """returns the output of item, the size of the batch it ran in"""
+        future = Future()
+        with self.condition:
+            self.pending.append((key, item, future))
+            if getattr(self.local, "expected", False):
+                self.local.expected = False
+                self.expected -= 1
+            self.condition.notify_all()
+        #the calls take turns running the next batch until their own output is ready
+        while True:
+            with self.condition:
+                while self.running and not future.done():
+                    self.condition.wait()
+                if future.done():
+                    break
+                self.running = True
+                batch = self.take_batch()
+            try:
+                self.run(batch)
+            finally:
+                with self.condition:
+                    self.running = False
+                    self.condition.notify_all()
+        return future.result()
+
+    def take_batch(self):
+        """called with the lock held. the calls of the oldest key, after the batch window"""
+        key = self.pending[0][0]
+        deadline = time.perf_counter() + self.max_wait
+        while True:
+            batch = [entry for entry in self.pending if entry[0] == key][:self.max_batch]
+            remaining = deadline - time.perf_counter()
+            #no tracked request is still on its way to a call
+            if len(batch) >= self.max_batch or self.expected <= 0 or remaining <= 0:
+                break
+            self.condition.wait(remaining)
+        batch_ids = set(id(entry) for entry in batch)
+        self.pending = [entry for entry in self.pending if id(entry) not in batch_ids]
+        return batch
+
+    def run(self, batch):
+        try:
+            outputs = self.run_batch(batch[0][0], [item for _, item, _ in batch])
+            for (_, _, future), output in zip(batch, outputs):
+                future.set_result((output, len(batch)))
+        except BaseException as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+        with self.condition:
+            self.stats["batches"] += 1
+            self.stats["items"] += len(batch)
+            self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+        stats["mean_batch_size"] = stats["items"] / stats["batches"] if stats["batches"] > 0 else None
+        return stats
@@ -1,17 +1,30 @@
 from abc import *
-from this import d
 import torch
 from torch.optim.lr_scheduler import ExponentialLR
 import os
 import copy
+import contextlib
 from external_libs.scheduler import build_scheduler_from_cfg
+from checkpointer import AsyncCheckpointer, get_rng_state, set_rng_state, reseed_rng
+from dist_utils import is_distributed, is_main_process, get_rank, all_gather_object
+from torch.nn.parallel import DistributedDataParallel
 class BaseModel(metaclass=ABCMeta):
     def __init__(self, config, module):
         self.config = config
 
+        self.device = torch.device(self.config.get("device", "cuda"))
         self.module = module(config)
         self.module.train()
-        self.module.cuda()
+        self.module.to(self.device)
+        #forward_module is what step() calls. with several processes it syncs the gradients in backward,
+        #while self.module stays unwrapped so the saved state_dict keys do not change.
+        self.forward_module = self.module
+        if is_distributed():
+            self.forward_module = DistributedDataParallel(
+                self.module,
+                device_ids=[self.device.index] if self.device.type == "cuda" else None,
+                find_unused_parameters=True,
+            )
 
         if self.config["tr_set"]["optimizer"]["NAME"] == "sgd":
             self.optimizer = torch.optim.SGD(self.module.parameters(), lr=self.config["tr_set"]["optimizer"]["lr"], momentum=self.config["tr_set"]["optimizer"]["momentum"], weight_decay=self.config["tr_set"]["optimizer"]["weight_decay"])
@@ -27,6 +40,31 @@ class BaseModel(metaclass=ABCMeta):
             sched_config["tr_set"]["scheduler"]["min_lr"] = self.config["tr_set"]["scheduler"]["min_lr"]
             self.scheduler = build_scheduler_from_cfg(sched_config["tr_set"]["scheduler"], self.optimizer)
 
+        self.checkpointer = AsyncCheckpointer(self.config.get("checkpoint", {}).get("async_save", True))
+
+    def autocast(self):
+        """
+        mixed precision context for the forward pass. config["tr_set"]["mixed_precision"]: None | "bf16"
+        bf16 keeps the float32 exponent range, so no loss scaling is needed and it also works on cpu.
+        """
+        mixed_precision = self.config["tr_set"].get("mixed_precision")
+        if mixed_precision is None:
+            return contextlib.nullcontext()
+        elif mixed_precision == "bf16":
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        else:
+            raise "mixed_precision is something unknown"
+
+    def float_outputs(self, output):
+        """losses are computed in float32 outside of autocast"""
+        if type(output) == torch.Tensor:
+            return output.float() if output.is_floating_point() else output
+        elif type(output) == dict:
+            return {key: self.float_outputs(value) for key, value in output.items()}
+        elif type(output) in (list, tuple):
+            return type(output)(self.float_outputs(value) for value in output)
+        return output
+
     def _set_model(self, phase):
         if phase=="train":
             self.module.train()
@@ -37,15 +75,57 @@ class BaseModel(metaclass=ABCMeta):
         self.module.load_state_dict(torch.load(self.config["checkpoint_path"]+".h5"))
 
     def save(self, phase):
-        if not os.path.exists(os.path.dirname(self.config["checkpoint_path"])):
-            os.makedirs(os.path.dirname(self.config["checkpoint_path"]), exist_ok=True)
-        
         if phase=="train":
-            torch.save(self.module.state_dict(), self.config["checkpoint_path"]+".h5")
+            path = self.config["checkpoint_path"]+".h5"
         elif phase=="val":
-            torch.save(self.module.state_dict(), self.config["checkpoint_path"]+"_val.h5")
+            path = self.config["checkpoint_path"]+"_val.h5"
         else:
             raise "phase is something unknown"
+        self.checkpointer.save({path: self.module.state_dict()})
+
+    def get_training_state_path(self):
+        return self.config["checkpoint_path"]+"_state.pth"
+
+    def save_training_state(self, trainer_state):
+        """
+        save everything needed to resume training - weights, optimizer, scheduler, rng and the trainer counters.
+        trainer_state: dict from Trainer.get_state()
+        with several processes every one of them calls it: the rng states(python, numpy, torch, cuda) of all ranks are gathered as a list in rank order,
+        so that each rank resumes its own stream(augmentation, dataloader worker seeds). only the main process writes the file.
+        """
+        rng_states = all_gather_object(get_rng_state())
+        if not is_main_process():
+            return
+        state = {
+            "module": self.module.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "rng": rng_states,
+            "trainer": trainer_state,
+        }
+        self.checkpointer.save({self.get_training_state_path(): state})
+
+    def load_training_state(self, path):
+        """
+        output: trainer state dict saved by save_training_state
+        """
+        state = torch.load(path, map_location=self.device, weights_only=False)
+        self.module.load_state_dict(state["module"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.scheduler.load_state_dict(state["scheduler"])
+        rng_states, rank = state["rng"], get_rank()
+        if isinstance(rng_states, list) and rank < len(rng_states):
+            set_rng_state(rng_states[rank])
+        else:
+            #a single rng state(older checkpoints) or a run with more processes than the saved one:
+            #the saved first state, then the other ranks get distinct streams seeded from it
+            set_rng_state(rng_states[0] if isinstance(rng_states, list) else rng_states)
+            if rank > 0:
+                reseed_rng(int(torch.randint(2**31, ())) + rank)
+        return state["trainer"]
+
+    def wait_for_checkpoints(self):
+        self.checkpointer.wait()
 
     @abstractmethod
     def get_loss(self):
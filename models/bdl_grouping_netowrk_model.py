@@ -14,8 +14,8 @@ class BdlGroupingNetworkModel(BaseModel):
     def __init__(self, config, model):
         super().__init__(config, model)
         self.base_model = GroupingNetworkModule(config["fps_model_info"])
-        self.base_model.load_state_dict(torch.load(self.config["fps_model_info"]["load_ckpt_path"]+".h5"))
-        self.base_model.cuda()
+        self.base_model.load_state_dict(torch.load(self.config["fps_model_info"]["load_ckpt_path"]+".h5", map_location=self.device))
+        self.base_model.to(self.device)
 
         self.stl_path_map = {}
         for dir_path in [
@@ -34,7 +34,7 @@ class BdlGroupingNetworkModel(BaseModel):
         self.Y_AXIS_MAX = 33.15232091532151
         self.Y_AXIS_MIN = -36.9843781139949
         
-    def get_loss(self, offset_1, offset_2, sem_1, sem_2, mask_1, mask_2, gt_seg_label_1, gt_seg_label_2, input_coords, cropped_coords):
+    def get_loss(self, offset_1, offset_2, sem_1, sem_2, mask_1, mask_2, gt_seg_label_1, gt_seg_label_2, input_coords, cropped_coords, offset=None):
         half_seg_label = gt_seg_label_1.clone()
         half_seg_label[half_seg_label>=9] -= 8
 
@@ -42,9 +42,9 @@ class BdlGroupingNetworkModel(BaseModel):
         tooth_class_loss_1 = tgn_loss.tooth_class_loss(sem_1, half_seg_label,9)
         tooth_class_loss_2 = tgn_loss.tooth_class_loss(sem_2, gt_seg_label_2,2)
 
-        offset_1_loss, offset_1_dir_loss = tgn_loss.batch_center_offset_loss(offset_1, input_coords, gt_seg_label_1)
+        offset_1_loss, offset_1_dir_loss = tgn_loss.segment_center_offset_loss(offset_1, input_coords, gt_seg_label_1, offset)
         
-        chamf_1_loss = tgn_loss.batch_chamfer_distance_loss(offset_1, input_coords, gt_seg_label_1)
+        chamf_1_loss = tgn_loss.segment_chamfer_distance_loss(offset_1, input_coords, gt_seg_label_1, offset)
         return {
             "tooth_class_loss_1": (tooth_class_loss_1, self.config["tr_set"]["loss"]["tooth_class_loss_1"]),
             "tooth_class_loss_2": (tooth_class_loss_2, self.config["tr_set"]["loss"]["tooth_class_loss_2"]),
@@ -63,8 +63,8 @@ class BdlGroupingNetworkModel(BaseModel):
         Returns:
             labels: N
         """
-        points = batch_item["feat"].cuda()
-        seg_label = batch_item["gt_seg_label"].cuda()
+        points = batch_item["feat"].to(self.device)
+        seg_label = batch_item["gt_seg_label"].to(self.device)
         gt_seg_label = gu.torch_to_numpy(batch_item["gt_seg_label"])
         with torch.no_grad():
             output = self.base_model([points, seg_label])
@@ -73,8 +73,8 @@ class BdlGroupingNetworkModel(BaseModel):
         crop_num = output["sem_2"].shape[0]
         org_xyz_cpu = gu.torch_to_numpy(points)[0,:3,:].T
 
-        whole_pd_mask_2 = torch.zeros((points.shape[2], 2)).cuda()
-        whole_pd_mask_count_2 = torch.zeros(points.shape[2]).cuda()
+        whole_pd_mask_2 = torch.zeros((points.shape[2], 2)).to(self.device)
+        whole_pd_mask_count_2 = torch.zeros(points.shape[2]).to(self.device)
         for crop_idx in range(crop_num):
             pd_mask = output["sem_2"][crop_idx, :, :].permute(1,0) # 3072,17
             inside_crop_idx = output["nn_crop_indexes"][0][crop_idx]
@@ -195,18 +195,26 @@ class BdlGroupingNetworkModel(BaseModel):
     def step(self, batch_idx, batch_item, phase):
         self._set_model(phase)
 
-        points, seg_label = self.get_boundary_sampled_points(batch_item)
+        points_ls, seg_label_ls = [], []
+        for b_idx in range(len(batch_item["mesh_path"])):
+            b_points, b_seg_label = self.get_boundary_sampled_points(gu.get_batch_item(batch_item, b_idx))
+            points_ls.append(b_points[0])
+            seg_label_ls.append(b_seg_label[0])
+        points, offset = gu.stack_point_tensors(points_ls)
+        seg_label, _ = gu.stack_point_tensors(seg_label_ls)
 
-        points = points.cuda()
-        l0_xyz = points[:,:3,:].cuda()
+        points = points.to(self.device)
+        l0_xyz = points[:,:3,:].to(self.device)
         
-        seg_label = seg_label.cuda()
+        seg_label = seg_label.to(self.device)
         
         if phase == "train":
-            output = self.module([points, seg_label])
+            with self.autocast():
+                output = self.forward_module([points, seg_label], offset=offset)
         else:
-            with torch.no_grad():
-                output = self.module([points, seg_label])
+            with torch.no_grad(), self.autocast():
+                output = self.forward_module([points, seg_label], offset=offset)
+        output = self.float_outputs(output)
         loss_meter = LossMap()
         
         loss_meter.add_loss_by_dict(self.get_loss(
@@ -219,7 +227,8 @@ class BdlGroupingNetworkModel(BaseModel):
             seg_label, 
             output["cluster_gt_seg_label"], 
             l0_xyz, 
-            output["cropped_feature_ls"][:,:3,:]
+            output["cropped_feature_ls"][:,:3,:],
+            offset
             )
         )
         
@@ -4,7 +4,7 @@ from models.base_model import BaseModel
 from loss_meter import LossMap
 
 class FpsGroupingNetworkModel(BaseModel):
-    def get_loss(self, offset_1, offset_2, sem_1, sem_2, mask_1, mask_2, gt_seg_label_1, gt_seg_label_2, input_coords, cropped_coords):
+    def get_loss(self, offset_1, offset_2, sem_1, sem_2, mask_1, mask_2, gt_seg_label_1, gt_seg_label_2, input_coords, cropped_coords, offset=None):
         half_seg_label = gt_seg_label_1.clone()
         half_seg_label[half_seg_label>=9] -= 8
 
@@ -12,9 +12,9 @@ class FpsGroupingNetworkModel(BaseModel):
         tooth_class_loss_1 = tgn_loss.tooth_class_loss(sem_1, half_seg_label, 9)
         tooth_class_loss_2 = tgn_loss.tooth_class_loss(sem_2, gt_seg_label_2, 2)
 
-        offset_1_loss, offset_1_dir_loss = tgn_loss.batch_center_offset_loss(offset_1, input_coords, gt_seg_label_1)
+        offset_1_loss, offset_1_dir_loss = tgn_loss.segment_center_offset_loss(offset_1, input_coords, gt_seg_label_1, offset)
         
-        chamf_1_loss = tgn_loss.batch_chamfer_distance_loss(offset_1, input_coords, gt_seg_label_1)
+        chamf_1_loss = tgn_loss.segment_chamfer_distance_loss(offset_1, input_coords, gt_seg_label_1, offset)
         return {
             "tooth_class_loss_1": (tooth_class_loss_1, self.config["tr_set"]["loss"]["tooth_class_loss_1"]),
             "tooth_class_loss_2": (tooth_class_loss_2, self.config["tr_set"]["loss"]["tooth_class_loss_2"]),
@@ -26,18 +26,21 @@ class FpsGroupingNetworkModel(BaseModel):
     def step(self, batch_idx, batch_item, phase):
         self._set_model(phase)
 
-        points = batch_item["feat"].cuda()
-        l0_xyz = batch_item["feat"][:,:3,:].cuda()
+        points = batch_item["feat"].to(self.device)
+        l0_xyz = batch_item["feat"][:,:3,:].to(self.device)
         
-        seg_label = batch_item["gt_seg_label"].cuda()
+        seg_label = batch_item["gt_seg_label"].to(self.device)
+        offset = batch_item.get("offset")
         
         inputs = [points, seg_label]
 
         if phase == "train":
-            output = self.module(inputs)
+            with self.autocast():
+                output = self.forward_module(inputs, offset=offset)
         else:
-            with torch.no_grad():
-                output = self.module(inputs)
+            with torch.no_grad(), self.autocast():
+                output = self.forward_module(inputs, offset=offset)
+        output = self.float_outputs(output)
         loss_meter = LossMap()
         
         loss_meter.add_loss_by_dict(self.get_loss(
@@ -50,7 +53,8 @@ class FpsGroupingNetworkModel(BaseModel):
             seg_label, 
             output["cluster_gt_seg_label"], 
             l0_xyz, 
-            output["cropped_feature_ls"][:,:3,:]
+            output["cropped_feature_ls"][:,:3,:],
+            offset
             )
         )
         
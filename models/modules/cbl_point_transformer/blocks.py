@@ -11,6 +11,19 @@ from .basic_operators import _eps, _inf
 from collections import defaultdict
 
 
+def get_neighbor_idx(pxo, nsample):
+    """
+    pxo can carry the knn index of its points as a 4th element. every block of a stage works on the same points, so it is computed once and reused.
+    input: pxo: [p, x, o] or [p, x, o, idx]
+    output: idx: (n, nsample)
+    """
+    idx = pxo[3] if len(pxo) > 3 else None
+    if idx is None or idx.shape[1] != nsample:
+        p, _, o = pxo[:3]
+        idx, _ = pointops.knnquery(nsample, p, p, o, o)  # (n, nsample)
+    return idx
+
+
 class PointTransformerLayer(nn.Module):
     def __init__(self, in_planes, out_planes, share_planes=8, nsample=16):
         super().__init__()
@@ -27,12 +40,32 @@ class PointTransformerLayer(nn.Module):
                                     nn.BatchNorm1d(mid_planes // share_planes), nn.ReLU(inplace=True),
                                     nn.Linear(out_planes // share_planes, out_planes // share_planes))
         self.softmax = nn.Softmax(dim=1)
+        #inference only. if set, the (n, nsample, c) intermediates are built for chunk_size points at a time
+        self.chunk_size = None
         
     def forward(self, pxo) -> torch.Tensor:
-        p, x, o = pxo  # (n, 3), (n, c), (b)
+        p, x, o = pxo[:3]  # (n, 3), (n, c), (b)
+        idx = get_neighbor_idx(pxo, self.nsample)  # (n, nsample) - shared by k and v
         x_q, x_k, x_v = self.linear_q(x), self.linear_k(x), self.linear_v(x)  # (n, c)
-        x_k = pointops.queryandgroup(self.nsample, p, p, x_k, None, o, o, use_xyz=True)  # (n, nsample, 3+c)
-        x_v = pointops.queryandgroup(self.nsample, p, p, x_v, None, o, o, use_xyz=False)  # (n, nsample, c)
+        n = p.shape[0]
+        # batch norm in eval mode is per point, so chunks give the same result. training needs the whole batch statistics.
+        if self.chunk_size is None or self.training or torch.is_grad_enabled() or n <= self.chunk_size:
+            return self.attend(p, x_q, x_k, x_v, idx, o, 0, n)
+        x = torch.empty((n, self.out_planes), dtype=x_v.dtype, device=x_v.device)
+        for start in range(0, n, self.chunk_size):
+            end = min(start + self.chunk_size, n)
+            x[start:end] = self.attend(p, x_q, x_k, x_v, idx, o, start, end)
+        return x
+
+    def attend(self, p, x_q, x_k, x_v, idx, o, start, end):
+        """
+        attention of the points start:end over their neighbors
+        input: p: (n, 3), x_q, x_k, x_v: (n, c), idx: (n, nsample)
+        output: (end-start, c)
+        """
+        new_p, idx, x_q = p[start:end], idx[start:end], x_q[start:end]
+        x_k = pointops.queryandgroup(self.nsample, p, new_p, x_k, idx, o, o, use_xyz=True)  # (m, nsample, 3+c)
+        x_v = pointops.queryandgroup(self.nsample, p, new_p, x_v, idx, o, o, use_xyz=False)  # (m, nsample, c)
         p_r, x_k = x_k[:, :, 0:3], x_k[:, :, 3:]
         # torch batch-norm should use (n, c, nsample)
         for i, layer in enumerate(self.linear_p): p_r = layer(p_r.transpose(1, 2).contiguous()).transpose(1, 2).contiguous() if i == 1 else layer(p_r)    # (n, nsample, c)
@@ -56,17 +89,32 @@ class TransitionDown(nn.Module):
         self.bn = nn.BatchNorm1d(out_planes)
         self.relu = nn.ReLU(inplace=True)
         
-    def forward(self, pxo):
+    def get_downsampled_offset(self, o_host):
+        """
+        input: o_host: [b] host side cumulative point counts
+        output: [b] cumulative point counts after this layer
+        """
+        if self.stride == 1:
+            return o_host
+        # calc the reduced size of points for the batch - n = [BxN], with each b clouds, i-th cloud containing N = b[i] points
+        n_o, count, start = [], 0, 0
+        for end in o_host:
+            count += (end - start) // self.stride
+            n_o.append(count)
+            start = end
+        return n_o
+
+    def forward(self, pxo, o_host=None):
+        """o_host: optional host side copy of o(list of int). the sampled offsets are computed from it without reading o back from the device"""
         # o - num of points in each batch - b batch together - using BxN, used for finding the points in each example
-        p, x, o = pxo  # (n, 3), (n, c), (b)
+        p, x, o = pxo[:3]  # (n, 3), (n, c), (b)
         if self.stride != 1:
-            # calc the reduced size of points for the batch - n = [BxN], with each b clouds, i-th cloud containing N = b[i] points
-            n_o, count = [o[0].item() // self.stride], o[0].item() // self.stride
-            for i in range(1, o.shape[0]):
-                count += (o[i].item() - o[i-1].item()) // self.stride
-                n_o.append(count)
-            n_o = torch.cuda.IntTensor(n_o)
-            idx = pointops.furthestsampling(p, o, n_o)  # (m)
+            if o_host is None:
+                o_host = o.tolist()
+            n_o_host = self.get_downsampled_offset(o_host)
+            n_max = max(end - start for start, end in zip([0] + o_host[:-1], o_host))
+            n_o = torch.tensor(n_o_host, dtype=torch.int).to(o.device, non_blocking=True)
+            idx = pointops.furthestsampling(p, o, n_o, n_max, n_o_host[-1])  # (m)
             n_p = p[idx.long(), :]  # (m, 3)
             x = pointops.queryandgroup(self.nsample, p, n_p, x, None, o, n_o, use_xyz=True)  # (m, 3+c, nsample)
             x = self.relu(self.bn(self.linear(x).transpose(1, 2).contiguous()))  # (m, c, nsample)
@@ -91,22 +139,17 @@ class TransitionUp(nn.Module):
         
     def forward(self, pxo1, pxo2=None):
         if pxo2 is None:
-            _, x, o = pxo1  # (n, 3), (n, c), (b)
-            x_tmp = []
-            for i in range(o.shape[0]):
-                if i == 0:
-                    s_i, e_i, cnt = 0, o[0], o[0]
-                else:
-                    s_i, e_i, cnt = o[i-1], o[i], o[i] - o[i-1]
-                x_b = x[s_i:e_i, :]
-                # concat each with per-cloud mean => finally x = mlp[ x, mlp[mean(x)] ]
-                x_b = torch.cat((x_b, self.linear2(x_b.sum(0, True) / cnt).repeat(cnt, 1)), 1)
-                x_tmp.append(x_b)
-            x = torch.cat(x_tmp, 0)
+            _, x, o = pxo1[:3]  # (n, 3), (n, c), (b)
+            # concat each with per-cloud mean => finally x = mlp[ x, mlp[mean(x)] ]
+            # segment mean over all clouds at once. output_size keeps repeat_interleave from reading o back to the host
+            cnt = torch.diff(o, prepend=o.new_zeros(1)).long()  # (b)
+            cloud_idx = torch.repeat_interleave(torch.arange(o.shape[0], device=o.device), cnt, output_size=x.shape[0])  # (n)
+            x_mean = torch.zeros((o.shape[0], x.shape[1]), dtype=x.dtype, device=x.device).index_add_(0, cloud_idx, x) / cnt.unsqueeze(1).to(x.dtype)  # (b, c)
+            x = torch.cat((x, self.linear2(x_mean)[cloud_idx]), 1)
             x = self.linear1(x)
         else:
             # upsample pxo2 to pxo1
-            p1, x1, o1 = pxo1; p2, x2, o2 = pxo2
+            p1, x1, o1 = pxo1[:3]; p2, x2, o2 = pxo2[:3]
             x = self.linear1(x1) + pointops.interpolation(p2, p1, self.linear2(x2), o2, o1)
         return x
 
@@ -125,14 +168,15 @@ class PointTransformerBlock(nn.Module):
         self.relu = nn.ReLU(inplace=True)
 
     def forward(self, pxo):
-        p, x, o = pxo  # (n, 3), (n, c), (b)
+        p, x, o = pxo[:3]  # (n, 3), (n, c), (b)
+        idx = get_neighbor_idx(pxo, self.transformer2.nsample)  # (n, nsample) - passed on to the next block of the stage
         identity = x
         x = self.relu(self.bn1(self.linear1(x)))  # mlp
-        x = self.relu(self.bn2(self.transformer2([p, x, o])))  # - seems like trans/convolute - bn - relu
+        x = self.relu(self.bn2(self.transformer2([p, x, o, idx])))  # - seems like trans/convolute - bn - relu
         x = self.bn3(self.linear3(x))  # linear (+bn)
         x += identity
         x = self.relu(x)  # relu(x+shortcut)
-        return [p, x, o]
+        return [p, x, o, idx]
 
 class PtTransBlock(nn.Module):
     # wrapper of PointTransformerBlock
@@ -1,9 +1,11 @@
 import os
 import sys
 sys.path.append(os.getcwd())
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .utils import *
 from .blocks import *
@@ -25,9 +27,56 @@ class Loss(nn.Module):
             loss_list += self.contrast_head(output, target, stage_list)
         return torch.stack(loss_list)
 
+class StageMemoryMeter:
+    """
+    memory report of each encoder/decoder stage.
+    saved_mb: activations the stage keeps for backward(counted with saved tensor hooks, so it also works on cpu)
+    peak_mb: cuda peak memory while the stage runs(cuda only)
+    """
+    def __init__(self):
+        self.stats = {}
+
+    @contextlib.contextmanager
+    def measure(self, name, device):
+        saved_storages = {}
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            saved_storages[storage.data_ptr()] = storage.nbytes()
+            return tensor
+        is_cuda = device.type == "cuda"
+        if is_cuda:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            yield
+        stat = self.stats.setdefault(name, {"saved_mb": 0, "peak_mb": 0})
+        stat["saved_mb"] += sum(saved_storages.values()) / 2**20
+        if is_cuda:
+            stat["peak_mb"] = max(stat["peak_mb"], torch.cuda.max_memory_allocated(device) / 2**20)
+
+@contextlib.contextmanager
+def frozen_bn_stats(module):
+    """batch norm layers still normalize with batch statistics, but the running statistics are not updated"""
+    bn_states = []
+    for m in module.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm):
+            num_batches_tracked = m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None
+            bn_states.append((m, m.momentum, num_batches_tracked))
+            m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum, num_batches_tracked in bn_states:
+            m.momentum = momentum
+            if num_batches_tracked is not None:
+                m.num_batches_tracked.copy_(num_batches_tracked)
+
 class PointTransformerSeg(nn.Module):
-    def __init__(self, block, blocks, c, k, mask_head=None, planes=None, block_num=None, config=None, **kwargs):
+    def __init__(self, block, blocks, c, k, mask_head=None, planes=None, block_num=None, config=None, grad_checkpoint=False, inference_chunk_size=None, **kwargs):
         super().__init__()
+        #recompute the activations of every encoder/decoder stage in backward instead of keeping them
+        self.grad_checkpoint = grad_checkpoint
+        self.memory_meter = None
         self.c = c
         self.in_planes = c
         self.k = k
@@ -69,6 +118,16 @@ class PointTransformerSeg(nn.Module):
             self.offset_head = nn.Sequential(nn.Linear(planes[0], planes[0]), nn.BatchNorm1d(planes[0]), nn.ReLU(inplace=True), nn.Linear(planes[0], 3))
         
         self.criterion = Loss(config=config)
+        self.set_inference_chunk_size(inference_chunk_size)
+
+    def set_inference_chunk_size(self, chunk_size):
+        """
+        under torch.no_grad() in eval mode, the point transformer layers attend chunk_size points at a time.
+        the outputs are the same, the peak memory of the layers grows with chunk_size instead of the number of points. None disables it.
+        """
+        for m in self.modules():
+            if isinstance(m, PointTransformerLayer):
+                m.chunk_size = chunk_size
 
     def _make_enc(self, block, planes, blocks, share_planes=8, stride=1, nsample=16):
         """
@@ -90,124 +149,115 @@ class PointTransformerSeg(nn.Module):
             layers.append(block(self.in_planes, self.in_planes, share_planes, nsample=nsample))
         return nn.Sequential(*layers)
 
-    def forward(self, inputs):
+    def get_host_offsets(self, o0_host):
+        """host side offsets of every encoder level, computed once so the stages don't read offsets back from the device"""
+        o_hosts = [o0_host]
+        for i in range(1, self.block_num+1):
+            o_hosts.append(getattr(self, f"enc{i}")[0].get_downsampled_offset(o_hosts[-1]))
+        return o_hosts
+
+    def encode(self, enc, p, x, o, o_host=None):
+        """output: p, x, o, idx - idx is the knn index of p computed by the blocks of the stage(None if the stage has no block)"""
+        pxo = enc[1:](enc[0]([p, x, o], o_host))
+        return pxo[0], pxo[1], pxo[2], pxo[3] if len(pxo) > 3 else None
+
+    def decode(self, dec, p, x, o, idx, p_prev=None, x_prev=None, o_prev=None):
+        """idx: knn index of p from the encoder stage on the same points, reused by the decoder blocks"""
+        if p_prev is None:
+            x = dec[0]([p, x, o])  # no upsample - concat with per-cloud mean: mlp[ x, mlp[mean(x)] ]
+        else:
+            x = dec[0]([p, x, o], [p_prev, x_prev, o_prev])
+        return dec[1:]([p, x, o, idx])[1]
+
+    def compile_stages(self, **compile_kwargs):
+        """
+        torch.compile the encoder/decoder stage functions, so the Linear/BatchNorm/ReLU chains of the blocks are fused.
+        pointops are custom ops, the stages compile without graph breaks. the stage modules are not wrapped, the state dict keys stay the same.
+        """
+        #dynamo caches one graph per stage module and the cache of encode/decode is shared by every compiled model of the process,
+        #so the recompile limit grows with the stages(and a dynamic shape variant of each stage)
+        limit_name = "recompile_limit" if hasattr(torch._dynamo.config, "recompile_limit") else "cache_size_limit"
+        setattr(torch._dynamo.config, limit_name, getattr(torch._dynamo.config, limit_name) + 2*self.block_num)
+        self.encode = torch.compile(self.encode, **compile_kwargs)
+        self.decode = torch.compile(self.decode, **compile_kwargs)
+
+    def run_stage(self, name, stage_func, stage, *args):
+        with self.memory_meter.measure(name, args[0].device) if self.memory_meter is not None else contextlib.nullcontext():
+            if self.grad_checkpoint and self.training and torch.is_grad_enabled():
+                return self.checkpoint_stage(stage_func, stage, *args)
+            return stage_func(stage, *args)
+
+    def checkpoint_stage(self, stage_func, stage, *args):
+        is_recompute = [False]
+        def run(*inputs):
+            #the second call is the recomputation in backward. batch norm must not update its running stats twice.
+            if is_recompute[0]:
+                with frozen_bn_stats(stage):
+                    return stage_func(stage, *inputs)
+            is_recompute[0] = True
+            return stage_func(stage, *inputs)
+        return checkpoint(run, *args, use_reentrant=False)
+
+    def forward(self, inputs, offset=None):
 
         """
         input:
             inputs[0] -> pxo -> batch_size, channel, 24000
             inputs[1] -> target -> batch_size, 24000
             inputs[2] -> pxo_prev -> batch_size, channel(32), 24000
+            offset -> None or (b) cumulative point counts. if given, inputs are packed clouds of different sizes => 1, channel, sum of points
         """
         B, C, N = inputs[0].shape
         pxo = inputs[0].permute(0,2,1) # (batch_size, 24000, channel)
         x0 = pxo.reshape(-1, C)
         p0 = pxo[:,:,:3].reshape(-1, 3).contiguous()
-        o0 = torch.arange(1, B+1, dtype=torch.int).cuda()
-        o0 *= N
+        if offset is None:
+            o0_host = [N*(i+1) for i in range(B)]
+        else:
+            o0_host = [int(end) for end in offset.tolist()]
+        o_hosts = self.get_host_offsets(o0_host)
+        o0 = torch.tensor(o0_host, dtype=torch.int).to(x0.device, non_blocking=True)
 
         stage_list = {'inputs': inputs}
 
-        if self.block_num==5:
-            p1, x1, o1 = self.enc1([p0, x0, o0])
-            p2, x2, o2 = self.enc2([p1, x1, o1])
-            p3, x3, o3 = self.enc3([p2, x2, o2])
-            p4, x4, o4 = self.enc4([p3, x3, o3])
-            p5, x5, o5 = self.enc5([p4, x4, o4])
-            down_list = [
-                # [p0, x0, o0],  # (n, 3), (n, in_feature_dims), (b)
-                {'p_out': p1, 'f_out': x1, 'offset': o1},  # (n, 3), (n, base_fdims), (b) - default base_fdims = 32
-                {'p_out': p2, 'f_out': x2, 'offset': o2},  # n_1
-                {'p_out': p3, 'f_out': x3, 'offset': o3},  # n_2
-                {'p_out': p4, 'f_out': x4, 'offset': o4},  # n_3
-                {'p_out': p5, 'f_out': x5, 'offset': o5},  # n_4 - fdims = 512
-            ]
-            # for i, s in enumerate(down_list):
-            #     print('\n\t'.join([str(i)] + [str(ss.shape) for ss in s]))
-            stage_list['down'] = down_list
-
-            x5 = self.dec5[1:]([p5, self.dec5[0]([p5, x5, o5]), o5])[1]  # no upsample - concat with per-cloud mean: mlp[ x, mlp[mean(x)] ]
-            x4 = self.dec4[1:]([p4, self.dec4[0]([p4, x4, o4], [p5, x5, o5]), o4])[1]
-            x3 = self.dec3[1:]([p3, self.dec3[0]([p3, x3, o3], [p4, x4, o4]), o3])[1]
-            x2 = self.dec2[1:]([p2, self.dec2[0]([p2, x2, o2], [p3, x3, o3]), o2])[1]
-            x1 = self.dec1[1:]([p1, self.dec1[0]([p1, x1, o1], [p2, x2, o2]), o1])[1]
-            up_list = [
-                {'p_out': p1, 'f_out': x1, 'offset': o1},  # n_0 = n, fdims = 32
-                {'p_out': p2, 'f_out': x2, 'offset': o2},  # n_1
-                {'p_out': p3, 'f_out': x3, 'offset': o3},  # n_2
-                {'p_out': p4, 'f_out': x4, 'offset': o4},  # n_3
-                {'p_out': p5, 'f_out': x5, 'offset': o5},  # n_4 - fdims = 512 (extracted through dec5 = mlps)
-            ]
-            stage_list['up'] = up_list
-
-        # for i, s in enumerate(up_list):
-        #     print('\n\t'.join([str(i)] + [str(ss.shape) for ss in s]))
-        elif self.block_num==3:
-            p1, x1, o1 = self.enc1([p0, x0, o0])
-            p2, x2, o2 = self.enc2([p1, x1, o1])
-            p3, x3, o3 = self.enc3([p2, x2, o2])
-            down_list = [
-                # [p0, x0, o0],  # (n, 3), (n, in_feature_dims), (b)
-                {'p_out': p1, 'f_out': x1, 'offset': o1},  # (n, 3), (n, base_fdims), (b) - default base_fdims = 32
-                {'p_out': p2, 'f_out': x2, 'offset': o2},  # n_1
-                {'p_out': p3, 'f_out': x3, 'offset': o3},  # n_2
-            ]
-            # for i, s in enumerate(down_list):
-            #     print('\n\t'.join([str(i)] + [str(ss.shape) for ss in s]))
-            stage_list['down'] = down_list
-
-            x3 = self.dec3[1:]([p3, self.dec3[0]([p3, x3, o3]), o3])[1]
-            x2 = self.dec2[1:]([p2, self.dec2[0]([p2, x2, o2], [p3, x3, o3]), o2])[1]
-            x1 = self.dec1[1:]([p1, self.dec1[0]([p1, x1, o1], [p2, x2, o2]), o1])[1]
-            up_list = [
-                {'p_out': p1, 'f_out': x1, 'offset': o1},  # n_0 = n, fdims = 32
-                {'p_out': p2, 'f_out': x2, 'offset': o2},  # n_1
-                {'p_out': p3, 'f_out': x3, 'offset': o3},  # n_2
-            ]
-
-            stage_list['up'] = up_list
-
-        elif self.block_num==2:
-            p1, x1, o1 = self.enc1([p0, x0, o0])
-            p2, x2, o2 = self.enc2([p1, x1, o1])
-            down_list = [
-                {'p_out': p1, 'f_out': x1, 'offset': o1},  # (n, 3), (n, base_fdims), (b) - default base_fdims = 32
-                {'p_out': p2, 'f_out': x2, 'offset': o2},  # n_1
-            ]
-            stage_list['down'] = down_list
-
-            x2 = self.dec2[1:]([p2, self.dec2[0]([p2, x2, o2]), o2])[1]
-            x1 = self.dec1[1:]([p1, self.dec1[0]([p1, x1, o1], [p2, x2, o2]), o1])[1]
-            up_list = [
-                {'p_out': p1, 'f_out': x1, 'offset': o1},  # n_0 = n, fdims = 32
-                {'p_out': p2, 'f_out': x2, 'offset': o2},  # n_1
-            ]
-
-            stage_list['up'] = up_list
-
-
-        if self.cls_head is not None:
-            cls_results, stage_list = self.cls_head(stage_list)
-            if B==1:
+        # encoder: enc1 ... enc{block_num}, each stage downsamples the previous one
+        down_list = []  # (n_i, 3), (n_i, fdims_i), (b) - n_0 = n, fdims_0 = base_fdims
+        p, x, o = p0, x0, o0
+        for i in range(1, self.block_num+1):
+            p, x, o, idx = self.run_stage(f"enc{i}", self.encode, getattr(self, f"enc{i}"), p, x, o, o_hosts[i-1])
+            down_list.append({'p_out': p, 'f_out': x, 'offset': o, 'neighbor_idx': idx})
+        stage_list['down'] = down_list
+
+        # decoder: dec{block_num} has no upsample - concat with per-cloud mean: mlp[ x, mlp[mean(x)] ]
+        # the others fuse the upsampled previous stage with the skip connection of the same level
+        up_list = [None] * self.block_num
+        prev = {}
+        for i in range(self.block_num, 0, -1):
+            down = down_list[i-1]
+            pxo_prev = [prev['p_out'], prev['f_out'], prev['offset']] if prev else []
+            x = self.run_stage(f"dec{i}", self.decode, getattr(self, f"dec{i}"), down['p_out'], down['f_out'], down['offset'], down['neighbor_idx'], *pxo_prev)
+            up_list[i-1] = prev = {'p_out': down['p_out'], 'f_out': x, 'offset': down['offset'], 'neighbor_idx': down['neighbor_idx']}
+        stage_list['up'] = up_list
+        x1 = up_list[0]['f_out']
+
+        with self.memory_meter.measure("heads", x0.device) if self.memory_meter is not None else contextlib.nullcontext():
+            if self.cls_head is not None:
+                cls_results, stage_list = self.cls_head(stage_list)
                 offset_results, _ = self.offset_head(stage_list)
             else:
-                offset_results = None
-        else:
-            cls_results = self.cls(x1)
-            offset_results = self.offset(x1)
-        
-        output = []
-        if len(inputs) == 2:
-            target = inputs[1].reshape(-1) # target: n
-            target = target.type(torch.long)
-            target = target + 1 # -1 is gingiva now with out subtraction
-            info_loss = self.criterion(cls_results, target, stage_list)
-            output.append(info_loss)
+                cls_results = self.cls(x1)
+                offset_results = self.offset(x1)
+            
+            output = []
+            if len(inputs) == 2:
+                target = inputs[1].reshape(-1) # target: n
+                target = target.type(torch.long)
+                target = target + 1 # -1 is gingiva now with out subtraction
+                info_loss = self.criterion(cls_results, target, stage_list)
+                output.append(info_loss)
 
         cls_results = cls_results.view(B, N, self.k).permute(0,2,1)
-        if B==1:
-            offset_results = offset_results.view(B, N, 3).permute(0,2,1)
-        else:
-            offset_results = None
+        offset_results = offset_results.view(B, N, 3).permute(0,2,1)
         output.append(cls_results)
         output.append(offset_results)
         output.append(None)
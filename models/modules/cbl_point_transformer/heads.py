@@ -189,7 +189,9 @@ class ContrastHead(nn.Module):
 
         nsample = self.nsample[i]
         labels = get_subscene_label(n, i, stage_list, target, self.nstride, self.config.num_classes)  # (m, ncls) - distribution / onehot
-        neighbor_idx, _ = pointops.knnquery(nsample, p, p, o, o) # (m, nsample)
+        neighbor_idx = stage_list[n][i].get('neighbor_idx')  # knn of the same points, already computed by the backbone stage
+        if neighbor_idx is None or neighbor_idx.shape[1] != nsample:
+            neighbor_idx, _ = pointops.knnquery(nsample, p, p, o, o) # (m, nsample)
 
         # exclude self-loop
         nsample = self.nsample[i] - 1  # nsample -= 1 can only be used if nsample is py-number - results in decreasing number if is tensor, e.g. 4,3,2,1,...
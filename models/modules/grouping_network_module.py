@@ -11,21 +11,24 @@ class GroupingNetworkModule(torch.nn.Module):
         super().__init__()
         class_num = 9
         self.first_ins_cent_model = get_model(**config["model_parameter"], c=config["model_parameter"]["input_feat"], k=class_num + 1)
-        self.second_ins_cent_model = get_model(**config["model_parameter"], c=config["model_parameter"]["input_feat"], k=2).train().cuda()
+        self.second_ins_cent_model = get_model(**config["model_parameter"], c=config["model_parameter"]["input_feat"], k=2).train()
 
-    def forward(self, inputs, test=False):
+    def forward(self, inputs, test=False, offset=None, crop_sample_size=None):
         DEBUG=False
         """
         inputs
             inputs[0] => B, 6, 24000 : point features
             inputs[1] => B, 1, 24000 : ground truth segmentation
+        offset
+            None, or (b) cumulative point counts when clouds of different sizes are packed => inputs are 1, 6, sum of points
+        crop_sample_size
+            None, or points of each tooth crop instead of model_parameter crop_sample_size(inference presets)
         """
-        B, C, N = inputs[0].shape
         outputs = {}
         if len(inputs)>=2 and not test:
             half_seg_label = inputs[1].clone()
             half_seg_label[half_seg_label>=9] -= 8
-            cbl_loss_1, sem_1, offset_1, mask_1, first_features = self.first_ins_cent_model([inputs[0], half_seg_label])
+            cbl_loss_1, sem_1, offset_1, mask_1, first_features = self.first_ins_cent_model([inputs[0], half_seg_label], offset)
             outputs.update({
                 "cbl_loss_1": cbl_loss_1,
                 "sem_1": sem_1,
@@ -34,7 +37,7 @@ class GroupingNetworkModule(torch.nn.Module):
                 "first_features": first_features
             })
         else:
-            sem_1, offset_1, mask_1, first_features = self.first_ins_cent_model([inputs[0]])
+            sem_1, offset_1, mask_1, first_features = self.first_ins_cent_model([inputs[0]], offset)
             outputs.update({
                 "sem_1": sem_1,
                 "offset_1":offset_1,
@@ -42,37 +45,16 @@ class GroupingNetworkModule(torch.nn.Module):
                 "first_features": first_features
             })
         
-        cluster_centroids = []
+        cloud_ranges = self.get_cloud_ranges(inputs, offset)
         if len(inputs) >= 2:
-            for b_idx in range(B):
-                b_gt_seg_labels = gu.torch_to_numpy(inputs[1][b_idx,:,:].view(-1))
-                b_points_coords = gu.torch_to_numpy(inputs[0][b_idx,:3,:]).T
-                contained_tooth_num = np.unique(b_gt_seg_labels)
-                temp_list = []
-                for tooth_num in contained_tooth_num:
-                    if tooth_num == -1:
-                        continue
-                    temp_list.append(b_points_coords[tooth_num == b_gt_seg_labels].mean(axis=0))
-                cluster_centroids.append(temp_list)
+            cluster_centroids = self.get_gt_centroids(inputs, cloud_ranges)
         else:
-            for b_idx in range(B):
-                whole_pd_sem_1 = gu.torch_to_numpy(sem_1)[b_idx,:,:].T
-                whole_cls_1 = np.argmax(whole_pd_sem_1, axis=1)
-                whole_offset_1 = gu.torch_to_numpy(offset_1)[b_idx,:,:].T
-                b_points_coords = gu.torch_to_numpy(inputs[b_idx][b_idx,:3,:]).T
-                b_moved_points = b_points_coords + whole_offset_1
-                b_fg_moved_points = b_moved_points[whole_cls_1.reshape(-1)!=0, :]
-                fg_points_labels_ls = ou.get_clustering_labels(b_moved_points, whole_cls_1)
-                temp_centroids = []
-                for i in np.unique(fg_points_labels_ls):
-                    temp_centroids.append(np.mean(b_fg_moved_points[fg_points_labels_ls==i, :],axis=0))
-                cluster_centroids.append(temp_centroids)
+            cluster_centroids = self.get_pred_centroids(inputs, sem_1, offset_1, cloud_ranges)
         
-        org_xyz_cpu = gu.torch_to_numpy(inputs[0][:, :3, :].permute(0, 2, 1))
-        nn_crop_indexes = ou.get_nearest_neighbor_idx(org_xyz_cpu, cluster_centroids, self.config["model_parameter"]["crop_sample_size"])
-        cropped_feature_ls = ou.get_indexed_features(inputs[0], nn_crop_indexes)
+        nn_crop_indexes, row_crop_indexes = self.get_crop_indexes(inputs, cluster_centroids, cloud_ranges, crop_sample_size)
+        cropped_feature_ls = ou.get_indexed_features(inputs[0], row_crop_indexes)
         if len(inputs)>=2:
-            cluster_gt_seg_label = ou.get_indexed_features(inputs[1], nn_crop_indexes)
+            cluster_gt_seg_label = ou.get_indexed_features(inputs[1], row_crop_indexes)
 
         cropped_feature_ls = ou.centering_object(cropped_feature_ls)
 
@@ -97,5 +79,69 @@ class GroupingNetworkModule(torch.nn.Module):
 
         outputs["cropped_feature_ls"] = cropped_feature_ls
         outputs["nn_crop_indexes"] =  nn_crop_indexes
+        outputs["crop_batch_index"] = np.concatenate([np.full(len(indexes), cloud_idx) for cloud_idx, indexes in enumerate(nn_crop_indexes)])
+
+        return outputs
+
+    def get_cloud_ranges(self, inputs, offset):
+        """
+        output: [(batch row, start, end)] of every cloud in inputs
+        """
+        B, C, N = inputs[0].shape
+        if offset is None:
+            return [(b_idx, 0, N) for b_idx in range(B)]
+        ends = [int(end) for end in offset.tolist()]
+        starts = [0] + ends[:-1]
+        return [(0, start, end) for start, end in zip(starts, ends)]
 
-        return outputs
\ No newline at end of file
+    def get_gt_centroids(self, inputs, cloud_ranges):
+        seg_labels = gu.torch_to_numpy(inputs[1])
+        points_coords = gu.torch_to_numpy(inputs[0][:, :3, :])
+        cluster_centroids = []
+        for b_idx, start, end in cloud_ranges:
+            b_gt_seg_labels = seg_labels[b_idx, 0, start:end]
+            b_points_coords = points_coords[b_idx, :, start:end].T
+            contained_tooth_num = np.unique(b_gt_seg_labels)
+            temp_list = []
+            for tooth_num in contained_tooth_num:
+                if tooth_num == -1:
+                    continue
+                temp_list.append(b_points_coords[tooth_num == b_gt_seg_labels].mean(axis=0))
+            cluster_centroids.append(temp_list)
+        return cluster_centroids
+
+    def get_pred_centroids(self, inputs, sem_1, offset_1, cloud_ranges):
+        pd_sem_1 = gu.torch_to_numpy(sem_1)
+        pd_offset_1 = gu.torch_to_numpy(offset_1)
+        points_coords = gu.torch_to_numpy(inputs[0][:, :3, :])
+        cluster_centroids = []
+        for b_idx, start, end in cloud_ranges:
+            whole_cls_1 = np.argmax(pd_sem_1[b_idx, :, start:end].T, axis=1)
+            whole_offset_1 = pd_offset_1[b_idx, :, start:end].T
+            b_points_coords = points_coords[b_idx, :, start:end].T
+            b_moved_points = b_points_coords + whole_offset_1
+            b_fg_moved_points = b_moved_points[whole_cls_1.reshape(-1)!=0, :]
+            fg_points_labels_ls = ou.get_clustering_labels(b_moved_points, whole_cls_1)
+            temp_centroids = []
+            for i in np.unique(fg_points_labels_ls):
+                temp_centroids.append(np.mean(b_fg_moved_points[fg_points_labels_ls==i, :],axis=0))
+            cluster_centroids.append(temp_centroids)
+        return cluster_centroids
+
+    def get_crop_indexes(self, inputs, cluster_centroids, cloud_ranges, crop_sample_size=None):
+        """
+        output:
+            nn_crop_indexes => [cloud](cluster_num, crop_sample_size) : point indexes inside each cloud
+            row_crop_indexes => [batch row](cluster_num, crop_sample_size) : the same indexes inside each row of inputs, for get_indexed_features
+        """
+        org_xyz_cpu = gu.torch_to_numpy(inputs[0][:, :3, :].permute(0, 2, 1))
+        if crop_sample_size is None:
+            crop_sample_size = self.config["model_parameter"]["crop_sample_size"]
+        nn_crop_indexes = []
+        row_crop_indexes = [[] for _ in range(inputs[0].shape[0])]
+        for (b_idx, start, end), centroids in zip(cloud_ranges, cluster_centroids):
+            indexes = ou.get_nearest_neighbor_idx(org_xyz_cpu[b_idx:b_idx+1, start:end, :], [centroids], crop_sample_size)[0]
+            nn_crop_indexes.append(indexes)
+            row_crop_indexes[b_idx].append(indexes + start)
+        row_crop_indexes = [np.concatenate(indexes, axis=0) if len(indexes) > 0 else [] for indexes in row_crop_indexes]
+        return nn_crop_indexes, row_crop_indexes
@@ -301,6 +301,111 @@ def batch_chamfer_distance_loss(pred_offset, sample_xyz, gt_seg_label):
     loss /= B
     return loss
 
+def get_cloud_index(gt_seg_label, offset=None):
+    """cloud index of every point
+
+    Args:
+        gt_seg_label (B, 1, N), or (1, 1, sum of points) if clouds are packed with offset
+        offset (b): cumulative point counts of the packed clouds, None if every cloud has N points
+    Returns:
+        cloud_index (B*N), num_of_clouds
+    """
+    B, _, N = gt_seg_label.shape
+    device = gt_seg_label.device
+    if offset is None:
+        return torch.arange(B, device=device).repeat_interleave(N), B
+    offset = offset.to(device=device, dtype=torch.long)
+    counts = torch.diff(offset, prepend=offset.new_zeros(1))
+    return torch.arange(offset.shape[0], device=device).repeat_interleave(counts), offset.shape[0]
+
+def get_tooth_groups(sample_xyz, gt_seg_label, offset=None):
+    """group foreground points by (cloud, tooth number) and get the centroid of every group
+
+    Args:
+        sample_xyz (B, 3, N)
+        gt_seg_label (B, 1, N)
+    Returns:
+        fg_cond (B*N): points of tooth 0~15
+        group_index (fg points): cloud*16 + tooth number
+        group_count (num_of_clouds*16)
+        centroids (num_of_clouds*16, 3)
+        cloud_index (B*N), num_of_clouds
+    """
+    sample_xyz = sample_xyz.permute(0,2,1).reshape(-1, 3)
+    cloud_index, num_of_clouds = get_cloud_index(gt_seg_label, offset)
+    gt_seg_label = gt_seg_label.reshape(-1).type(torch.long)
+    fg_cond = (gt_seg_label >= 0) & (gt_seg_label < 16)
+    group_index = cloud_index[fg_cond]*16 + gt_seg_label[fg_cond]
+    group_count = torch.bincount(group_index, minlength=num_of_clouds*16)
+    centroids = sample_xyz.new_zeros((num_of_clouds*16, 3)).index_add_(0, group_index, sample_xyz[fg_cond])
+    centroids = centroids / group_count.clamp(min=1).unsqueeze(1)
+    return fg_cond, group_index, group_count, centroids, cloud_index, num_of_clouds
+
+def segment_center_offset_loss(pred_offset, sample_xyz, gt_seg_label, offset=None):
+    """batch_center_offset_loss without the per tooth loop. also works for clouds packed with offset.
+
+    Args:
+        pred_offset (B, 3, 16000)
+        sample_xyz (B, 3, 16000)
+        gt_seg_label (B, 1, 16000)
+        offset (b): cumulative point counts if clouds of different sizes are packed in (1, *, sum of points)
+    """
+    fg_cond, group_index, group_count, centroids, _, _ = get_tooth_groups(sample_xyz, gt_seg_label, offset)
+    pred_offset = pred_offset.permute(0,2,1).reshape(-1, 3)[fg_cond]
+    sample_xyz = sample_xyz.permute(0,2,1).reshape(-1, 3)[fg_cond]
+
+    #groups with less than 5 points are skipped
+    valid_group = group_count >= 5
+    valid_point = valid_group[group_index]
+    group_index, pred_offset, sample_xyz = group_index[valid_point], pred_offset[valid_point], sample_xyz[valid_point]
+    point_centroids = centroids[group_index]
+
+    moved_dists = torch.sum((sample_xyz + pred_offset - point_centroids)**2, dim=1)
+    group_dists = moved_dists.new_zeros(centroids.shape[0]).index_add_(0, group_index, moved_dists)
+    centroid_losses = torch.sum(group_dists[valid_group] / group_count[valid_group]) / torch.sum(valid_group)
+
+    offset_norm = torch.norm(pred_offset, dim=1)
+    dir_cond = offset_norm > 0.0002
+    offset_dir = pred_offset[dir_cond] / offset_norm[dir_cond].unsqueeze(1)
+    points_to_center_dir = point_centroids[dir_cond] - sample_xyz[dir_cond]
+    points_to_center_dir = points_to_center_dir / torch.norm(points_to_center_dir, dim=1, keepdim=True)
+    dot_mat = (torch.sum(points_to_center_dir * offset_dir, dim=1) - 1)**2
+    dir_group_index = group_index[dir_cond]
+    dir_count = torch.bincount(dir_group_index, minlength=centroids.shape[0])
+    dir_sums = dot_mat.new_zeros(centroids.shape[0]).index_add_(0, dir_group_index, dot_mat)
+    dir_group = dir_count > 0
+    dir_losses = torch.sum(dir_sums[dir_group] / dir_count[dir_group]) / torch.sum(dir_group)
+    return centroid_losses, dir_losses
+
+def segment_chamfer_distance_loss(pred_offset, sample_xyz, gt_seg_label, offset=None):
+    """batch_chamfer_distance_loss without the per tooth/batch loops. also works for clouds packed with offset.
+
+    Args:
+        pred_offset (B, 3, 16000)
+        sample_xyz (B, 3, 16000)
+        gt_seg_label (B, 1, 16000)
+        offset (b): cumulative point counts if clouds of different sizes are packed in (1, *, sum of points)
+    """
+    _, _, group_count, centroids, cloud_index, num_of_clouds = get_tooth_groups(sample_xyz, gt_seg_label, offset)
+    valid_group = group_count >= 5
+    centroids = centroids[valid_group]
+    centroid_cloud_index = torch.div(torch.nonzero(valid_group).view(-1), 16, rounding_mode="floor")
+
+    moved_points = (sample_xyz + pred_offset).permute(0,2,1).reshape(-1, 3)
+    point_cond = gt_seg_label.reshape(-1) != -1
+    moved_points, cloud_index = moved_points[point_cond], cloud_index[point_cond]
+
+    #distances to the centroids of the other clouds are ignored
+    pred_ct_dists = torch.sum((moved_points.unsqueeze(1) - centroids.unsqueeze(0))**2, dim=2)
+    pred_ct_dists = pred_ct_dists.masked_fill(cloud_index.unsqueeze(1) != centroid_cloud_index.unsqueeze(0), float("inf"))
+    min_pred_ct_dists, _ = torch.topk(pred_ct_dists, 2, dim=1, largest=False, sorted=True)
+    ratio = torch.div(min_pred_ct_dists[:,0], min_pred_ct_dists[:,1])
+
+    cloud_ratio = ratio.new_zeros(num_of_clouds).index_add_(0, cloud_index, ratio)
+    cloud_count = torch.bincount(cloud_index, minlength=num_of_clouds)
+    loss = torch.sum(cloud_ratio / cloud_count) / num_of_clouds
+    return loss
+
 def chamfer_distance_with_gin_loss(pred_offset, sample_xyz, centroid):
     pred_offset = pred_offset.permute(0,2,1)
     sample_xyz = sample_xyz.permute(0,2,1)
@@ -364,9 +469,9 @@ def tooth_class_loss(cls_pred, gt_cls, cls_num, weight=None, label_smoothing=Non
     gt_cls = gt_cls + 1
     if label_smoothing is None:
         if weight is None:
-            loss = torch.nn.CrossEntropyLoss().type(torch.float).cuda()(cls_pred, gt_cls)
+            loss = torch.nn.CrossEntropyLoss().type(torch.float).to(cls_pred.device)(cls_pred, gt_cls)
         else:
-            loss = torch.nn.CrossEntropyLoss(weight=torch.tensor(weight).type(torch.float).cuda())(cls_pred, gt_cls)
+            loss = torch.nn.CrossEntropyLoss(weight=torch.tensor(weight).type(torch.float).to(cls_pred.device))(cls_pred, gt_cls)
     else:
         loss = LabelSmoothingLoss(cls_num, smoothing=label_smoothing)(cls_pred, gt_cls)
     return loss
@@ -69,10 +69,10 @@ class TSegNetModel(BaseModel):
         inputs = [points, seg_label]
         
         if phase == "train":
-            output = self.module(inputs)
+            output = self.forward_module(inputs)
         else:
             with torch.no_grad():
-                output = self.module(inputs)
+                output = self.forward_module(inputs)
         loss_meter = LossMap()
         
         loss_meter.add_loss_by_dict(self.get_loss(
@@ -1,11 +1,14 @@
-from sklearn.cluster import DBSCAN, KMeans
 import numpy as np
-from sklearn.neighbors import KDTree
 import torch 
 from external_libs.pointnet2_utils.pointnet2_utils import square_distance
-from sklearn.cluster import MeanShift
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
+from lazy_import import lazy_import
+#imported on first use, see import_time_report.py
+DBSCAN = lazy_import("sklearn.cluster", "DBSCAN")
+KMeans = lazy_import("sklearn.cluster", "KMeans")
+MeanShift = lazy_import("sklearn.cluster", "MeanShift")
+KDTree = lazy_import("sklearn.neighbors", "KDTree")
+PCA = lazy_import("sklearn.decomposition", "PCA")
+plt = lazy_import("matplotlib.pyplot")
 
 def clustering_points(moved_points, method, num_of_clusters=None):
     """
@@ -162,11 +165,12 @@ def get_nearest_neighbor_idx(org_xyz, sampled_clusters, crop_num=4096):
 
 
 def centering_object(points):
-    points = points.permute(0,2,1)
-    for point in points:
-        point[:,:3] = point[:,:3] - torch.mean(point[:, :3], dim=0)
-    points = points.permute(0,2,1)
-    return points
+    """
+    move the xyz of every crop to its own mean
+    points => B, channel, N
+    """
+    xyz = points[:, :3, :] - torch.mean(points[:, :3, :], dim=2, keepdim=True)
+    return torch.cat([xyz, points[:, 3:, :]], dim=1)
 
 def seg_label_to_cent(gt_coords, gt_seg_label):
     gt_coords = gt_coords.permute(0,2,1)
@@ -203,17 +207,26 @@ def get_indexed_features(features, cropped_indexes):
     Output:
         cropped_item_ls => type torch cuda/np => new batch B, channel, 4096
     """
-    cropped_item_ls = []
-    for b_idx in range(len(cropped_indexes)):
-        for cluster_idx in range(len(cropped_indexes[b_idx])):
-            #cropped_point = torch.index_select(features[b_idx,:,:], 1, torch.tensor(cropped_indexes[b_idx][cluster_idx]).cuda())
-            cropped_point = features[b_idx][:, cropped_indexes[b_idx][cluster_idx]]
-            cropped_item_ls.append(cropped_point)
-    if type(cropped_item_ls[0]) == torch.Tensor:
-        cropped_item_ls = torch.stack(cropped_item_ls, dim=0)
-    elif type(cropped_item_ls[0]) == np.ndarray:
-        cropped_item_ls = np.stack(cropped_item_ls, axis=0)
+    batch_index, crop_index = get_crop_index_arrays(cropped_indexes)
+    if type(features) == torch.Tensor:
+        batch_index = torch.from_numpy(batch_index).to(features.device)
+        crop_index = torch.from_numpy(crop_index).to(features.device)
+        cropped_item_ls = features[batch_index[:, None], :, crop_index].permute(0, 2, 1)
+    elif type(features) == np.ndarray:
+        cropped_item_ls = features[batch_index[:, None], :, crop_index].transpose(0, 2, 1)
     else:
         raise "someting unknwon type"
     return cropped_item_ls
 
+def get_crop_index_arrays(cropped_indexes):
+    """
+    Input:
+        cropped indexes => B, cluster_num, 4096 (cluster_num can differ between batch items)
+    Output:
+        batch_index => np => new batch B, batch item of each crop
+        crop_index => np => new batch B, 4096
+    """
+    batch_index = np.concatenate([np.full(len(b_indexes), b_idx) for b_idx, b_indexes in enumerate(cropped_indexes)]).astype(np.int64)
+    crop_index = np.concatenate([np.asarray(b_indexes).reshape(len(b_indexes), -1) for b_indexes in cropped_indexes if len(b_indexes) > 0], axis=0).astype(np.int64)
+    return batch_index, crop_index
+
@@ -1,10 +1,15 @@
 import glob
 import json
 import os
+import threading
 import numpy as np
 import traceback
-import open3d as o3d
-from gen_utils import read_txt_obj_ls
+from collections import OrderedDict
+from gen_utils import read_jaw_mesh, atomic_path
+from lazy_import import lazy_import
+from mesh_protocol import as_uint8_labels
+from stage_timer import StageTimer
+o3d = lazy_import("open3d")
 
 def get_colored_mesh(mesh, label_arr):
     palte = {
@@ -74,45 +79,96 @@ def get_mesh_of_each_tooth(mesh, label_arr, label):
     
     return new_mesh
 
-def save_tooth_and_get_brace_location(mesh, label_arr, ind_dir):
+#the brace of each tooth is on its facial side: the vertices whose normal points to -y(incisors), -x(right teeth) or +x(left teeth).
+#molars and premolars after the first one only use the third of those vertices most distal along x.
+INCISOR_LABELS = [11, 12, 21, 22, 31, 32, 41, 42]
+RIGHT_LABELS = [13, 14, 15, 16, 17, 18, 43, 44, 45, 46, 47, 48]
+LEFT_LABELS = [23, 24, 25, 26, 27, 28, 33, 34, 35, 36, 37, 38]
+RIGHT_DISTAL_LABELS = [15, 16, 17, 18, 45, 46, 47, 48]
+LEFT_DISTAL_LABELS = [25, 26, 27, 28, 35, 36, 37, 38]
+#fdi labels of the teeth of each jaw
+JAW_LABELS = {
+    "upper": list(range(11, 19)) + list(range(21, 29)),
+    "lower": list(range(31, 39)) + list(range(41, 49)),
+}
+
+def get_face_vertex_mask(faces, face_mask, num_vertices):
+    """vertices used by the faces of face_mask. select_by_index of open3d keeps only these(cleanup)"""
+    vertex_mask = np.zeros(num_vertices, dtype=bool)
+    vertex_mask[faces[face_mask].reshape(-1)] = True
+    return vertex_mask
+
+def get_brace_locations(vertices, normals, faces, label_arr):
+    """
+    brace location of every tooth in one pass over the arrays of the jaw mesh. the same vertices as building the facial submesh of each tooth with open3d(up to exact ties)
+    input: vertices (n, 3), vertex normals (n, 3), faces (m, 3), per vertex labels (n)
+    output: {label: {"center_location", "normal_vector"}}, in label order
+    """
+    label_arr = np.asarray(label_arr).reshape(-1)
+    num_vertices = vertices.shape[0]
+    facial = (np.isin(label_arr, INCISOR_LABELS) & (normals[:,1] <= 0)) | (np.isin(label_arr, RIGHT_LABELS) & (normals[:,0] <= 0)) | (np.isin(label_arr, LEFT_LABELS) & (normals[:,0] >= 0))
+    #faces of one tooth, inside its facial side
+    face_labels = label_arr[faces]
+    tooth_faces = (face_labels[:,0] == face_labels[:,1]) & (face_labels[:,1] == face_labels[:,2])
+    facial_faces = tooth_faces & np.all(facial[faces], axis=1)
+    candidates = get_face_vertex_mask(faces, facial_faces, num_vertices)
+
+    #distal third: rank of the facial vertices of each tooth along x
+    right_distal, left_distal = np.isin(label_arr, RIGHT_DISTAL_LABELS), np.isin(label_arr, LEFT_DISTAL_LABELS)
+    distal_ids = np.flatnonzero(candidates & (right_distal | left_distal))
+    if distal_ids.shape[0] > 0:
+        order = distal_ids[np.lexsort((vertices[distal_ids,0], label_arr[distal_ids]))]
+        order_labels = label_arr[order]
+        group_starts = np.flatnonzero(np.concatenate([[True], order_labels[1:] != order_labels[:-1]]))
+        group_sizes = np.diff(np.append(group_starts, order.shape[0]))
+        ranks = np.arange(order.shape[0]) - np.repeat(group_starts, group_sizes)
+        sizes = np.repeat(group_sizes, group_sizes)
+        #[:n//3] of the right teeth, [-n//3:](the last ceil(n/3)) of the left teeth
+        keep = np.where(right_distal[order], ranks < sizes // 3, ranks >= sizes + (-sizes // 3))
+        selected = np.zeros(num_vertices, dtype=bool)
+        selected[order[keep]] = True
+        distal_faces = facial_faces & np.all(selected[faces], axis=1)
+        distal_candidates = get_face_vertex_mask(faces, distal_faces, num_vertices)
+        candidates = np.where(right_distal | left_distal, distal_candidates, candidates)
+
     brace_locations = {}
+    candidate_ids = np.flatnonzero(candidates)
+    candidate_labels = label_arr[candidate_ids]
     for lbl in np.unique(label_arr):
-        tooth_mesh = get_mesh_of_each_tooth(mesh, label_arr, lbl) 
-        if lbl in [11, 12, 21, 22, 31, 32, 41, 42]:
-            outer_mesh = tooth_mesh.select_by_index(np.where(np.array(tooth_mesh.vertex_normals)[:,1]<=0)[0])
-            center = np.mean(np.array(outer_mesh.vertices), axis=0)
-            # find the vertex that is closest to the center
-            closest_vertex = np.argmin(np.linalg.norm(np.array(outer_mesh.vertices)-center, axis=1))
-            closest_vertex_normal = np.array(outer_mesh.vertex_normals)[closest_vertex]
-            brace_locations[int(lbl)] = {"center_location": np.array(outer_mesh.vertices)[closest_vertex].tolist(), 
-                                    "normal_vector": closest_vertex_normal.tolist()}
-        if lbl in [13, 14, 15, 16, 17, 18, 43, 44, 45, 46, 47, 48]:
-            outer_mesh = tooth_mesh.select_by_index(np.where(np.array(tooth_mesh.vertex_normals)[:,0]<=0)[0])
-            # get the half most <=0 x value vertex
-            if lbl in [15, 16, 17, 18, 45, 46, 47, 48]:
-                outer_mesh = outer_mesh.select_by_index(np.argsort(np.array(outer_mesh.vertices)[:,0])[:len(outer_mesh.vertices)//3])
-
-            center = np.mean(np.array(outer_mesh.vertices), axis=0)
-            # find the vertex that is closest to the center
-            closest_vertex = np.argmin(np.linalg.norm(np.array(outer_mesh.vertices)-center, axis=1))
-            closest_vertex_normal = np.array(outer_mesh.vertex_normals)[closest_vertex]
-            brace_locations[int(lbl)] = {"center_location": np.array(outer_mesh.vertices)[closest_vertex].tolist(), 
-                                    "normal_vector": closest_vertex_normal.tolist()}
-        if lbl in [23, 24, 25, 26, 27, 28, 33, 34, 35, 36, 37, 38]:
-            outer_mesh = tooth_mesh.select_by_index(np.where(np.array(tooth_mesh.vertex_normals)[:,0]>=0)[0])
-            if lbl in [25, 26, 27, 28, 35, 36, 37, 38]:
-                outer_mesh = outer_mesh.select_by_index(np.argsort(np.array(outer_mesh.vertices)[:,0])[-len(outer_mesh.vertices)//3:])
-            center = np.mean(np.array(outer_mesh.vertices), axis=0)
-            # find the vertex that is closest to the center
-            closest_vertex = np.argmin(np.linalg.norm(np.array(outer_mesh.vertices)-center, axis=1))
-            closest_vertex_normal = np.array(outer_mesh.vertex_normals)[closest_vertex]
-            brace_locations[int(lbl)] = {"center_location": np.array(outer_mesh.vertices)[closest_vertex].tolist(), 
-                                    "normal_vector": closest_vertex_normal.tolist()}
-
-        tooth_mesh.compute_vertex_normals()
-        o3d.io.write_triangle_mesh(ind_dir + f"/tooth_{lbl}.stl", tooth_mesh)
+        if lbl in INCISOR_LABELS + RIGHT_LABELS + LEFT_LABELS and not np.any(candidate_labels == lbl):
+            raise ValueError(f"tooth {lbl} has no vertices on its facial side")
+    if candidate_ids.shape[0] == 0:
+        return brace_locations
+    #vertex closest to the centroid of its tooth's candidates
+    unique_labels, inverse = np.unique(candidate_labels, return_inverse=True)
+    counts = np.bincount(inverse)
+    centers = np.stack([np.bincount(inverse, weights=vertices[candidate_ids,axis]) for axis in range(3)], axis=1) / counts[:,None]
+    distances = np.linalg.norm(vertices[candidate_ids] - centers[inverse], axis=1)
+    order = np.lexsort((distances, inverse))
+    closest = candidate_ids[order[np.concatenate([[0], np.cumsum(counts)[:-1]])]]
+    for lbl, vertex_id in zip(unique_labels, closest):
+        brace_locations[int(lbl)] = {"center_location": vertices[vertex_id].tolist(), 
+                                "normal_vector": normals[vertex_id].tolist()}
     return brace_locations
 
+def save_tooth_and_get_brace_location(mesh, label_arr, ind_dir):
+    """ind_dir: the mesh of each tooth is written here, None only returns the brace locations"""
+    brace_locations = get_brace_locations(np.asarray(mesh.vertices), np.asarray(mesh.vertex_normals), np.asarray(mesh.triangles), label_arr)
+    if ind_dir is not None:
+        for lbl in np.unique(label_arr):
+            save_tooth(mesh, label_arr, lbl, ind_dir)
+    return brace_locations
+
+def save_tooth(mesh, label_arr, lbl, ind_dir):
+    """writes ind_dir/tooth_{lbl}.stl, or removes it if no vertex has the label(eg: a tooth removed by a user edit)"""
+    tooth_path = ind_dir + f"/tooth_{lbl}.stl"
+    if not np.any(label_arr == lbl):
+        if os.path.exists(tooth_path):
+            os.remove(tooth_path)
+        return
+    tooth_mesh = get_mesh_of_each_tooth(mesh, label_arr, lbl)
+    tooth_mesh.compute_vertex_normals()
+    o3d.io.write_triangle_mesh(tooth_path, tooth_mesh)
 
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -126,12 +182,20 @@ class NpEncoder(json.JSONEncoder):
 
 
 class ScanSegmentation():  # SegmentationAlgorithm is not inherited in this class anymore
-    def __init__(self, model):
+    def __init__(self, model, result_cache=None, max_contexts=8):
         """
         Write your own input validators here
         Initialize your model etc.
+        result_cache: ResultCache(see result_cache.py) of the tgnet pipeline, None segments every scan
+        max_contexts: results kept for resegment(keep_context=True), least recently used ones are dropped beyond it
         """
         self.chl_pipeline = model
+        self.result_cache = result_cache
+        self.max_contexts = max_contexts
+        #context id => {"jaw", "pipeline_context", "mesh", "braces_location", "output_path", "output_format", "lock"}
+        self.contexts = OrderedDict()
+        self.context_lock = threading.Lock()
+        self.context_count = 0
 
         #self.model = load_model()
         #sef.device = "cuda"
@@ -151,11 +215,20 @@ class ScanSegmentation():  # SegmentationAlgorithm is not inherited in this clas
         return inputs
 
     @staticmethod
-    def write_output(labels, instances, jaw, output_path):
+    def write_output(labels, instances, jaw, output_path, output_format="json"):
         """
         Write to /output/dental-labels.json your predicted labels and instances
         Check https://grand-challenge.org/components/interfaces/outputs/
+        output_format: json | npz(uint8 labels and instances, written next to output_path with the .npz extension)
+        the file is written atomically, a crash does not leave a partial output
         """
+        if output_format == "npz":
+            with atomic_path(ScanSegmentation.get_output_file_path(output_path, output_format)) as tmp_path, open(tmp_path, "wb") as f:
+                np.savez_compressed(f, labels=as_uint8_labels(labels), instances=as_uint8_labels(instances), jaw=jaw)
+            return
+        elif output_format != "json":
+            raise ValueError(f"unknown output format {output_format}, json | npz")
+
         pred_output = {'id_patient': "",
                        'jaw': jaw,
                        'labels': labels,
@@ -164,11 +237,20 @@ class ScanSegmentation():  # SegmentationAlgorithm is not inherited in this clas
 
         # just for testing
         #with open('./test/test_local/expected_output.json', 'w') as fp:
-        with open(output_path, 'w') as fp:
+        with atomic_path(output_path) as tmp_path, open(tmp_path, 'w') as fp:
             json.dump(pred_output, fp, cls=NpEncoder)
 
         return
 
+    @staticmethod
+    def get_output_file_path(output_path, output_format="json"):
+        """path of the labels file that write_output writes"""
+        return os.path.splitext(output_path)[0] + ".npz" if output_format == "npz" else output_path
+
+    @staticmethod
+    def get_braces_location_path(output_path):
+        return output_path.replace("_labels.json", "_braces_location.json")
+
     @staticmethod
     def get_jaw(scan_path):
         try:
@@ -188,21 +270,38 @@ class ScanSegmentation():  # SegmentationAlgorithm is not inherited in this clas
 
         return jaw
 
-    def predict(self, scan_path, jaw):
+    def predict(self, scan_path, jaw, preset=None, context=None):
         """
         Your algorithm goes here
+        preset: tgnet only, speed/accuracy preset of this scan(see TGNET_PRESETS in inference_pipeline_maker.py). None is the default of the pipeline.
+        context: tgnet only, dict that receives the context of the result under "pipeline_context", see resegment. None does not keep it.
+        returns labels, instances, stage_timing(None if the pipeline does not time its stages)
         """
-
+        kwargs = {}
+        if preset is not None:
+            kwargs["preset"] = preset
+        if context is not None:
+            kwargs["keep_context"] = True
         try:
-            pred_result = self.chl_pipeline(scan_path, jaw)
-            if jaw == "lower":
-                pred_result["sem"][pred_result["sem"]>0] += 20
-            elif jaw=="upper":
-                pass
+            pred_result = self.chl_pipeline(scan_path, jaw, **kwargs)
         except Exception as e:
             print(str(e))
             print(traceback.format_exc())
             raise
+        if context is not None:
+            context["pipeline_context"] = pred_result.pop("context")
+        return self.get_labels(pred_result, jaw)
+
+    @staticmethod
+    def get_labels(pred_result, jaw):
+        """
+        pred_result: output of the pipeline({"sem", "ins", ...})
+        returns labels, instances, stage_timing(None if the pipeline does not time its stages)
+        """
+        if jaw == "lower":
+            pred_result["sem"][pred_result["sem"]>0] += 20
+        elif jaw=="upper":
+            pass
 
         # extract number of vertices from mesh
         nb_vertices = pred_result["sem"].shape[0]
@@ -215,26 +314,182 @@ class ScanSegmentation():  # SegmentationAlgorithm is not inherited in this clas
         except AssertionError as e:
             raise Exception(e.args)
 
-        return labels, instances
+        return labels, instances, pred_result.get("stage_timing")
 
-    def process(self, input_path, output_path, jaw):
+    def get_cached_result(self, input_mesh, jaw, preset, compute, timer):
+        """
+        compute: function that returns {"labels", "instances", "braces_location"} of the scan
+        returns the result(from the result cache if the scan was segmented before), the cache status(hit | miss | coalesced, None without a cache)
+        """
+        if self.result_cache is None:
+            return compute(), None
+        with timer.measure("cache_key"):
+            key = self.result_cache.get_key(input_mesh, jaw, self.chl_pipeline.config.get("preset") if preset is None else preset)
+        result, status = self.result_cache.get_or_compute(key, compute)
+        timer.annotate("result_cache", status)
+        return result, status
+
+    def is_cached(self, input_mesh, jaw, preset=None):
+        """whether the result of the scan is in the result cache, eg: to skip its pipeline stages"""
+        if self.result_cache is None:
+            return False
+        return self.result_cache.contains(self.result_cache.get_key(input_mesh, jaw, self.chl_pipeline.config.get("preset") if preset is None else preset))
+
+    def segment(self, input_mesh, jaw, preset=None, keep_context=False):
+        """
+        segmentation without any file output, eg: for a mesh uploaded to inference_server
+        input_mesh: scan file path, or (vertices (n, 3), faces (m, 3)) arrays
+        keep_context: tgnet only, keeps the result for the incremental re-segmentation of user edits(see resegment), the result cache is not used
+        returns {"labels", "instances", "braces_location", "stage_timing"}, and "context_id" with keep_context
+        """
+        timer = StageTimer()
+        context = {} if keep_context else None
+        def compute():
+            labels, instances, stage_timing = self.predict(scan_path=input_mesh, jaw=jaw, preset=preset, context=context)
+            timer.extend(stage_timing)
+            with timer.measure("mesh_reload"):
+                mesh = read_jaw_mesh(input_mesh, jaw, creating_color_mesh=True).remove_duplicated_vertices()
+            with timer.measure("brace_location"):
+                braces_location = save_tooth_and_get_brace_location(mesh, np.array(labels), None)
+            if context is not None:
+                context["mesh"] = mesh
+            return {"labels": labels, "instances": instances, "braces_location": braces_location}
+
+        if keep_context:
+            result = compute()
+            result["context_id"] = self.add_context(context, jaw, result["braces_location"])
+        else:
+            result, _ = self.get_cached_result(input_mesh, jaw, preset, compute, timer)
+        return {**result, "stage_timing": timer.to_dict()}
+
+    def process(self, input_path, output_path, jaw, preset=None, output_format="json", prediction=None, keep_context=False):
         """
         Read input from /input, process with your algorithm and write to /output
         assumption /input contains only 1 file
+        output_format: labels and instances as json | npz, see write_output
+        prediction: labels, instances, stage_timing of the scan if the pipeline ran elsewhere(see get_labels and start_inference.py), None runs it here
+        keep_context: tgnet only, as segment. resegment then rewrites these outputs.
+        returns the stage timing of the pipeline and the export, see stage_timer.py. with keep_context, its "context_id"
         """
-        labels, instances = self.predict(scan_path=input_path, jaw=jaw)
+        timer = StageTimer()
+        ind_dir = output_path.replace("_labels.json", "_individual")
+        context = {} if keep_context else None
+        def export_teeth(labels):
+            with timer.measure("mesh_reload"):
+                # read mesh from obj file
+                mesh = read_jaw_mesh(input_path, jaw, creating_color_mesh=True)
+                mesh = mesh.remove_duplicated_vertices()
+            if context is not None:
+                context["mesh"] = mesh
+
+            # mesh = get_colored_mesh(mesh, np.array(labels))
+            # o3d.io.write_triangle_mesh(output_path.replace(".json", ".obj"), mesh)
+
+            with timer.measure("tooth_export"):
+                os.makedirs(ind_dir, exist_ok=True)
+                return save_tooth_and_get_brace_location(mesh, np.array(labels), ind_dir)
+
+        def compute():
+            labels, instances, stage_timing = prediction if prediction is not None and not keep_context else self.predict(scan_path=input_path, jaw=jaw, preset=preset, context=context)
+            timer.extend(stage_timing)
+            return {"labels": labels, "instances": instances, "braces_location": export_teeth(labels)}
 
-        # read mesh from obj file
-        _, mesh = read_txt_obj_ls(input_path, jaw=jaw, ret_mesh=True, use_tri_mesh=True, creating_color_mesh=True)
-        mesh = mesh.remove_duplicated_vertices()
+        if keep_context:
+            result, cache_status = compute(), None
+        else:
+            result, cache_status = self.get_cached_result(input_path, jaw, preset, compute, timer)
+        labels, instances, braces_location = result["labels"], result["instances"], result["braces_location"]
+        if cache_status in ("hit", "coalesced"):
+            #the tooth meshes were written by an earlier request, maybe to another output path
+            export_teeth(labels)
+        with timer.measure("write_output"):
+            # write output
+            with atomic_path(self.get_braces_location_path(output_path)) as tmp_path, open(tmp_path, 'w') as fp:
+                json.dump(braces_location, fp, indent=4)
 
-        # mesh = get_colored_mesh(mesh, np.array(labels))
-        # o3d.io.write_triangle_mesh(output_path.replace(".json", ".obj"), mesh)
+            self.write_output(labels=labels, instances=instances, jaw=jaw, output_path=output_path, output_format=output_format)
 
-        os.makedirs(output_path.replace("_labels.json", "_individual"), exist_ok=True)
-        braces_location = save_tooth_and_get_brace_location(mesh, np.array(labels), output_path.replace("_labels.json", "_individual"))
-        # write output
-        with open(output_path.replace("_labels.json", "_braces_location.json"), 'w') as fp:
-            json.dump(braces_location, fp, indent=4)
+        result = timer.to_dict()
+        result["scan"] = input_path
+        if keep_context:
+            result["context_id"] = self.add_context(context, jaw, braces_location, output_path=output_path, output_format=output_format)
+        return result
 
-        self.write_output(labels=labels, instances=instances, jaw=jaw, output_path=output_path)
\ No newline at end of file
+    def add_context(self, context, jaw, braces_location, output_path=None, output_format="json"):
+        """context: {"pipeline_context", "mesh"} of a result. returns its id for resegment"""
+        with self.context_lock:
+            self.context_count += 1
+            context_id = str(self.context_count)
+            self.contexts[context_id] = dict(context, jaw=jaw, braces_location=braces_location, output_path=output_path, output_format=output_format, lock=threading.Lock())
+            while len(self.contexts) > self.max_contexts:
+                self.contexts.popitem(last=False)
+        return context_id
+
+    def resegment(self, context_id, vertex_ids=None, label=None, instance=None):
+        """
+        incremental re-segmentation of a result kept with keep_context=True after a user edit, see InferencePipeLine.resegment of tgnet
+            vertex_ids, label: the user painted these vertices(of the mesh without duplicated vertices, as the labels) as tooth label. 0 is the gingiva.
+            instance, label: the user relabeled the teeth of a whole instance.
+        only the brace locations of the touched teeth are recomputed. a result written by process is rewritten, with the meshes of the touched teeth only.
+        the edit is kept, the next resegment of context_id starts from it.
+        returns {"labels", "instances", "braces_location", "touched"(labels of the teeth whose vertices changed), "stage_timing"}
+        """
+        with self.context_lock:
+            if context_id not in self.contexts:
+                raise KeyError(f"unknown context {context_id}, it was never kept or it was dropped(see max_contexts)")
+            self.contexts.move_to_end(context_id)
+            context = self.contexts[context_id]
+        vertex_ids = self.check_edit(context, vertex_ids, label, instance)
+
+        #edits of one result apply in order
+        with context["lock"]:
+            timer = StageTimer()
+            jaw = context["jaw"]
+            lower = jaw == "lower"
+            pred_result = self.chl_pipeline.resegment(context["pipeline_context"], vertex_ids=vertex_ids, label=label - 20 if lower and label > 0 else label, instance=instance)
+            #the context is updated once the outputs are written, a failed edit leaves the result as it was
+            pipeline_context = pred_result.pop("context")
+            touched = [int(lbl) + 20 if lower and lbl > 0 else int(lbl) for lbl in pred_result.pop("touched")]
+            labels, instances, stage_timing = self.get_labels(pred_result, jaw)
+            timer.extend(stage_timing)
+
+            mesh = context["mesh"]
+            label_arr = np.array(labels)
+            with timer.measure("brace_location"):
+                #the teeth that were not touched are gingiva here, their brace locations do not change
+                braces_location = {lbl: location for lbl, location in context["braces_location"].items() if lbl not in touched}
+                braces_location.update(get_brace_locations(np.asarray(mesh.vertices), np.asarray(mesh.vertex_normals), np.asarray(mesh.triangles), np.where(np.isin(label_arr, touched), label_arr, 0)))
+                braces_location = dict(sorted(braces_location.items()))
+
+            output_path = context["output_path"]
+            if output_path is not None:
+                with timer.measure("tooth_export"):
+                    ind_dir = output_path.replace("_labels.json", "_individual")
+                    for lbl in touched:
+                        save_tooth(mesh, label_arr, lbl, ind_dir)
+                with timer.measure("write_output"):
+                    with atomic_path(self.get_braces_location_path(output_path)) as tmp_path, open(tmp_path, 'w') as fp:
+                        json.dump(braces_location, fp, indent=4)
+                    self.write_output(labels=labels, instances=instances, jaw=jaw, output_path=output_path, output_format=context["output_format"])
+            context["pipeline_context"], context["braces_location"] = pipeline_context, braces_location
+
+        return {"labels": labels, "instances": instances, "braces_location": braces_location, "touched": touched, "stage_timing": timer.to_dict()}
+
+    @staticmethod
+    def check_edit(context, vertex_ids, label, instance):
+        """raises ValueError for an edit that is not valid for the jaw and the mesh of context. returns vertex_ids as an int array(None for an instance relabel)"""
+        if (vertex_ids is None) == (instance is None):
+            raise ValueError("an edit has either vertex_ids or an instance")
+        if type(label) not in (int, np.int64) or (label != 0 and label not in JAW_LABELS[context["jaw"]]):
+            raise ValueError(f"label {label} is not 0(gingiva) or a tooth of the {context['jaw']} jaw")
+        if instance is not None:
+            if type(instance) not in (int, np.int64) or instance < 0:
+                raise ValueError(f"instance {instance} is not a non negative integer")
+            return None
+        vertex_ids = np.asarray(vertex_ids)
+        num_vertices = len(context["mesh"].vertices)
+        if vertex_ids.ndim != 1 or vertex_ids.shape[0] == 0 or vertex_ids.dtype.kind not in "iu":
+            raise ValueError("vertex_ids is not a non empty list of vertex indexes")
+        if vertex_ids.min() < 0 or vertex_ids.max() >= num_vertices:
+            raise ValueError(f"vertex_ids out of range, the mesh has {num_vertices} vertices")
+        return vertex_ids
\ No newline at end of file
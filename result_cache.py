@@ -0,0 +1,173 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from mesh_protocol import as_uint8_labels
+
+def get_file_digest(path, chunk_size=2**24):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def get_mesh_digest(source):
+    """
+    source: scan file path(digest of the file bytes), or (vertices (n, 3), faces (m, 3)) arrays of an upload(digest of the float32 vertices and int32 faces)
+    """
+    if type(source) == str:
+        return get_file_digest(source)
+    vertices, faces = source
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(vertices, dtype="<f4").tobytes())
+    sha.update(np.ascontiguousarray(faces, dtype="<i4").tobytes())
+    return sha.hexdigest()
+
+def get_model_digest(config):
+    """digest of the checkpoint contents and of the settings of a tgnet inference config that change the results(see get_tgnet_inference_config)"""
+    key = {"presets": config["presets"]}
+    for info_name in ["fps_model_info", "boundary_model_info"]:
+        model_parameter = {name: value for name, value in config[info_name]["model_parameter"].items() if name != "inference_chunk_size"}
+        key[info_name] = [get_file_digest(config[info_name]["load_ckpt_path"]), model_parameter]
+    for name in ["inference_profile", "device", "early_exit_threshold"]:
+        key[name] = str(config.get(name))
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+class ResultCache:
+    """
+    on disk cache of the segmentation results({"labels", "instances", "braces_location"}) of scans, least recently used entries are evicted beyond max_bytes.
+    concurrent requests of the same key are computed once, the others wait for that result.
+    usage:
+        cache = ResultCache("result_cache", get_model_digest(pipeline.config))
+        result, status = cache.get_or_compute(cache.get_key(scan_path, jaw, preset), compute)
+        cache.get_stats()
+    """
+    def __init__(self, cache_dir, model_digest, max_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.model_digest = model_digest
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        #key => future of the request that computes it
+        self.inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+        #key => file size, least recently used first. entries of earlier runs are ordered by their access time(mtime)
+        self.entries = OrderedDict()
+        paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".npz")]
+        for path in sorted(paths, key=os.path.getmtime):
+            self.entries[os.path.basename(path)[:-len(".npz")]] = os.path.getsize(path)
+        self.total_bytes = sum(self.entries.values())
+
+    def get_key(self, source, jaw, preset):
+        """source: scan file path or (vertices, faces) arrays, preset: preset name of the request, resolved to the pipeline default by the caller"""
+        key = json.dumps([self.model_digest, get_mesh_digest(source), jaw, preset])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        """cached result or None"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with np.load(self.get_path(key)) as npz:
+                result = {
+                    "labels": npz["labels"].astype(int).tolist(),
+                    "instances": npz["instances"].astype(int).tolist(),
+                    "braces_location": {int(label): location for label, location in json.loads(str(npz["braces_location"])).items()},
+                }
+            os.utime(self.get_path(key))
+            return result
+        except (OSError, ValueError, KeyError):
+            #evicted by another process that shares the directory, or a broken file
+            self.remove(key)
+            return None
+
+    def put(self, key, result):
+        path = self.get_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, labels=as_uint8_labels(result["labels"]), instances=as_uint8_labels(result["instances"]), braces_location=json.dumps(result["braces_location"]))
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+            self.entries[key] = os.path.getsize(path)
+            self.total_bytes += self.entries[key]
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                evicted_key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                evicted.append(evicted_key)
+            self.stats["evictions"] += len(evicted)
+        for evicted_key in evicted:
+            try:
+                os.remove(self.get_path(evicted_key))
+            except OSError:
+                pass
+
+    def remove(self, key):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+    def get_or_compute(self, key, compute):
+        """
+        compute: function that returns the result of key, called only on a miss
+        returns result, status(hit | miss | coalesced). a coalesced request gets the result(or the exception) of the request that computed it.
+        """
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = concurrent.futures.Future()
+            else:
+                self.stats["coalesced"] += 1
+        if not owner:
+            return future.result(), "coalesced"
+
+        try:
+            result = self.get(key)
+            status = "hit" if result is not None else "miss"
+            with self.lock:
+                self.stats["hits" if status == "hit" else "misses"] += 1
+            if result is None:
+                result = compute()
+                try:
+                    self.put(key, result)
+                except OSError as e:
+                    #the result is still returned, eg: when the disk is full
+                    print(f"result cache write failed: {e}")
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+        return result, status
+
+    def get_stats(self):
+        """hit_rate counts the coalesced requests as hits, they did not run the pipeline"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.total_bytes
+        stats["max_bytes"] = self.max_bytes
+        stats["requests"] = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = (stats["hits"] + stats["coalesced"]) / stats["requests"] if stats["requests"] > 0 else None
+        return stats
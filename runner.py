@@ -1,8 +1,11 @@
 from trainer import Trainer
 from generator import DentalModelGenerator
-from torch.utils.data import DataLoader
+import gen_utils as gu
+from torch.utils.data import DataLoader, Sampler
 import os
+import math
 import torch
+from dist_utils import get_rank, get_world_size, is_main_process
 
 def collate_fn(batch):
     output = {}
@@ -13,11 +16,62 @@ def collate_fn(batch):
                 output[key] = []
             output[key].append(batch_item[key])
     
-    for output_key in output.keys():
-        if output_key in ["feat", "gt_seg_label", "uniform_feat", "uniform_gt_seg_label"]:
-            output[output_key] = torch.stack(output[output_key])
+    #point tensors are stacked, or packed along the point axis with an "offset" if the point counts differ
+    for output_key in list(output.keys()):
+        if type(output[output_key][0]) == torch.Tensor:
+            output[output_key], offset = gu.stack_point_tensors(output[output_key])
+            if offset is not None:
+                output["offset"] = offset
     return output
 
+class ResumableRandomSampler(Sampler):
+    """Random sampler whose order only depends on (seed, epoch).
+
+    A resumed run gets the same permutation back and can start in the middle of it.
+    With several training processes every process draws the same permutation and takes every num_replicas-th item,
+    padded with the first items so all processes run the same number of steps(as DistributedSampler).
+    """
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = math.ceil(len(self.data_source) / self.num_replicas)
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        self.start_index = start_index
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=g).tolist()
+        indices += indices[:self.num_samples * self.num_replicas - len(indices)]
+        indices = indices[self.rank::self.num_replicas]
+        start_index, self.start_index = self.start_index, 0
+        return iter(indices[start_index:])
+
+    def __len__(self):
+        #full epoch length, so batch indexes keep counting from the start of the epoch after a resume
+        return self.num_samples
+
+class ShardSampler(Sampler):
+    """
+    sequential sampler over the rank-th shard, without padding so validation losses are not biased by repeated cases
+    """
+    def __init__(self, data_source, num_replicas=1, rank=0):
+        self.indices = list(range(len(data_source)))[rank::num_replicas]
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
 def get_mesh_path(basename):
     case_name = basename.split("_")[0]
     file_name = basename.split("_")[0]+"_"+basename.split("_")[1]+".obj"
@@ -25,33 +79,35 @@ def get_mesh_path(basename):
 
 def get_generator_set(config, is_test=False):
     if not is_test:
+        train_dataset = DentalModelGenerator(
+            config["input_data_dir_path"], 
+            aug_obj_str=config["aug_obj_str"],
+            split_with_txt_path=config["train_data_split_txt_path"]
+        )
         point_loader = DataLoader(
-            DentalModelGenerator(
-                config["input_data_dir_path"], 
-                aug_obj_str=config["aug_obj_str"],
-                split_with_txt_path=config["train_data_split_txt_path"]
-            ), 
-            shuffle=True,
+            train_dataset, 
+            sampler=ResumableRandomSampler(train_dataset, config.get("shuffle_seed", 0), get_world_size(), get_rank()),
             batch_size=config["train_batch_size"],
             collate_fn=collate_fn
         )
 
+        val_dataset = DentalModelGenerator(
+            config["input_data_dir_path"], 
+            aug_obj_str=None,
+            split_with_txt_path=config["val_data_split_txt_path"]
+        )
         val_point_loader = DataLoader(
-            DentalModelGenerator(
-                config["input_data_dir_path"], 
-                aug_obj_str=None,
-                split_with_txt_path=config["val_data_split_txt_path"]
-
-            ), 
-            shuffle=False,
+            val_dataset, 
+            sampler=ShardSampler(val_dataset, get_world_size(), get_rank()),
             batch_size=config["val_batch_size"],
             collate_fn= collate_fn
         )
         return [point_loader, val_point_loader]
 
-def runner(config, model):
+def runner(config, model, resume_path=None):
     gen_set = [get_generator_set(config["generator"], False)]
-    print("train_set", len(gen_set[0][0]))
-    print("validation_set", len(gen_set[0][1]))
-    trainner = Trainer(config=config, model = model, gen_set=gen_set)
+    if is_main_process():
+        print("train_set", len(gen_set[0][0]))
+        print("validation_set", len(gen_set[0][1]))
+    trainner = Trainer(config=config, model = model, gen_set=gen_set, resume_path=resume_path)
     trainner.run()
\ No newline at end of file
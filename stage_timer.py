@@ -0,0 +1,110 @@
+import contextlib
+import os
+import sys
+import time
+import torch
+
+try:
+    import resource
+except ImportError:
+    #windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def get_rss_mb():
+    """current resident set size of the process. None if it can not be read."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    return None
+
+def get_peak_rss_mb():
+    """peak resident set size of the process since it started. None if it can not be read."""
+    if resource is not None:
+        #kilobytes on linux, bytes on macos
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == "darwin" else 2**10)
+    if psutil is not None and hasattr(psutil.Process().memory_info(), "peak_wset"):
+        return psutil.Process().memory_info().peak_wset / 2**20
+    return None
+
+class StageTimer:
+    """
+    wall time, cpu time, rss and torch tensor memory of the stages of one request.
+    cpu_ms is the cpu time of the whole process(all threads), it includes the other requests that run at the same time.
+    peak_rss_mb is the peak of the process so far, it only grows.
+    tensor_mb is the cuda memory allocated by torch at the end of the stage and tensor_delta_mb its change over the stage, None on cpu. they count the tensors of the other requests too.
+    cuda kernels are asynchronous, without cuda_sync the wall time of a stage is the time until its results are read back on the host(eg: torch_to_numpy).
+    cuda_sync: synchronizes the device around each stage and records tensor_peak_mb, the cuda peak of the stage. for profiling only:
+        it serializes the gpu work, and the peak counter is global to the process, so the peaks are wrong when requests run at the same time.
+    usage:
+        timer = StageTimer(device)
+        with timer.measure("fps"):
+            ...
+        timer.annotate("early_exit", {...})
+        timer.to_dict()
+    """
+    def __init__(self, device=None, enabled=True, cuda_sync=False):
+        self.device = torch.device(device) if device is not None else None
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync
+        self.stages = []
+        #other per request telemetry, added to to_dict()
+        self.info = {}
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        if not self.enabled:
+            yield
+            return
+        use_cuda = self.device is not None and self.device.type == "cuda"
+        if use_cuda and self.cuda_sync:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        tensor_start = torch.cuda.memory_allocated(self.device) if use_cuda else None
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            if use_cuda and self.cuda_sync:
+                #the stage ends when its kernels end
+                torch.cuda.synchronize(self.device)
+            stage = {
+                "name": name,
+                "wall_ms": (time.perf_counter() - wall_start) * 1000,
+                "cpu_ms": (time.process_time() - cpu_start) * 1000,
+                "rss_mb": get_rss_mb(),
+                "peak_rss_mb": get_peak_rss_mb(),
+                "tensor_mb": None,
+                "tensor_delta_mb": None,
+            }
+            if use_cuda:
+                tensor_end = torch.cuda.memory_allocated(self.device)
+                stage["tensor_mb"] = tensor_end / 2**20
+                stage["tensor_delta_mb"] = (tensor_end - tensor_start) / 2**20
+                if self.cuda_sync:
+                    stage["tensor_peak_mb"] = torch.cuda.max_memory_allocated(self.device) / 2**20
+            self.stages.append(stage)
+
+    def annotate(self, key, value):
+        if self.enabled:
+            self.info[key] = value
+
+    def extend(self, stage_timing):
+        """appends the stages(and the annotations) of another timer's to_dict(), eg: the pipeline stages before the export stages"""
+        if self.enabled and stage_timing is not None:
+            self.stages += stage_timing["stages"]
+            self.info.update({key: value for key, value in stage_timing.items() if key not in ("total_wall_ms", "stages")})
+
+    def to_dict(self):
+        return {
+            "total_wall_ms": (time.perf_counter() - self.start) * 1000,
+            "stages": self.stages,
+            **self.info,
+        }
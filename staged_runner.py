@@ -0,0 +1,100 @@
+import itertools
+import queue
+import threading
+import time
+
+class StagedRunner:
+    """
+    runs items through stages in worker threads, eg: the cpu stages of tgnet(mesh load, clustering, export) of some scans overlap with the forwards of others.
+    stages: [(name, function(item) => item, worker group name)], each item goes through them in order.
+    workers: {worker group name: number of threads}. the stages of a group share its threads and its queue, later stages first so that started items finish before new ones start.
+    max_in_flight: items between the first and the last stage, it bounds the queued items(and their memory) as the groups feed each other both ways.
+    usage:
+        runner = StagedRunner([("load", load, "cpu"), ("forward", forward, "model"), ("export", export, "cpu")], {"cpu": 2, "model": 1})
+        for item, error in runner.run(items):   #in completion order, error is None or the exception of the failed stage(item is its input)
+            ...
+        runner.get_stats()
+    """
+    def __init__(self, stages, workers, max_in_flight=4):
+        for name, _, group in stages:
+            if group not in workers:
+                raise ValueError(f"stage {name} has no workers, unknown group {group}")
+        self.stages = stages
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.lock = threading.Lock()
+        self.stage_stats = {name: {"items": 0, "busy_s": 0.0, "wait_s": 0.0} for name, _, _ in stages}
+        self.group_busy = {group: 0.0 for group in workers}
+        self.wall_s = 0.0
+
+    def run(self, items):
+        items = list(items)
+        queues = {group: queue.PriorityQueue() for group in self.workers}
+        done = queue.Queue()
+        in_flight = threading.Semaphore(self.max_in_flight)
+        counter = itertools.count()
+
+        def put(stage_index, item):
+            #(priority, arrival order, ...), the arrival order also keeps the items out of the comparison
+            queues[self.stages[stage_index][2]].put((-stage_index, next(counter), time.perf_counter(), stage_index, item))
+
+        def work(group):
+            while True:
+                _, _, put_time, stage_index, item = queues[group].get()
+                if stage_index is None:
+                    return
+                name, function, _ = self.stages[stage_index]
+                start = time.perf_counter()
+                error = None
+                try:
+                    item = function(item)
+                except Exception as e:
+                    error = e
+                busy = time.perf_counter() - start
+                with self.lock:
+                    self.stage_stats[name]["items"] += 1
+                    self.stage_stats[name]["busy_s"] += busy
+                    self.stage_stats[name]["wait_s"] += start - put_time
+                    self.group_busy[group] += busy
+                if error is not None or stage_index == len(self.stages) - 1:
+                    done.put((item, error))
+                else:
+                    put(stage_index + 1, item)
+
+        def feed():
+            for item in items:
+                in_flight.acquire()
+                put(0, item)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for group, num_threads in self.workers.items():
+            threads += [threading.Thread(target=work, args=(group,), daemon=True) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in range(len(items)):
+                item, error = done.get()
+                in_flight.release()
+                yield item, error
+        finally:
+            #the stop entries sort after every item
+            for group, num_threads in self.workers.items():
+                for _ in range(num_threads):
+                    queues[group].put((1, next(counter), 0, None, None))
+            with self.lock:
+                self.wall_s += time.perf_counter() - start
+
+    def get_stats(self):
+        """busy and queue wait seconds per stage, utilization(busy time / wall time of its threads) per worker group"""
+        with self.lock:
+            stats = {"wall_s": self.wall_s, "stages": {}, "workers": {}}
+            for name, stat in self.stage_stats.items():
+                stats["stages"][name] = dict(stat, mean_ms=stat["busy_s"] * 1000 / stat["items"] if stat["items"] > 0 else None)
+            for group, num_threads in self.workers.items():
+                stats["workers"][group] = {
+                    "threads": num_threads,
+                    "busy_s": self.group_busy[group],
+                    "utilization": self.group_busy[group] / (self.wall_s * num_threads) if self.wall_s > 0 else None,
+                }
+        return stats
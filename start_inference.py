@@ -1,10 +1,15 @@
 import sys
 import os
+import json
 sys.path.append(os.getcwd())
 from inference_pipelines.inference_pipeline_maker import make_inference_pipeline
-from glob import glob
 import argparse
+import time
+import traceback
+import batch_manifest
 from predict_utils import ScanSegmentation
+from result_cache import ResultCache, get_model_digest, get_file_digest
+from staged_runner import StagedRunner
 
 parser = argparse.ArgumentParser(description='Inference models')
 parser.add_argument('--input_dir_path', default="G:/tooth_seg/main/all_datas/chl/3D_scans_per_patient_obj_files", type=str, help = "input directory path that contain obj files.")
@@ -13,19 +18,139 @@ parser.add_argument('--save_path', type=str, default="test_results", help = "res
 parser.add_argument('--model_name', type=str, default="tgnet", help = "model name. list: tsegnet | tgnet | pointnet | pointnetpp | dgcnn | pointtransformer")
 parser.add_argument('--checkpoint_path', default="ckpts/tgnet_fps" ,type=str,help = "checkpoint path.")
 parser.add_argument('--checkpoint_path_bdl', default="ckpts/tgnet_bdl" ,type=str,help = "checkpoint path(for tgnet_bdl).")
+parser.add_argument('--checkpoint_ext', default=".h5", type=str, help = "tgnet only. .h5 | .inference.pt(exported by export_inference_ckpt.py, memory mapped)")
+parser.add_argument('--inference_chunk_size', default=None, type=int, help = "tgnet only. attend this many points at a time in the point transformer layers to bound memory, eg: 4096. default: all points at once.")
+parser.add_argument('--device', default="cuda", type=str, help = "tgnet only. cuda | cpu")
+parser.add_argument('--inference_profile', default="fp32", type=str, help = "tgnet only. fp32 | int8(cpu only, dynamic int8 linear layers) | bf16. batch norm is folded into the linear layers for every profile.")
+parser.add_argument('--stage_timing_path', default=None, type=str, help = "tgnet only. the per stage timing of each scan is appended to this json lines file, eg: test_results/stage_timing.jsonl")
+parser.add_argument('--preset', default="accurate", type=str, help = "tgnet only. accurate | balanced | fast, fewer points and smaller crops for faster inference. see TGNET_PRESETS in inference_pipeline_maker.py")
+parser.add_argument('--early_exit_threshold', default=None, type=float, help = "tgnet only. the boundary module is skipped for scans whose boundary score(printed per scan) is below this, eg: 0.1. default: always run it.")
+parser.add_argument('--log_boundary_score', action='store_true', help = "tgnet only. computes and prints the boundary score of each scan without --early_exit_threshold, to choose a threshold.")
+parser.add_argument('--output_format', default="json", type=str, help = "json | npz. npz stores the labels and instances as uint8 arrays, much smaller and faster to write than json.")
+parser.add_argument('--result_cache_dir', default=None, type=str, help = "tgnet only. scans segmented before(same file content, checkpoints and preset) reuse the cached labels, eg: test_results/result_cache")
+parser.add_argument('--result_cache_max_mb', default=1024, type=int, help = "least recently used results are evicted beyond this size.")
+parser.add_argument('--prepared_cache_dir', default=None, type=str, help = "tgnet only. cache directory for the prepared modules, eg: ckpts/prepared")
+parser.add_argument('--sequential', action='store_true', help = "tgnet only. one scan at a time. by default the cpu stages of some scans(mesh load, fps, clustering, export) overlap with the forwards of others, see staged_runner.py")
+parser.add_argument('--loader_workers', default=2, type=int, help = "tgnet only. threads that load and sample the next scans.")
+parser.add_argument('--post_workers', default=2, type=int, help = "tgnet only. threads of the cpu stages after the forwards(clustering, boundary selection, label merge, export).")
+parser.add_argument('--max_in_flight', default=4, type=int, help = "tgnet only. scans loaded but not yet written, bounds the memory of the queued scans.")
+parser.add_argument('--manifest_path', default=None, type=str, help = "the cases of input_dir_path are listed once into this file(json lines), later runs and the other shards read it instead of walking the archive, eg: test_results/manifest.jsonl")
+parser.add_argument('--shard', default="0/1", type=str, help = "i/n, process every n-th case of the manifest from the i-th(i counts from 0), eg: 2/8 on the third of eight nodes.")
+parser.add_argument('--overwrite', action='store_true', help = "also process the cases already done. by default a case is skipped if its outputs exist with a done record of the same model digest and output format.")
 args = parser.parse_args()
 
-stl_path_ls = []
-for dir_path in [
-    x[0] for x in os.walk(args.input_dir_path)
-    ][1:]:
-    if os.path.basename(dir_path): 
-        stl_path_ls += glob(os.path.join(dir_path,"*.stl"))
-
-pred_obj = ScanSegmentation(make_inference_pipeline(args.model_name, [args.checkpoint_path+".h5", args.checkpoint_path_bdl+".h5"]))
+pipeline = make_inference_pipeline(args.model_name, [args.checkpoint_path+args.checkpoint_ext, args.checkpoint_path_bdl+args.checkpoint_ext], args.inference_chunk_size, args.device, args.inference_profile, args.prepared_cache_dir, args.preset, args.early_exit_threshold, log_boundary_score=args.log_boundary_score)
+result_cache = None
+if args.result_cache_dir is not None:
+    if args.model_name != "tgnet":
+        raise "result_cache_dir is tgnet only"
+    result_cache = ResultCache(args.result_cache_dir, get_model_digest(pipeline.config), args.result_cache_max_mb * 2**20)
+pred_obj = ScanSegmentation(pipeline, result_cache)
 os.makedirs(args.save_path, exist_ok=True)
 
-for i in range(len(stl_path_ls)):
-    print(f"Processing: ", i,":",stl_path_ls[i])
-    base_name = os.path.basename(stl_path_ls[i]).split(".")[0]
-    pred_obj.process(stl_path_ls[i], os.path.join(args.save_path, os.path.basename(stl_path_ls[i]).replace(".stl", ".json")))
\ No newline at end of file
+#what the done records of the outputs must match
+run_info = {
+    "model_name": args.model_name,
+    "model_digest": get_model_digest(pipeline.config) if args.model_name == "tgnet" else get_file_digest(args.checkpoint_path+args.checkpoint_ext),
+    "output_format": args.output_format,
+}
+cases = batch_manifest.get_shard(batch_manifest.load_or_make_manifest(args.manifest_path, args.input_dir_path, ScanSegmentation.get_jaw), args.shard)
+
+def write_stage_timing(stage_timing):
+    if args.stage_timing_path is not None:
+        with open(args.stage_timing_path, "a") as f:
+            f.write(json.dumps(stage_timing) + "\n")
+
+def get_output_path(stl_path):
+    return os.path.join(args.save_path, os.path.basename(stl_path).replace(".stl", "_labels.json"))
+
+todo_cases = [case for case in cases if args.overwrite or not batch_manifest.is_done(get_output_path(case["scan"]), run_info)]
+print(f"shard {args.shard}: {len(cases)} cases, {len(cases) - len(todo_cases)} already done")
+batch_log_path = os.path.join(args.save_path, "batch_log_{}_of_{}.jsonl".format(*batch_manifest.parse_shard(args.shard)))
+
+def finish_case(case, stage_timing, error):
+    """writes the done record of a processed case and its line of the batch log(status, timing or error)"""
+    log = {"scan": case["scan"], "status": "done" if error is None else "failed", "time": time.time()}
+    if error is None:
+        output_path = get_output_path(case["scan"])
+        outputs = [ScanSegmentation.get_output_file_path(output_path, args.output_format), ScanSegmentation.get_braces_location_path(output_path)]
+        batch_manifest.write_done(output_path, run_info, outputs, stage_timing.get("total_wall_ms"))
+        write_stage_timing(stage_timing)
+        log["total_wall_ms"] = stage_timing.get("total_wall_ms")
+        early_exit = stage_timing.get("early_exit")
+        if early_exit is not None and early_exit["boundary_score"] is not None:
+            print(f"boundary score {early_exit['boundary_score']:.4f}" + (", boundary module skipped" if early_exit["skipped"] else ""), ":", case["scan"])
+            log["boundary_score"] = early_exit["boundary_score"]
+    else:
+        print(f"Failed: ", case["scan"])
+        print("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+        log["error"] = repr(error)
+    with open(batch_log_path, "a") as f:
+        f.write(json.dumps(log) + "\n")
+    return error is None
+
+def run_staged():
+    """
+    the stages of the tgnet pipeline(see InferencePipeLine.infer) in worker groups: loader threads, one model thread for both forwards and the post processing threads.
+    returns the runner, for its utilization stats
+    """
+    def load(item):
+        print(f"Processing: ", item["index"],":",item["scan_path"])
+        #cached scans skip the pipeline stages, process reads their result
+        item["state"] = None if pred_obj.is_cached(item["scan_path"], item["jaw"]) else pipeline.load_scan(item["scan_path"], item["jaw"])
+        return item
+
+    def state_stage(function):
+        def run(item):
+            if item["state"] is not None:
+                function(item["state"])
+            return item
+        return run
+
+    def merge_labels(item):
+        if item["state"] is not None:
+            item["prediction"] = ScanSegmentation.get_labels(pipeline.merge_labels(item.pop("state")), item["jaw"])
+        return item
+
+    def export(item):
+        item["stage_timing"] = pred_obj.process(item["scan_path"], get_output_path(item["scan_path"]), item["jaw"], output_format=args.output_format, prediction=item.get("prediction"))
+        return item
+
+    runner = StagedRunner([
+        ("load", load, "loader"),
+        ("first_forward", state_stage(pipeline.run_first_forward), "model"),
+        ("boundary_selection", state_stage(pipeline.select_boundary), "post"),
+        ("boundary_forward", state_stage(pipeline.run_boundary_forward), "model"),
+        ("label_merge", merge_labels, "post"),
+        ("export", export, "post"),
+    ], {"loader": args.loader_workers, "model": 1, "post": args.post_workers}, args.max_in_flight)
+    items = [{"index": i, "scan_path": case["scan"], "jaw": case["jaw"], "case": case} for i, case in enumerate(todo_cases)]
+    num_done = 0
+    for item, error in runner.run(items):
+        num_done += finish_case(item["case"], item.get("stage_timing"), error)
+    return runner, num_done
+
+if args.model_name == "tgnet" and not args.sequential:
+    runner, num_done = run_staged()
+    stats = runner.get_stats()
+    if len(todo_cases) > 0:
+        print(f"staged run: {len(todo_cases)} scans in {stats['wall_s']:.1f}s")
+        for group, stat in stats["workers"].items():
+            print(f"  {group} workers: {stat['threads']} threads, utilization {stat['utilization']:.0%}")
+        for name, stat in stats["stages"].items():
+            print(f"  {name}: {stat['items']} scans, busy {stat['busy_s']:.1f}s, queue wait {stat['wait_s']:.1f}s")
+else:
+    num_done = 0
+    for i, case in enumerate(todo_cases):
+        print(f"Processing: ", i,":",case["scan"])
+        try:
+            stage_timing, error = pred_obj.process(case["scan"], get_output_path(case["scan"]), case["jaw"], output_format=args.output_format), None
+        except Exception as e:
+            stage_timing, error = None, e
+        num_done += finish_case(case, stage_timing, error)
+print(f"shard {args.shard}: {num_done} cases processed, {len(todo_cases) - num_done} failed(see {batch_log_path})")
+
+if hasattr(pred_obj.chl_pipeline, "get_early_exit_stats"):
+    print("boundary module early exit:", json.dumps(pred_obj.chl_pipeline.get_early_exit_stats()))
+if result_cache is not None:
+    print("result cache:", json.dumps(result_cache.get_stats()))
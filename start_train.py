@@ -1,6 +1,8 @@
 from runner import runner
 from train_configs import train_config_maker
+import dist_utils
 import argparse
+import os
 
 parser = argparse.ArgumentParser(description='Inference models')
 parser.add_argument('--model_name', default="tsegnet", type=str, help = "model name. list: tsegnet | tgnet_fps/tgnet_bdl | pointnet | pointnetpp | dgcnn | pointtransformer")
@@ -9,43 +11,76 @@ parser.add_argument('--experiment_name', default="tsegnet_0620", type=str, help
 parser.add_argument('--input_data_dir_path', default="data_preprocessed_path", type=str, help = "input data dir path.")
 parser.add_argument('--train_data_split_txt_path', default="base_name_train_fold.txt", type=str, help = "train cases list file path.")
 parser.add_argument('--val_data_split_txt_path', default="base_name_val_fold.txt", type=str, help = "val cases list file path.")
-args = parser.parse_args()
+parser.add_argument('--resume', default=None, type=str, help = "training state file to resume from. \"auto\" uses {checkpoint_path}_state.pth of this experiment.")
+parser.add_argument('--nprocs', default=1, type=int, help = "number of data parallel training processes to spawn on this machine. not needed when launched with torchrun.")
+parser.add_argument('--dist_backend', default="gloo", type=str, help = "distributed backend. gloo(cpu or gpu) | nccl(gpu)")
+parser.add_argument('--master_port', default="29500", type=str, help = "port for the process group when using --nprocs.")
 
-config = train_config_maker.get_train_config(
-    args.config_path,
-    args.experiment_name,
-    args.input_data_dir_path,
-    args.train_data_split_txt_path,
-    args.val_data_split_txt_path,
-)
+def get_model(model_name, config):
+    if model_name == "tgnet_fps":
+        from models.fps_grouping_network_model import FpsGroupingNetworkModel
+        from models.modules.grouping_network_module import GroupingNetworkModule
+        model = FpsGroupingNetworkModel(config, GroupingNetworkModule)
+    elif model_name == "tsegnet":
+        from models.tsegnet_model import TSegNetModel
+        from models.modules.tsegnet import TSegNetModule
+        model = TSegNetModel(config, TSegNetModule)
+    elif model_name == "dgcnn":
+        from models.dgcnn_model import DGCnnModel
+        from models.modules.dgcnn import DGCnnModule
+        model = DGCnnModel(config, DGCnnModule)
+    elif model_name == "pointnet":
+        from models.pointnet_model import PointFirstModel
+        from models.modules.pointnet import PointFirstModule
+        model = PointFirstModel(config, PointFirstModule)
+    elif model_name == "pointnetpp":
+        from models.pointnet_pp_model import PointPpFirstModel
+        from models.modules.pointnet_pp import PointPpFirstModule
+        model = PointPpFirstModel(config, PointPpFirstModule)
+    elif model_name == "pointtransformer":
+        from models.transformer_model import TransformerModel
+        from models.modules.point_transformer import PointTransformerModule
+        model = TransformerModel(config, PointTransformerModule)
+    elif model_name == "tgnet_bdl":
+        from models.bdl_grouping_netowrk_model import BdlGroupingNetworkModel
+        from models.modules.grouping_network_module import GroupingNetworkModule
+        model = BdlGroupingNetworkModel(config, GroupingNetworkModule)
+    return model
 
-if args.model_name == "tgnet_fps":
-    from models.fps_grouping_network_model import FpsGroupingNetworkModel
-    from models.modules.grouping_network_module import GroupingNetworkModule
-    model = FpsGroupingNetworkModel(config, GroupingNetworkModule)
-if args.model_name == "tsegnet":
-    from models.tsegnet_model import TSegNetModel
-    from models.modules.tsegnet import TSegNetModule
-    model = TSegNetModel(config, TSegNetModule)
-elif args.model_name == "dgcnn":
-    from models.dgcnn_model import DGCnnModel
-    from models.modules.dgcnn import DGCnnModule
-    model = DGCnnModel(config, DGCnnModule)
-elif args.model_name == "pointnet":
-    from models.pointnet_model import PointFirstModel
-    from models.modules.pointnet import PointFirstModule
-    model = PointFirstModel(config, PointFirstModule)
-elif args.model_name == "pointnetpp":
-    from models.pointnet_pp_model import PointPpFirstModel
-    from models.modules.pointnet_pp import PointPpFirstModule
-    model = PointPpFirstModel(config, PointPpFirstModule)
-elif args.model_name == "pointtransformer":
-    from models.transformer_model import TransformerModel
-    from models.modules.point_transformer import PointTransformerModule
-    model = TransformerModel(config, PointTransformerModule)
-elif args.model_name == "tgnet_bdl":
-    from models.bdl_grouping_netowrk_model import BdlGroupingNetworkModel
-    from models.modules.grouping_network_module import GroupingNetworkModule
-    model = BdlGroupingNetworkModel(config, GroupingNetworkModule)
+def train(args):
+    config = train_config_maker.get_train_config(
+        args.config_path,
+        args.experiment_name,
+        args.input_data_dir_path,
+        args.train_data_split_txt_path,
+        args.val_data_split_txt_path,
+    )
+    config["device"] = dist_utils.init_distributed(args.dist_backend)
+    model = get_model(args.model_name, config)
 
-runner(config, model)
+    resume_path = args.resume
+    if resume_path == "auto":
+        resume_path = model.get_training_state_path()
+        if not os.path.exists(resume_path):
+            print("no training state to resume, starting from scratch")
+            resume_path = None
+    try:
+        runner(config, model, resume_path)
+    finally:
+        dist_utils.cleanup_distributed()
+
+def spawned_train(rank, args):
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(args.nprocs)
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", args.master_port)
+    train(args)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.nprocs > 1 and "WORLD_SIZE" not in os.environ:
+        import torch.multiprocessing as mp
+        mp.spawn(spawned_train, args=(args,), nprocs=args.nprocs)
+    else:
+        train(args)
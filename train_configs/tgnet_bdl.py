@@ -21,7 +21,9 @@ config = {
             "offset_1_loss": 0.03,
             "offset_1_dir_loss": 0.03,
             "chamf_1_loss": 0.15,
-        }
+        },
+        # None | "bf16". bf16 autocast also works on cpu.
+        "mixed_precision": None,
     },
     #Changing the model parameters does not actually alter the model parameters (not implemented).
     "model_parameter":{
@@ -32,6 +34,8 @@ config = {
         "block_num": 2,
         "planes": [16, 32],
         "crop_sample_size": 3072,
+        # recompute each encoder/decoder stage in backward instead of keeping its activations.
+        "grad_checkpoint": False,
     },
 
     "boundary_sampling_info":{
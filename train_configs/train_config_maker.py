@@ -23,6 +23,14 @@ def get_default_config(experiment_name, input_data_dir_path, train_data_split_tx
             "aug_obj_str": "aug.Augmentator([aug.Scaling([0.85, 1.15]), aug.Rotation([-30,30], 'fixed'), aug.Translation([-0.2, 0.2])])",
             "train_batch_size": 1,
             "val_batch_size": 1,
+            "shuffle_seed": 0,
+        },
+        #Checkpoint options
+        #Full training state(weights, optimizer, scheduler, counters) is written to {checkpoint_path}_state.pth
+        #after every epoch and every save_every_batches batches(0 to disable). It can be resumed with --resume.
+        "checkpoint":{
+            "async_save": True,
+            "save_every_batches": 500,
         },
         "checkpoint_path": f"ckpts/{experiment_name}",
     }
@@ -2,8 +2,9 @@ import torch
 import wandb
 from loss_meter import LossMeter
 from math import inf
+from dist_utils import is_main_process
 class Trainer:
-    def __init__(self, config = None, model=None, gen_set=None):
+    def __init__(self, config = None, model=None, gen_set=None, resume_path=None):
         self.gen_set = gen_set
         self.config = config
         self.model = model
@@ -11,7 +12,21 @@ class Trainer:
         self.val_count = 0
         self.train_count = 0
         self.step_count = 0
-        if config["wandb"]["wandb_on"]:
+        self.best_val_loss = inf
+        self.start_epoch = 0
+        self.start_batch_idx = 0
+        self.epoch_start_step_count = 0
+        self.wandb_id = None
+        self.save_every_batches = self.config.get("checkpoint", {}).get("save_every_batches", 0)
+        #with several training processes only the first one logs and writes checkpoints
+        self.is_main = is_main_process()
+        self.wandb_on = config["wandb"]["wandb_on"] and self.is_main
+        if resume_path is not None:
+            self.set_state(self.model.load_training_state(resume_path))
+            if self.is_main:
+                print("resumed from", resume_path, "epoch", self.start_epoch, "batch", self.start_batch_idx)
+
+        if self.wandb_on:
             wandb.init(
             entity=self.config["wandb"]["entity"],
             project=self.config["wandb"]["project"],
@@ -19,32 +34,67 @@ class Trainer:
             tags=self.config["wandb"]["tags"],
             name=self.config["wandb"]["name"],
             config=self.config,
+            id=self.wandb_id,
+            resume="allow",
             )
+            self.wandb_id = wandb.run.id
 
-        self.best_val_loss = inf
+    def get_state(self, epoch, next_batch_idx):
+        return {
+            "epoch": epoch,
+            "next_batch_idx": next_batch_idx,
+            "step_count": self.step_count,
+            "epoch_start_step_count": self.epoch_start_step_count,
+            "train_count": self.train_count,
+            "val_count": self.val_count,
+            "best_val_loss": self.best_val_loss,
+            "wandb_id": self.wandb_id,
+        }
 
-    def train(self, epoch, data_loader):
+    def set_state(self, state):
+        self.start_epoch = state["epoch"]
+        self.start_batch_idx = state["next_batch_idx"]
+        self.step_count = state["step_count"]
+        self.epoch_start_step_count = state["epoch_start_step_count"]
+        self.train_count = state["train_count"]
+        self.val_count = state["val_count"]
+        self.best_val_loss = state["best_val_loss"]
+        self.wandb_id = state["wandb_id"]
+
+    def train(self, epoch, data_loader, start_batch_idx=0):
         total_loss_meter = LossMeter()
         step_loss_meter =  LossMeter()
-        pre_step = self.step_count
-        for batch_idx, batch_item in enumerate(data_loader):
+        if start_batch_idx == 0:
+            self.epoch_start_step_count = self.step_count
+        pre_step = self.epoch_start_step_count
+        #the sampler shuffles with a per epoch seed, so a resumed epoch sees the same order and skips the finished batches without loading them
+        data_loader.sampler.set_epoch(epoch)
+        data_loader.sampler.set_start_index(start_batch_idx * data_loader.batch_size)
+        for batch_idx, batch_item in enumerate(data_loader, start_batch_idx):
             loss = self.model.step(batch_idx, batch_item, "train")
             torch.cuda.empty_cache()
             total_loss_meter.aggr(loss.get_loss_dict_for_print("train"))
             step_loss_meter.aggr(loss.get_loss_dict_for_print("step"))
-            print(loss.get_loss_dict_for_print("step"))
+            if self.is_main:
+                print(loss.get_loss_dict_for_print("step"))
             if ((batch_idx+1) % self.config["tr_set"]["scheduler"]["schedueler_step"] == 0) or (self.step_count == pre_step and batch_idx == len(data_loader)-1):
-                if self.config["wandb"]["wandb_on"]:
+                step_loss_meter.all_reduce()
+                if self.wandb_on:
                     wandb.log(step_loss_meter.get_avg_results(), step=self.step_count)
                     wandb.log({"step_lr": self.model.scheduler.get_last_lr()[0]}, step = self.step_count)
                 self.step_count +=1
                 self.model.scheduler.step(self.step_count)
                 step_loss_meter.init()
+            #every process saves, the rng states of all ranks are gathered(see save_training_state)
+            if self.save_every_batches > 0 and (batch_idx+1) % self.save_every_batches == 0:
+                self.model.save_training_state(self.get_state(epoch, batch_idx+1))
                 
-        if self.config["wandb"]["wandb_on"]:
+        total_loss_meter.all_reduce()
+        if self.wandb_on:
             wandb.log(total_loss_meter.get_avg_results(), step = self.step_count)
             self.train_count += 1
-        self.model.save("train")
+        if self.is_main:
+            self.model.save("train")
 
     def test(self, epoch, data_loader, save_best_model):
         total_loss_meter = LossMeter()
@@ -52,15 +102,17 @@ class Trainer:
             loss = self.model.step(batch_idx, batch_item, "test")
             total_loss_meter.aggr(loss.get_loss_dict_for_print("val"))
 
+        total_loss_meter.all_reduce()
         avg_total_loss = total_loss_meter.get_avg_results()
-        if self.config["wandb"]["wandb_on"]:
+        if self.wandb_on:
             wandb.log(avg_total_loss, step = self.step_count)
             self.val_count+=1
 
         if save_best_model:
             if self.best_val_loss > avg_total_loss["total_val"]:
                 self.best_val_loss = avg_total_loss["total_val"]
-                self.model.save("val")
+                if self.is_main:
+                    self.model.save("val")
 
     def train_depr(self):
         total_loss = 0
@@ -96,6 +148,11 @@ class Trainer:
     def run(self):
         train_data_loader = self.gen_set[0][0]
         val_data_loader = self.gen_set[0][1]
-        for epoch in range(100000):
-            self.train(epoch, train_data_loader)
-            self.test(epoch, val_data_loader, True)
\ No newline at end of file
+        try:
+            for epoch in range(self.start_epoch, 100000):
+                self.train(epoch, train_data_loader, self.start_batch_idx)
+                self.start_batch_idx = 0
+                self.test(epoch, val_data_loader, True)
+                self.model.save_training_state(self.get_state(epoch+1, 0))
+        finally:
+            self.model.wait_for_checkpoints()
@@ -1,5 +1,6 @@
 # websocket_client.py
 import asyncio
+import sys
 import websockets
 import json
 
@@ -17,13 +18,45 @@ async def test_inference():
         request = {
             "lower_scan": lower_scan,
             "upper_scan": upper_scan,
-            "output_dir": output_dir
+            "output_dir": output_dir,
+            "return_timing": True,
+            "preset": "accurate",
         }
 
         await websocket.send(json.dumps(request))
         response = await websocket.recv()
         print(f"Response from server: {response}")
 
+async def test_binary_inference():
+    # The meshes are sent in the message, the server does not need access to the files
+    import open3d as o3d
+    from mesh_protocol import encode_mesh_request, decode_result_message
+    uri = "ws://localhost:8800"
+    async with websockets.connect(uri,
+            ping_interval=20,
+            ping_timeout=60,
+            close_timeout=10,
+            max_size=2**28) as websocket:
+        lower_scan = "samples/SAMPLE1/SAMPLE1_l.stl"
+        mesh = o3d.io.read_triangle_mesh(lower_scan)
+        message = encode_mesh_request({"lower": (mesh.vertices, mesh.triangles)}, compression="gzip", preset="accurate", return_timing=True, result_format="binary")
+
+        await websocket.send(message)
+        # Results come back as a binary message with uint8 labels and instances, errors as json
+        response = await websocket.recv()
+        if isinstance(response, bytes):
+            response, results = decode_result_message(response)
+        else:
+            response = json.loads(response)
+            results = response.get("results", {})
+        print(f"Response from server: {response['status']} {response['message']}")
+        for scan_type, result in results.items():
+            if result is not None:
+                print(f"{scan_type}: {len(result['labels'])} labels, teeth {sorted(result['braces_location'].keys())}")
+
 # Use asyncio.run for compatibility with Python 3.7+ and better async handling
 if __name__ == "__main__":
-    asyncio.run(test_inference())
+    if "--binary" in sys.argv:
+        asyncio.run(test_binary_inference())
+    else:
+        asyncio.run(test_inference())